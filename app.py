@@ -1,41 +1,320 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
 import re
 import json
 import hashlib
 import pickle
 import os
+import sys
 from typing import List, Dict, Optional
 import time
 import io
 import base64
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
-from google.auth.transport.requests import Request
+import threading
+import weakref
+from collections import OrderedDict, deque
+from collections.abc import Mapping, MutableMapping, Sequence
+from bisect import bisect_left, insort
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import queue
+import random
 import tempfile
+import gzip
+import zipfile
+import zlib
+import sqlite3
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: shard writes are only serialized within the process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
 
 # ----------------------------
 # Configuration
 # ----------------------------
 CHAT_HISTORY_FILE = "chat_sessions.pkl"
 CHAT_HISTORY_JSON = "chat_sessions.json"
-MAX_CHAT_HISTORY = 100
+CHAT_LOG_DIR = "chat_sessions_log"
+LOG_COMPACT_MIN_RECORDS = 256
+CHAT_DB_FILE = "chat_sessions.db"
+STORAGE_BACKEND = os.environ.get("CHAT_STORAGE_BACKEND", "sqlite")  # "sqlite", "log", "files" or "kv"
+CHAT_SHARD_DIR = "chat_sessions_shards"
+CHAT_KV_URL = os.environ.get("CHAT_KV_URL")  # e.g. redis://host:6379/0; required by the "kv" backend
+SHARD_REFRESH_SECONDS = 5  # how often sharded stores pick up writes from other processes
+KV_CAS_MAX_ATTEMPTS = 100
+MAX_CHAT_HISTORY = 100  # sessions kept in the live store; older ones are archived
+CHAT_ARCHIVE_DIR = "chat_sessions_archive"
+SESSION_CACHE_SIZE = 8  # sessions whose messages stay in memory per user
+SEARCH_INDEX_FILE = "chat_search.db"
+SEARCH_RESULT_LIMIT = 10
+EXPORT_DIR = "exports"
+CUSTOMER_DATA_FILE = os.environ.get("CUSTOMER_DATA_FILE", "customers.csv")  # CRM export, .csv or .parquet
+CUSTOMER_SEGMENT_COLUMN = "segment"
+CUSTOMER_STATUS_COLUMN = "status"
+CUSTOMER_ACTIVE_STATUSES = ("active",)
+CUSTOMER_LAST_VISIT_COLUMN = "last_visit"  # used for "active" when there is no status column
+CUSTOMER_ACTIVE_DAYS = 90
+TRANSCRIPT_PAGE_SIZE = 30
+RENDER_CACHE_SIZE = 4096
+STATS_REFRESH_SECONDS = 10
 DEFAULT_N8N_WEBHOOK = "https://agentonline-u29564.vm.elestio.app/webhook/f4927f0d-167b-4ab0-94d2-87d4c373f9e9"
 
+# Webhook HTTP client configuration
+WEBHOOK_POOL_SIZE = 10
+WEBHOOK_CONNECT_TIMEOUT = 5
+WEBHOOK_READ_TIMEOUT = 45
+WEBHOOK_MAX_RETRIES = 2
+WEBHOOK_RETRY_BACKOFF = 0.5
+WEBHOOK_RETRY_STATUSES = (502, 503)  # 504: the upstream may still be running the request
+WEBHOOK_BREAKER_THRESHOLD = 5
+WEBHOOK_BREAKER_RESET_SECONDS = 30
+
+# Hedged dispatch across equivalent webhook endpoints
+WEBHOOK_HEDGE_WORKERS = WEBHOOK_POOL_SIZE  # one thread per pooled connection
+WEBHOOK_HEDGE_DEFAULT_DELAY = 2.0
+WEBHOOK_HEDGE_MIN_DELAY = 0.25
+WEBHOOK_HEDGE_MAX_DELAY = 10.0
+WEBHOOK_LATENCY_WINDOW = 100
+WEBHOOK_LATENCY_MIN_SAMPLES = 5
+
+# Durable outbox for webhook calls the UI stopped waiting for
+WEBHOOK_OUTBOX_FILE = "webhook_outbox.db"
+WEBHOOK_UI_WAIT_SECONDS = 8  # longest the UI waits for a reply (or the next streamed chunk)
+WEBHOOK_STREAM_TAG_HOLD = 256  # longest unclosed "<..." held back waiting for the rest of a split tag
+WEBHOOK_OUTBOX_WORKERS = WEBHOOK_POOL_SIZE  # threads for retries; first attempts get their own
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_RETRY_STATUSES = WEBHOOK_RETRY_STATUSES + (429,)  # answers that say the workflow did not run
+OUTBOX_BACKOFF_BASE = 2
+OUTBOX_BACKOFF_MAX = 300
+OUTBOX_POLL_SECONDS = 5
+OUTBOX_PATCH_WINDOW = 24 * 60 * 60  # how long a late reply waits for its placeholder to be saved
+OUTBOX_RETENTION = 7 * 24 * 60 * 60
+
+# Conversation context sent with each prompt
+CONTEXT_BUDGETS = {  # UTF-8 bytes per prompt by user role, roughly 4 bytes per token
+    "Visitor": 2 * 1024,
+    "Customer": 4 * 1024,
+    "Technician": 8 * 1024,
+    "Manager": 8 * 1024,
+    "Admin": 16 * 1024,
+}
+CONTEXT_DEFAULT_BUDGET = 4 * 1024
+CONTEXT_SUMMARY_SHARE = 0.3  # part of the budget spent on the summary of older turns
+CONTEXT_SUMMARY_POOL = 3  # candidate sentences kept, as a multiple of the summary budget
+CONTEXT_SUMMARY_TERMS = 300  # term counts kept for scoring sentences
+
+# Response cache configuration
+RESPONSE_CACHE_TTL = 6 * 60 * 60
+RESPONSE_CACHE_MAX_ENTRIES = 500
+RESPONSE_CACHE_MAX_BYTES = 4 * 1024 * 1024
+RESPONSE_CACHE_FILE = "response_cache.db"  # set to None for a memory-only cache
+
 # Google Drive Configuration
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 DRIVE_FOLDER_NAME = "Lil J's AI Chat Sessions"
+DRIVE_SYNC_DEBOUNCE_SECONDS = 3
+DRIVE_SYNC_MAX_RETRIES = 5
+DRIVE_SYNC_BACKOFF_BASE = 2
+DRIVE_SYNC_BACKOFF_MAX = 60
+DRIVE_SYNC_MODE = "delta"  # "delta" uploads one file per changed session, "full" one snapshot file
+DRIVE_MANIFEST_NAME = "session_manifest.json"
+DRIVE_MANIFEST_CACHE = "drive_manifest_cache.json"
+DRIVE_DOWNLOAD_CACHE = "drive_download_cache.json"
+DRIVE_LISTING_CACHE = "drive_listing_cache.json"
+DRIVE_LISTING_TTL_SECONDS = 60  # how often the cached file list is checked against the Changes API
+DRIVE_LISTING_POLL_SECONDS = 5  # how often the sidebar re-reads the cached listing
+DRIVE_SYNC_STATUS_POLL_SECONDS = 3  # how often the footer re-reads the background sync state
+DRIVE_LISTING_FIELDS = "id, name, modifiedTime, size"
+DRIVE_LIST_PAGE_SIZE = 1000
+DRIVE_DISCOVERY_CACHE = "drive_v3_discovery.json"
+DRIVE_TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024  # must be a multiple of 256 KB
+DRIVE_TRANSFER_RETRIES = 5
+DRIVE_ARCHIVE_TMP_PREFIX = "chat_archive_"
+DRIVE_ARCHIVE_TMP_MAX_AGE = 7 * 24 * 3600  # Drive expires resumable upload sessions after a week
+DRIVE_DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/drive/v3/rest"
 
 # ----------------------------
 # Google Drive Integration
 # ----------------------------
-class GoogleDriveManager:
+def _http_status(error: Exception) -> Optional[int]:
+    """HTTP status of a failed Drive API call (``HttpError.resp.status``), if it has one"""
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+def _load_json_file(path: str) -> Dict:
+    """Contents of a local JSON cache file, or an empty dict if it is missing or unreadable"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def _save_json_file(path: str, data: Dict):
+    """Replace a local JSON cache file via rename, so readers never see a partial write.
+
+    Each write uses its own temporary file, so concurrent writers never share one.
+    """
+    tmp = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}.",
+                                      suffix=".tmp", delete=False)
+    try:
+        with tmp:
+            json.dump(data, tmp)
+        os.replace(tmp.name, path)
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+
+class _LockedAuthorizedHttp:
+    """Authorized httplib2 transport shared across threads.
+
+    httplib2 connections are not thread-safe, so requests are serialized;
+    the keep-alive connection and the access token are reused by every
+    caller. google-auth refreshes the token only once it is close to expiry.
+    """
+
+    def __init__(self, credentials):
+        import google_auth_httplib2
+        import httplib2
+        self._http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=60))
+        self._lock = threading.Lock()
+    
+    def request(self, *args, **kwargs):
+        with self._lock:
+            return self._http.request(*args, **kwargs)
+    
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+class DriveClientPool:
+    """Process-wide Drive API clients keyed by service-account identity.
+
+    Each identity gets one credentials object, one authorized transport and
+    one service built from a locally cached discovery document, so reruns,
+    saves and the sync worker reuse them instead of rebuilding per call.
+    """
+
     def __init__(self):
+        self._clients: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        self._discovery_doc = None
+    
+    @staticmethod
+    def identity(credentials_info: Dict) -> tuple:
+        return (credentials_info.get('client_email'), credentials_info.get('private_key_id'))
+    
+    def _discovery_document(self) -> str:
+        if self._discovery_doc is None:
+            if os.path.exists(DRIVE_DISCOVERY_CACHE):
+                with open(DRIVE_DISCOVERY_CACHE, 'r') as f:
+                    self._discovery_doc = f.read()
+            else:
+                from googleapiclient import discovery_cache
+                doc = discovery_cache.get_static_doc('drive', 'v3')
+                if doc is None:
+                    response = requests.get(DRIVE_DISCOVERY_URL, timeout=30)
+                    response.raise_for_status()
+                    doc = response.text
+                with open(DRIVE_DISCOVERY_CACHE, 'w') as f:
+                    f.write(doc)
+                self._discovery_doc = doc
+        return self._discovery_doc
+    
+    def get(self, credentials_info: Dict):
+        """Return the shared Drive service for a service account, building it once"""
+        key = self.identity(credentials_info)
+        with self._lock:
+            service = self._clients.get(key)
+            if service is None:
+                from google.oauth2 import service_account
+                from googleapiclient.discovery import build_from_document
+                credentials = service_account.Credentials.from_service_account_info(
+                    credentials_info, scopes=SCOPES
+                )
+                service = build_from_document(
+                    self._discovery_document(), http=_LockedAuthorizedHttp(credentials)
+                )
+                self._clients[key] = service
+            return service
+    
+    def invalidate(self, credentials_info: Optional[Dict] = None):
+        """Drop the client for one service account, or all clients"""
+        with self._lock:
+            if credentials_info is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(self.identity(credentials_info), None)
+
+@st.cache_resource
+def get_drive_client_pool() -> DriveClientPool:
+    return DriveClientPool()
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class PendingArchiveUpload:
+    """A resumable archive upload that stopped part way through.
+
+    Lives in the browser session's ``st.session_state`` under the account it
+    was started with, never on the shared ``GoogleDriveManager``. Its temp file
+    is removed when the upload finishes or is discarded, or at the latest when
+    the session holding it is garbage-collected.
+    """
+
+    def __init__(self, request, path: str, filename: str):
+        self.request = request
+        self.path = path
+        self.filename = filename
+        self.progress = 0.0
+        self._cleanup = weakref.finalize(self, _remove_quietly, path)
+    
+    def discard(self):
+        self._cleanup()
+
+def _archive_upload_key() -> Optional[tuple]:
+    """The account (service account and folder) this browser session is connected to"""
+    credentials_info = st.session_state.get('drive_credentials')
+    if not credentials_info:
+        return None
+    return DriveClientPool.identity(credentials_info) + (st.session_state.get('drive_folder_id'),)
+
+def _sweep_stale_archive_files():
+    """Remove archive temp files left behind by a process that exited mid-upload"""
+    cutoff = time.time() - DRIVE_ARCHIVE_TMP_MAX_AGE
+    tmp_dir = tempfile.gettempdir()
+    try:
+        names = [n for n in os.listdir(tmp_dir) if n.startswith(DRIVE_ARCHIVE_TMP_PREFIX)]
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(tmp_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+class GoogleDriveManager:
+    def __init__(self, client_pool: Optional[DriveClientPool] = None):
         self.service = None
         self.folder_id = None
+        self.client_pool = client_pool or DriveClientPool()
     
     def authenticate_service_account(self, service_account_json: str) -> bool:
         """Authenticate with Google Drive using service account"""
@@ -52,14 +331,8 @@ class GoogleDriveManager:
                 st.error("❌ File is not a service account credential")
                 return False
             
-            # Create credentials from service account info
-            from google.oauth2 import service_account
-            credentials = service_account.Credentials.from_service_account_info(
-                credentials_info, scopes=SCOPES
-            )
-            
-            # Build Drive service
-            self.service = build('drive', 'v3', credentials=credentials)
+            # Get the pooled Drive service for this service account
+            self.service = self.client_pool.get(credentials_info)
             
             # Test the connection
             self.service.about().get(fields="user").execute()
@@ -90,12 +363,7 @@ class GoogleDriveManager:
             if not credentials_info:
                 return False
             
-            from google.oauth2 import service_account
-            credentials = service_account.Credentials.from_service_account_info(
-                credentials_info, scopes=SCOPES
-            )
-            
-            self.service = build('drive', 'v3', credentials=credentials)
+            self.service = self.client_pool.get(credentials_info)
             self.folder_id = st.session_state.get('drive_folder_id')
             
             if not self.folder_id:
@@ -108,6 +376,13 @@ class GoogleDriveManager:
             st.error(f"Drive initialization error: {str(e)}")
             return False
     
+    def initialize_from_credentials(self, credentials_info: Dict, folder_id: Optional[str] = None):
+        """Initialize Drive service outside a Streamlit script run; raises on failure"""
+        self.service = self.client_pool.get(credentials_info)
+        self.folder_id = folder_id or self._get_or_create_folder()
+        if not self.folder_id:
+            raise RuntimeError("Drive folder is not available")
+    
     def _get_or_create_folder(self) -> str:
         """Get or create the chat sessions folder in Drive"""
         try:
@@ -143,74 +418,97 @@ class GoogleDriveManager:
             if not self.service or not self.folder_id:
                 return False
             
-            if not filename:
-                filename = f"chat_sessions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-            
-            # Convert sessions to JSON format
-            json_data = json.dumps(sessions_data, indent=2, default=str)
-            
-            # Create file metadata
-            file_metadata = {
-                'name': filename,
-                'parents': [self.folder_id]
-            }
-            
-            # Upload file
-            media = MediaIoBaseUpload(
-                io.BytesIO(json_data.encode()),
-                mimetype='application/json'
-            )
-            
-            # Check if file already exists and update it - properly escape filename
-            query = f"name = \"{filename}\" and parents in \"{self.folder_id}\""
-            existing_files = self.service.files().list(
-                q=query,
-                spaces='drive',
-                fields='files(id, name)'
-            ).execute()
-            
-            if existing_files.get('files'):
-                # Update existing file
-                file_id = existing_files['files'][0]['id']
-                self.service.files().update(
-                    fileId=file_id,
-                    media_body=media,
-                    fields='id'
-                ).execute()
-            else:
-                # Create new file
-                self.service.files().create(
-                    body=file_metadata,
-                    media_body=media,
-                    fields='id'
-                ).execute()
-            
+            self._upload_file(dict(sessions_data), filename)
             return True
             
         except Exception as e:
             st.error(f"Upload error: {str(e)}")
             return False
     
+    def _upload_file(self, sessions_data: Dict, filename: str = None):
+        """Create or update a sessions JSON file in the Drive folder; raises on failure"""
+        if not filename:
+            filename = f"chat_sessions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        
+        # Convert sessions to JSON format
+        json_data = json.dumps(sessions_data, indent=2, default=_json_default)
+        
+        # Create file metadata
+        file_metadata = {
+            'name': filename,
+            'parents': [self.folder_id]
+        }
+        
+        # Upload file
+        from googleapiclient.http import MediaIoBaseUpload
+        media = MediaIoBaseUpload(
+            io.BytesIO(json_data.encode()),
+            mimetype='application/json'
+        )
+        
+        # Check if file already exists and update it - properly escape filename
+        query = f"name = \"{filename}\" and parents in \"{self.folder_id}\""
+        existing_files = self.service.files().list(
+            q=query,
+            spaces='drive',
+            fields='files(id, name)'
+        ).execute()
+        
+        if existing_files.get('files'):
+            # Update existing file
+            file_id = existing_files['files'][0]['id']
+            self.service.files().update(
+                fileId=file_id,
+                media_body=media,
+                fields='id'
+            ).execute()
+        else:
+            # Create new file
+            self.service.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields='id'
+            ).execute()
+    
     def list_session_files(self) -> List[Dict]:
-        """List all session files in Drive folder"""
-        try:
-            if not self.service or not self.folder_id:
-                return []
-            
-            # Properly construct query with double quotes for folder ID and contains operator
-            query = f"parents in \"{self.folder_id}\" and name contains \"chat_sessions\""
+        """List every session file in the Drive folder, following all result pages; raises on failure"""
+        # Properly construct query with double quotes for folder ID and contains operator
+        query = f"parents in \"{self.folder_id}\" and name contains \"chat_sessions\" and trashed = false"
+        files = []
+        page_token = None
+        while True:
             results = self.service.files().list(
                 q=query,
                 orderBy='modifiedTime desc',
                 spaces='drive',
-                fields="files(id, name, modifiedTime, size)"
+                pageSize=DRIVE_LIST_PAGE_SIZE,
+                pageToken=page_token,
+                fields=f"nextPageToken, files({DRIVE_LISTING_FIELDS})"
             ).execute()
-            
-            return results.get('files', [])
-            
-        except Exception as e:
-            st.error(f"List files error: {str(e)}")
-            return []
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return files
+    
+    def start_page_token(self) -> str:
+        """Changes API token for "now"; changes after this point are listed from it; raises on failure"""
+        return self.service.changes().getStartPageToken().execute()['startPageToken']
+    
+    def list_changes(self, page_token: str) -> tuple:
+        """All changes since ``page_token`` and the token to continue from next time; raises on failure"""
+        changes = []
+        while True:
+            results = self.service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                pageSize=DRIVE_LIST_PAGE_SIZE,
+                fields=f"nextPageToken, newStartPageToken, "
+                       f"changes(fileId, removed, file({DRIVE_LISTING_FIELDS}, parents, trashed))"
+            ).execute()
+            changes.extend(results.get('changes', []))
+            if 'newStartPageToken' in results:
+                return changes, results['newStartPageToken']
+            page_token = results['nextPageToken']
     
     def download_sessions(self, file_id: str) -> Optional[Dict]:
         """Download and parse session file from Drive"""
@@ -218,321 +516,3937 @@ class GoogleDriveManager:
             if not self.service:
                 return None
             
-            request = self.service.files().get_media(fileId=file_id)
-            file_content = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_content, request)
+            return self._download_json(file_id)
+            
+        except Exception as e:
+            st.error(f"Download error: {str(e)}")
+            return None
+    
+    def _download_json(self, file_id: str):
+        """Download a JSON file from Drive and parse it; raises on failure"""
+        from googleapiclient.http import MediaIoBaseDownload
+        request = self.service.files().get_media(fileId=file_id)
+        file_content = io.BytesIO()
+        downloader = MediaIoBaseDownload(file_content, request)
+        
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
+        
+        # Parse JSON content
+        file_content.seek(0)
+        return json.loads(file_content.read().decode())
+    
+    def _put_json(self, data, filename: str, file_id: Optional[str] = None) -> str:
+        """Update a Drive file by ID, or create it when there is no ID; returns the file ID"""
+        from googleapiclient.http import MediaIoBaseUpload
+        media = MediaIoBaseUpload(
+            io.BytesIO(json.dumps(data, default=_json_default).encode()),
+            mimetype='application/json'
+        )
+        if file_id:
+            try:
+                self.service.files().update(fileId=file_id, media_body=media, fields='id').execute()
+                return file_id
+            except Exception as e:
+                # The cached ID is stale if the file was removed in Drive; recreate it below
+                if _http_status(e) != 404:
+                    raise
+                media = MediaIoBaseUpload(
+                    io.BytesIO(json.dumps(data, default=_json_default).encode()),
+                    mimetype='application/json'
+                )
+        
+        created = self.service.files().create(
+            body={'name': filename, 'parents': [self.folder_id]},
+            media_body=media,
+            fields='id'
+        ).execute()
+        return created['id']
+    
+    def upload_sessions_delta(self, sessions_data: Dict, manifest_cache: "DriveManifestCache") -> int:
+        """Upload only sessions whose content changed since the last sync; raises on failure.
+
+        Each session is stored as its own ``session_<id>.json`` file, and a
+        manifest of content hashes and file IDs is kept next to them. File IDs
+        come from the local manifest cache, so no name lookups are needed.
+        Returns the number of session files uploaded.
+        """
+        entries = manifest_cache.entries(self.folder_id)
+        uploaded = 0
+        changed = False
+        
+        try:
+            lazy = hasattr(sessions_data, "meta")  # a StoredSessions view, from any rerun
+            for session_id in list(sessions_data):
+                entry = entries.get(session_id, {})
+                # Store views answer from metadata so unchanged sessions are never loaded
+                meta = sessions_data.meta(session_id) if lazy else sessions_data[session_id]
+                if meta is None:
+                    continue
+                version = [meta.get("last_activity"), meta.get("message_count")]
+                if entry.get("version") == version and entry.get("file_id"):
+                    continue
+                
+                session_data = sessions_data[session_id]
+                content_hash = hashlib.sha256(
+                    json.dumps(session_data, sort_keys=True, default=_json_default).encode()
+                ).hexdigest()
+                if entry.get("hash") != content_hash or not entry.get("file_id"):
+                    entry["file_id"] = self._put_json(
+                        {session_id: session_data}, f"session_{session_id}.json", entry.get("file_id")
+                    )
+                    entry["hash"] = content_hash
+                    uploaded += 1
+                    changed = True
+                entry["version"] = version
+                entries[session_id] = entry
+            
+            # Sessions moved to the local archive keep their Drive copy
+            for session_id in [sid for sid in entries if sid not in sessions_data
+                               and not (lazy and sessions_data.is_archived(sid))]:
+                file_id = entries.pop(session_id).get("file_id")
+                changed = True
+                if file_id:
+                    try:
+                        self.service.files().delete(fileId=file_id).execute()
+                    except Exception as e:
+                        if _http_status(e) != 404:
+                            raise
+            
+            if changed:
+                manifest = {
+                    "updated_at": datetime.now().isoformat(),
+                    "sessions": {
+                        sid: {"hash": entry["hash"], "file_id": entry["file_id"]}
+                        for sid, entry in entries.items()
+                    }
+                }
+                manifest_cache.set_manifest_id(
+                    self.folder_id,
+                    self._put_json(manifest, DRIVE_MANIFEST_NAME, manifest_cache.manifest_id(self.folder_id))
+                )
+        finally:
+            # Keep progress from a partial sync so a retry skips finished sessions
+            manifest_cache.save()
+        
+        return uploaded
+    
+    def file_metadata(self, file_id: str) -> Dict:
+        """Current name, checksum, modification time and size of a Drive file; raises on failure"""
+        return self.service.files().get(
+            fileId=file_id, fields="id, name, md5Checksum, modifiedTime, size"
+        ).execute()
+    
+    def find_delta_manifest(self) -> Optional[Dict]:
+        """Metadata of the per-session sync manifest in the folder, if there is one; raises on failure"""
+        query = f"name = \"{DRIVE_MANIFEST_NAME}\" and parents in \"{self.folder_id}\""
+        files = self.service.files().list(
+            q=query, spaces='drive', fields='files(id, name, md5Checksum, modifiedTime, size)'
+        ).execute().get('files', [])
+        return files[0] if files else None
+
+    def upload_sessions_archive(self, sessions, filename: str = None, fmt: str = "ndjson.gz") -> bool:
+        """Upload sessions as a gzip NDJSON (or ZIP) archive with a resumable upload.
+
+        ``sessions`` is an iterable of ``(session_id, session_data)`` pairs; it is
+        streamed to a temporary file with ``write_export`` one session at a
+        time, so memory stays bounded by the largest session. Chunks that fail
+        are retried from the last confirmed offset, and an upload interrupted
+        beyond that is kept in this browser session so ``resume_archive_upload``
+        can continue it instead of restarting.
+        """
+        try:
+            if not self.service or not self.folder_id:
+                return False
+            
+            if not filename:
+                filename = f"chat_sessions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
             
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
+            # A new archive supersedes one this session left unfinished
+            self.discard_archive_upload()
+            _sweep_stale_archive_files()
             
-            # Parse JSON content
-            file_content.seek(0)
-            sessions_data = json.loads(file_content.read().decode())
+            with tempfile.NamedTemporaryFile(
+                prefix=DRIVE_ARCHIVE_TMP_PREFIX, suffix=f".{fmt}", delete=False
+            ) as tmp:
+                pending = PendingArchiveUpload(None, tmp.name, filename)
+                write_export(sessions, tmp, fmt)
             
-            return sessions_data
+            from googleapiclient.http import MediaFileUpload
+            media = MediaFileUpload(
+                tmp.name,
+                mimetype=EXPORT_FORMATS[fmt],
+                chunksize=DRIVE_TRANSFER_CHUNK_SIZE,
+                resumable=True
+            )
+            pending.request = self.service.files().create(
+                body={'name': filename, 'parents': [self.folder_id]},
+                media_body=media,
+                fields='id'
+            )
+            st.session_state.setdefault('pending_archive_uploads', {})[_archive_upload_key()] = pending
+            return self.resume_archive_upload()
             
         except Exception as e:
-            st.error(f"Download error: {str(e)}")
-            return None
+            st.error(f"Upload error: {str(e)}")
+            return False
+    
+    def pending_archive_upload(self) -> Optional[PendingArchiveUpload]:
+        """This browser session's interrupted archive upload for its connected account"""
+        return st.session_state.get('pending_archive_uploads', {}).get(_archive_upload_key())
+    
+    def discard_archive_upload(self):
+        """Drop this session's interrupted archive upload and its temp file"""
+        pending = st.session_state.get('pending_archive_uploads', {}).pop(_archive_upload_key(), None)
+        if pending is not None:
+            pending.discard()
+    
+    def resume_archive_upload(self) -> bool:
+        """Continue the pending resumable archive upload from its last confirmed chunk"""
+        pending = self.pending_archive_upload()
+        if not pending:
+            return False
+        try:
+            response = None
+            while response is None:
+                status, response = pending.request.next_chunk(num_retries=DRIVE_TRANSFER_RETRIES)
+                if status:
+                    pending.progress = status.progress()
+            
+            self.discard_archive_upload()
+            return True
+            
+        except Exception as e:
+            st.error(f"Upload interrupted at {pending.progress:.0%}: {str(e)}")
+            return False
+    
+    def iter_archive_sessions(self, file_id: str):
+        """Stream ``(session_id, session_data)`` pairs out of an NDJSON(.gz) archive.
+
+        Sessions are parsed as each chunk arrives from ``MediaIoBaseDownload``,
+        so only one chunk and one partial line are held in memory. Failed
+        chunks are re-requested from the current byte offset.
+        """
+        from googleapiclient.http import MediaIoBaseDownload
+        sink = _NDJSONArchiveSink()
+        request = self.service.files().get_media(fileId=file_id)
+        downloader = MediaIoBaseDownload(sink, request, chunksize=DRIVE_TRANSFER_CHUNK_SIZE)
+        
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk(num_retries=DRIVE_TRANSFER_RETRIES)
+            yield from sink.drain()
+        yield from sink.drain(final=True)
+
+class _NDJSONArchiveSink:
+    """Write target for MediaIoBaseDownload that decompresses and splits NDJSON lines"""
+
+    def __init__(self):
+        self._decompressor = None
+        self._buffer = b""
+        self._ready: List[bytes] = []
+    
+    def write(self, data: bytes) -> int:
+        if self._decompressor is None:
+            # Archives are gzip; plain NDJSON files are accepted as well
+            self._decompressor = zlib.decompressobj(wbits=31) if data[:2] == b"\x1f\x8b" else False
+        chunk = self._decompressor.decompress(data) if self._decompressor else data
+        
+        lines = (self._buffer + chunk).split(b"\n")
+        self._buffer = lines.pop()
+        self._ready.extend(line for line in lines if line.strip())
+        return len(data)
+    
+    def drain(self, final: bool = False):
+        if final:
+            if self._decompressor:
+                self._buffer += self._decompressor.flush()
+            if self._buffer.strip():
+                self._ready.append(self._buffer)
+            self._buffer = b""
+        ready, self._ready = self._ready, []
+        for line in ready:
+            record = json.loads(line)
+            yield record["session_id"], record["session"]
+
+class DriveManifestCache:
+    """Local cache of per-session Drive file IDs and content hashes, keyed by folder"""
+
+    def __init__(self, path: str = DRIVE_MANIFEST_CACHE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = _load_json_file(path)
+    
+    def _folder(self, folder_id: str) -> Dict:
+        return self._data.setdefault(folder_id, {"manifest_id": None, "sessions": {}})
+    
+    def entries(self, folder_id: str) -> Dict:
+        """Mutable ``session_id -> {file_id, hash, version}`` mapping for a folder"""
+        with self._lock:
+            return self._folder(folder_id)["sessions"]
+    
+    def manifest_id(self, folder_id: str) -> Optional[str]:
+        with self._lock:
+            return self._folder(folder_id)["manifest_id"]
+    
+    def set_manifest_id(self, folder_id: str, file_id: str):
+        with self._lock:
+            self._folder(folder_id)["manifest_id"] = file_id
+    
+    def save(self):
+        with self._lock:
+            _save_json_file(self.path, self._data)
+
+class DriveDownloadCache:
+    """What was last pulled from each Drive file, so unchanged downloads are skipped.
+
+    Per file it keeps the ``md5Checksum``/``modifiedTime`` seen at the last
+    pull and a digest of every session that file held, so a changed archive
+    only merges the sessions that differ from the previous pull.
+    """
+
+    def __init__(self, path: str = DRIVE_DOWNLOAD_CACHE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = _load_json_file(path)
+    
+    @staticmethod
+    def _stamp(file_meta: Dict) -> list:
+        return [file_meta.get("md5Checksum"), file_meta.get("modifiedTime")]
+    
+    def unchanged(self, file_meta: Dict) -> bool:
+        with self._lock:
+            entry = self._data.get(file_meta["id"])
+        return bool(entry) and entry["stamp"] == self._stamp(file_meta)
+    
+    def session_digests(self, file_id: str) -> Dict:
+        with self._lock:
+            return dict(self._data.get(file_id, {}).get("sessions", {}))
+    
+    def record(self, file_meta: Dict, session_digests: Dict, complete: bool = True):
+        """Remember a pull; an incomplete one is not skipped next time, only its merged sessions are"""
+        with self._lock:
+            stamp = self._stamp(file_meta) if complete else None
+            self._data[file_meta["id"]] = {"stamp": stamp, "sessions": session_digests}
+    
+    def save(self):
+        with self._lock:
+            _save_json_file(self.path, self._data)
+
+@st.cache_resource
+def get_drive_download_cache() -> DriveDownloadCache:
+    return DriveDownloadCache()
+
+def _is_session_file(file_meta: Dict) -> bool:
+    return "chat_sessions" in file_meta.get("name", "")
+
+class DriveFileListing:
+    """Cached listing of the session files in each Drive folder.
+
+    A folder is listed in full once, every page of it, together with a
+    Changes API start token. After that the listing is kept current from
+    ``changes.list`` at most once per ``DRIVE_LISTING_TTL_SECONDS``, and the
+    token and files are saved so a restart resumes from them. Reads never
+    call the API; ``refresh_async`` brings the cache up to date on a
+    background thread.
+    """
+
+    def __init__(self, client_pool: DriveClientPool, path: str = DRIVE_LISTING_CACHE):
+        self._client_pool = client_pool
+        self.path = path
+        self._lock = threading.Lock()
+        self._checked: Dict[str, float] = {}  # folder_id -> monotonic time of the last refresh
+        self._refreshing = set()
+        self._errors: Dict[str, str] = {}
+        self._ordered: Dict[str, List[Dict]] = {}  # folder_id -> files sorted newest first
+        self._data = _load_json_file(path)
+    
+    def files(self, folder_id: str) -> Optional[List[Dict]]:
+        """Cached session files, newest first; ``None`` until the folder was listed once"""
+        with self._lock:
+            entry = self._data.get(folder_id)
+            if entry is None:
+                return None
+            if folder_id not in self._ordered:
+                self._ordered[folder_id] = sorted(
+                    entry["files"].values(), key=lambda f: f.get("modifiedTime", ""), reverse=True
+                )
+            return list(self._ordered[folder_id])
+    
+    def status(self, folder_id: str) -> Dict:
+        """Whether a refresh is running and the error from the last one, if it failed"""
+        with self._lock:
+            return {"refreshing": folder_id in self._refreshing, "error": self._errors.get(folder_id)}
+    
+    def is_stale(self, folder_id: str) -> bool:
+        with self._lock:
+            checked = self._checked.get(folder_id)
+        return checked is None or time.monotonic() - checked >= DRIVE_LISTING_TTL_SECONDS
+    
+    def invalidate(self, folder_id: Optional[str]):
+        """Check the folder for changes on the next render, e.g. after this app uploaded a file"""
+        with self._lock:
+            self._checked.pop(folder_id, None)
+    
+    def refresh(self, drive_manager: "GoogleDriveManager"):
+        """Apply changes since the stored token, or list the folder in full; raises on failure"""
+        folder_id = drive_manager.folder_id
+        with self._lock:
+            self._checked[folder_id] = time.monotonic()
+            entry = self._data.get(folder_id)
+            page_token = entry["page_token"] if entry else None
+        
+        if page_token:
+            try:
+                changes, next_token = drive_manager.list_changes(page_token)
+            except Exception as e:
+                # An expired or unknown token means the folder has to be listed again
+                if _http_status(e) not in (400, 404, 410):
+                    raise
+            else:
+                with self._lock:
+                    files = self._data[folder_id]["files"]
+                    for change in changes:
+                        file_id = change.get("fileId")
+                        file_meta = change.get("file") or {}
+                        if not file_id:
+                            continue
+                        if (change.get("removed") or file_meta.get("trashed")
+                                or folder_id not in file_meta.get("parents", [])
+                                or not _is_session_file(file_meta)):
+                            files.pop(file_id, None)
+                        else:
+                            files[file_id] = {k: file_meta[k] for k in ("id", "name", "modifiedTime", "size")
+                                              if k in file_meta}
+                    self._data[folder_id]["page_token"] = next_token
+                    if changes:
+                        self._ordered.pop(folder_id, None)
+                if changes or next_token != page_token:
+                    self.save()
+                return
+        
+        # Take the token first so changes made while listing are replayed next time
+        next_token = drive_manager.start_page_token()
+        files = drive_manager.list_session_files()
+        with self._lock:
+            self._data[folder_id] = {"page_token": next_token, "files": {f["id"]: f for f in files}}
+            self._ordered.pop(folder_id, None)
+        self.save()
+    
+    def refresh_async(self, credentials_info: Dict, folder_id: str):
+        """Refresh a folder's listing on a background thread unless one is already running"""
+        with self._lock:
+            if folder_id in self._refreshing:
+                return
+            self._refreshing.add(folder_id)
+        threading.Thread(
+            target=self._refresh_in_background, args=(credentials_info, folder_id),
+            name="drive-listing", daemon=True
+        ).start()
+    
+    def _refresh_in_background(self, credentials_info: Dict, folder_id: str):
+        try:
+            drive_manager = GoogleDriveManager(self._client_pool)
+            drive_manager.initialize_from_credentials(credentials_info, folder_id)
+            self.refresh(drive_manager)
+            error = None
+        except Exception as e:
+            error = str(e)
+        with self._lock:
+            self._refreshing.discard(folder_id)
+            self._checked[folder_id] = time.monotonic()
+            if error:
+                self._errors[folder_id] = error
+            else:
+                self._errors.pop(folder_id, None)
+    
+    def save(self):
+        with self._lock:
+            _save_json_file(self.path, self._data)
+
+@st.cache_resource
+def get_drive_file_listing() -> DriveFileListing:
+    return DriveFileListing(get_drive_client_pool())
+
+def invalidate_drive_listing():
+    """Pick up this user's new Drive uploads on the next render"""
+    get_drive_file_listing().invalidate(st.session_state.get('drive_folder_id'))
 
 # Initialize Google Drive manager
 @st.cache_resource
 def get_drive_manager():
-    return GoogleDriveManager()
+    return GoogleDriveManager(get_drive_client_pool())
+
+class DriveSyncWorker:
+    """Uploads chat sessions to Drive on a background thread.
+
+    Saves are queued per service account and coalesced: a burst of saves
+    within the debounce window becomes a single upload of the newest data.
+    Failed uploads are retried with jittered exponential backoff, and newer
+    saves that arrive during the backoff replace the pending data.
+    """
+
+    def __init__(self, client_pool: DriveClientPool):
+        self._client_pool = client_pool
+        self._queue = queue.Queue()
+        self._status: Dict[tuple, Dict] = {}
+        self._lock = threading.Lock()
+        self._manifest_cache = DriveManifestCache()
+        self._thread = threading.Thread(target=self._run, name="drive-sync", daemon=True)
+        self._thread.start()
+    
+    @staticmethod
+    def _key(credentials_info: Dict, folder_id: Optional[str]) -> tuple:
+        return (credentials_info.get('client_email'), folder_id)
+    
+    def submit(self, credentials_info: Dict, folder_id: Optional[str], sessions: Dict):
+        """Queue an upload of ``sessions`` without waiting for Drive"""
+        job = {
+            "key": self._key(credentials_info, folder_id),
+            "credentials": credentials_info,
+            "folder_id": folder_id,
+            # A store view is read on the worker thread; plain dicts are snapshotted
+            "sessions": sessions if hasattr(sessions, "meta") else dict(sessions)
+        }
+        self._set_status(job["key"], state="pending")
+        self._queue.put(job)
+    
+    def status(self, credentials_info: Dict, folder_id: Optional[str]) -> Dict:
+        """Latest sync status for an account: state, last_sync, error, attempts"""
+        with self._lock:
+            return dict(self._status.get(self._key(credentials_info, folder_id), {}))
+    
+    def _set_status(self, key: tuple, **fields):
+        with self._lock:
+            self._status.setdefault(key, {"state": "idle", "last_sync": None, "error": None, "attempts": 0})
+            self._status[key].update(fields)
+    
+    def _run(self):
+        pending: Dict[tuple, Dict] = {}
+        while True:
+            job = self._queue.get()
+            pending[job["key"]] = job
+            
+            # Coalesce everything queued within the debounce window
+            deadline = time.monotonic() + DRIVE_SYNC_DEBOUNCE_SECONDS
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    job = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                pending[job["key"]] = job
+            
+            while pending:
+                _, job = pending.popitem()
+                self._upload_with_retry(job, pending)
+    
+    def _upload_with_retry(self, job: Dict, pending: Dict):
+        attempt = 0
+        while True:
+            attempt += 1
+            self._set_status(job["key"], state="syncing", attempts=attempt)
+            try:
+                drive_manager = GoogleDriveManager(self._client_pool)
+                drive_manager.initialize_from_credentials(job["credentials"], job["folder_id"])
+                if DRIVE_SYNC_MODE == "delta":
+                    drive_manager.upload_sessions_delta(job["sessions"], self._manifest_cache)
+                else:
+                    # Full snapshots include archived sessions so the backup covers all history
+                    sessions = job["sessions"]
+                    drive_manager._upload_file(
+                        sessions.snapshot() if hasattr(sessions, "snapshot") else dict(sessions),
+                        "chat_sessions_latest.json"
+                    )
+                self._set_status(
+                    job["key"], state="ok", error=None,
+                    last_sync=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                )
+                return
+            except Exception as e:
+                if attempt >= DRIVE_SYNC_MAX_RETRIES:
+                    self._set_status(job["key"], state="failed", error=str(e))
+                    return
+                self._set_status(job["key"], state="retrying", error=str(e))
+                delay = min(DRIVE_SYNC_BACKOFF_MAX, DRIVE_SYNC_BACKOFF_BASE ** attempt) * random.uniform(0.5, 1.0)
+            
+            # Keep collecting saves while backing off; newer data for this account wins
+            deadline = time.monotonic() + delay
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    newer = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if newer["key"] == job["key"]:
+                    job = newer
+                else:
+                    pending[newer["key"]] = newer
+
+@st.cache_resource
+def get_drive_sync_worker() -> DriveSyncWorker:
+    return DriveSyncWorker(get_drive_client_pool())
 
 # ----------------------------
-# Utility Functions
+# Message Model
 # ----------------------------
-def strip_html_tags(text):
-    """Remove HTML tags from text"""
-    clean = re.compile('<.*?>')
-    return re.sub(clean, '', text)
+# Streamlit re-executes this file on every rerun, redefining these classes,
+# while cached resources and session state keep instances of older runs.
+# Checks below therefore go by shape (Mapping, Sequence, attributes), not class.
+_EPOCH = datetime(1970, 1, 1)
 
-def extract_plain_text(response_text):
-    """Extract plain text message from AI response"""
+def _compact_timestamp(timestamp):
+    """ISO timestamp as integer microseconds since 1970; kept as given if that would not round-trip"""
+    if not isinstance(timestamp, str):
+        return timestamp
     try:
-        data = json.loads(response_text)
-        if isinstance(data, list):
-            for entry in data:
-                if isinstance(entry, dict) and "messages" in entry:
-                    msg_dict = entry["messages"]
-                    for key in ("ai", "assistant", "response", "message", "content", "text"):
-                        if key in msg_dict:
-                            return strip_html_tags(str(msg_dict[key]))
-        elif isinstance(data, dict):
-            for key in ("response", "message", "text", "content", "answer", "reply", "output"):
-                if key in data:
-                    content = data[key]
-                    if isinstance(content, str):
-                        return strip_html_tags(content)
-                    elif isinstance(content, dict):
-                        for nested_key in ("text", "content", "message"):
-                            if nested_key in content:
-                                return strip_html_tags(str(content[nested_key]))
-    except (json.JSONDecodeError, TypeError, KeyError):
-        pass
+        moment = datetime.fromisoformat(timestamp)
+    except ValueError:
+        return timestamp
+    if moment.tzinfo is not None:
+        return timestamp
+    delta = moment - _EPOCH
+    epoch_us = (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+    return epoch_us if _iso_timestamp(epoch_us) == timestamp else timestamp
+
+def _iso_timestamp(epoch_us: int) -> str:
+    return (_EPOCH + timedelta(microseconds=epoch_us)).isoformat()
+
+class Message(MutableMapping):
+    """Compact chat message that behaves like the ``{"role", "content", "timestamp"}`` dict.
+
+    Uses ``__slots__``, an interned role and an integer timestamp; any other
+    keys live in ``extra``. ``to_dict`` returns the JSON shape.
+    """
+
+    __slots__ = ("role", "content", "ts", "extra")
+    FIELDS = ("role", "content", "timestamp")
+
+    def __init__(self, role: str, content, timestamp=None, extra: Optional[Dict] = None):
+        self.role = sys.intern(role) if isinstance(role, str) else role
+        self.content = content
+        self.ts = _compact_timestamp(timestamp)
+        self.extra = extra or None
+    
+    @classmethod
+    def from_dict(cls, message: Mapping) -> "Message":
+        if getattr(message, "__slots__", None) == Message.__slots__:
+            return message  # a Message, possibly from an earlier rerun
+        extra = {k: v for k, v in message.items() if k not in cls.FIELDS}
+        return cls(message.get("role"), message.get("content"), message.get("timestamp"), extra)
+    
+    def to_dict(self) -> Dict:
+        return dict(self)
+    
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        if key == "timestamp" and self.ts is not None:
+            return _iso_timestamp(self.ts) if isinstance(self.ts, int) else self.ts
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+    
+    def __setitem__(self, key, value):
+        if key == "role":
+            self.role = sys.intern(value) if isinstance(value, str) else value
+        elif key == "content":
+            self.content = value
+        elif key == "timestamp":
+            self.ts = _compact_timestamp(value)
+        else:
+            self.extra = {**(self.extra or {}), key: value}
+    
+    def __delitem__(self, key):
+        if key == "timestamp" and self.ts is not None:
+            self.ts = None
+        elif self.extra and key in self.extra:
+            self.extra = {k: v for k, v in self.extra.items() if k != key} or None
+        else:
+            raise KeyError(key)
+    
+    def __iter__(self):
+        yield "role"
+        yield "content"
+        if self.ts is not None:
+            yield "timestamp"
+        if self.extra:
+            yield from self.extra
     
-    return strip_html_tags(str(response_text))
+    def __len__(self) -> int:
+        return 2 + (self.ts is not None) + len(self.extra or ())
+    
+    def __repr__(self) -> str:
+        return f"Message({self.to_dict()!r})"
 
-def generate_session_id(user_info: Dict) -> str:
-    """Generate a unique session ID based on user info and timestamp"""
-    base_string = f"{user_info['name']}_{user_info['role']}_{user_info['team']}"
-    return hashlib.md5(base_string.encode()).hexdigest()[:12]
+class MessageLog(list):
+    """The current session's messages as ``Message`` records; appended dicts are converted.
 
-def save_chat_sessions(sessions: Dict, auto_upload: bool = True):
-    """Save chat sessions to file and optionally upload to Drive"""
-    try:
-        # Save locally
-        with open(CHAT_HISTORY_FILE, 'wb') as f:
-            pickle.dump(sessions, f)
-        
-        # Save as JSON for Drive compatibility
-        with open(CHAT_HISTORY_JSON, 'w') as f:
-            json.dump(sessions, f, indent=2, default=str)
-        
-        # Auto-upload to Drive if enabled and authenticated
-        if auto_upload and st.session_state.get('drive_enabled', False):
-            drive_manager = get_drive_manager()
-            if drive_manager.initialize_from_session():
-                drive_manager.upload_sessions(sessions, "chat_sessions_latest.json")
-                
-    except Exception as e:
-        st.error(f"Error saving chat sessions: {e}")
+    ``view()`` snapshots the current length without copying, so saving a
+    session shares the records instead of duplicating the list.
+    """
 
-def load_chat_sessions() -> Dict:
-    """Load chat sessions from file"""
-    try:
-        if os.path.exists(CHAT_HISTORY_FILE):
-            with open(CHAT_HISTORY_FILE, 'rb') as f:
-                return pickle.load(f)
-    except Exception as e:
-        st.error(f"Error loading chat sessions: {e}")
-    return {}
+    __slots__ = ()
 
-def format_timestamp(timestamp: str) -> str:
-    """Format timestamp for display"""
+    def __init__(self, messages=()):
+        super().__init__(Message.from_dict(message) for message in messages)
+    
+    def append(self, message: Mapping):
+        super().append(Message.from_dict(message))
+    
+    def extend(self, messages):
+        super().extend(Message.from_dict(message) for message in messages)
+    
+    def view(self) -> "MessageView":
+        return MessageView(self, len(self))
+
+class MessageView(Sequence):
+    """Read-only prefix of a ``MessageLog``; later appends to the log are not visible"""
+
+    __slots__ = ("log", "length")
+
+    def __init__(self, log: MessageLog, length: int):
+        self.log = log
+        self.length = length
+    
+    def __len__(self) -> int:
+        return self.length
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.log[i] for i in range(self.length)[index]]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("message index out of range")
+        return self.log[index]
+    
+    def __iter__(self):
+        for index in range(self.length):
+            yield self.log[index]
+    
+    def covers_log(self) -> bool:
+        """True when the view still spans the whole log, so the log can be reused as is"""
+        return self.length == len(self.log)
+
+def _json_default(obj):
+    """``json.dumps`` hook that writes compact messages and message views in their plain shape"""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, Sequence) and not isinstance(obj, (str, bytes)):
+        return list(obj)
+    return str(obj)
+
+@st.cache_resource
+def get_shared_user_info() -> Dict[str, Dict]:
+    """Process-wide ``user_info`` intern table; a module global would be reset by every rerun"""
+    return {}
+
+def share_user_info(user_info: Dict) -> Dict:
+    """Return one shared dict per distinct ``user_info``; callers must not mutate it"""
+    key = json.dumps(user_info, sort_keys=True, default=_json_default)
+    return get_shared_user_info().setdefault(key, dict(user_info))
+
+def compact_session(session_data: Dict) -> Dict:
+    """Session with its messages as a ``MessageView`` and a shared ``user_info``"""
+    compact = dict(session_data)
+    messages = compact.get("messages", [])
+    if not hasattr(messages, "covers_log"):  # not a MessageView
+        compact["messages"] = MessageLog(messages).view()
+    if isinstance(compact.get("user_info"), dict):
+        compact["user_info"] = share_user_info(compact["user_info"])
+    return compact
+
+# ----------------------------
+# Session Storage
+# ----------------------------
+def _message_fingerprint(message: Dict) -> str:
+    """Short stable hash of a single message, used to detect rewritten history"""
+    return hashlib.sha1(json.dumps(message, sort_keys=True, default=_json_default).encode()).hexdigest()[:16]
+
+def _patch_outbox_message(messages: List[Dict], outbox_id: int, content: str) -> Optional[int]:
+    """Put ``content`` in place of the placeholder carrying ``outbox_id``; returns its index"""
+    for index, message in enumerate(messages):
+        if message.get("outbox_id") == outbox_id:
+            message["content"] = content
+            del message["outbox_id"]
+            return index
+    return None
+
+def _load_legacy_sessions() -> Dict:
+    """Read the old whole-history chat_sessions.pkl (or .json) file, if any"""
+    try:
+        if os.path.exists(CHAT_HISTORY_FILE):
+            with open(CHAT_HISTORY_FILE, 'rb') as f:
+                return pickle.load(f)
+        if os.path.exists(CHAT_HISTORY_JSON):
+            with open(CHAT_HISTORY_JSON, 'r') as f:
+                return json.load(f)
+    except Exception:
+        pass
+    return {}
+
+class SessionIndex:
+    """In-memory index of session metadata ordered by ``last_activity``.
+
+    Keeps ``(last_activity, session_id)`` keys in a sorted list plus running
+    session and message totals, so the recent-sessions list is O(k) and the
+    totals are O(1). The stores update it on every save and delete.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._order: List[tuple] = []
+        self._entries: Dict[str, tuple] = {}  # session_id -> (sort key, metadata, message count)
+        self._message_total = 0
+    
+    @staticmethod
+    def _key(session_id: str, meta: Dict) -> tuple:
+        return str(meta.get("last_activity", "")), session_id
+    
+    def rebuild(self, entries):
+        """Replace the index from ``(session_id, metadata, message_count)`` triples"""
+        with self._lock:
+            self._entries = {
+                session_id: (self._key(session_id, meta), meta, message_count)
+                for session_id, meta, message_count in entries
+            }
+            self._order = sorted(entry[0] for entry in self._entries.values())
+            self._message_total = sum(entry[2] for entry in self._entries.values())
+    
+    def _discard(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return
+        key, _, message_count = entry
+        del self._order[bisect_left(self._order, key)]
+        self._message_total -= message_count
+    
+    def update(self, session_id: str, meta: Dict, message_count: int):
+        """Insert or move a session after it was saved"""
+        key = self._key(session_id, meta)
+        with self._lock:
+            self._discard(session_id)
+            insort(self._order, key)
+            self._entries[session_id] = (key, meta, message_count)
+            self._message_total += message_count
+    
+    def remove(self, session_id: str):
+        with self._lock:
+            self._discard(session_id)
+    
+    def get(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            return dict(entry[1]) if entry else None
+    
+    def ids(self) -> List[str]:
+        with self._lock:
+            return list(self._entries)
+    
+    def oldest(self, limit: int) -> List[str]:
+        """Return up to ``limit`` session IDs, least recent activity first"""
+        with self._lock:
+            return [session_id for _, session_id in self._order[:max(limit, 0)]]
+    
+    def recent(self, limit: int = 10) -> List[tuple]:
+        """Return ``(session_id, metadata)`` pairs, most recent activity first"""
+        if limit <= 0:
+            return []
+        with self._lock:
+            keys = self._order[:-limit - 1:-1]
+            return [(session_id, dict(self._entries[session_id][1])) for _, session_id in keys]
+    
+    def totals(self) -> tuple:
+        """Return ``(session_count, message_count)``"""
+        with self._lock:
+            return len(self._entries), self._message_total
+
+class SessionLogStore:
+    """Append-only session storage.
+
+    Every session gets its own JSONL log under ``root`` holding one message per
+    line, and a small ``index.jsonl`` journal records the latest metadata for
+    each session. Saving a session appends only the messages that are not on
+    disk yet plus one journal line, so the cost of a save does not depend on
+    how many sessions exist. The journal is compacted on a background thread
+    once it holds mostly superseded records.
+    """
+
+    INDEX_FILE = "index.jsonl"
+
+    def __init__(self, root: str = CHAT_LOG_DIR):
+        self.root = root
+        self.index_path = os.path.join(root, self.INDEX_FILE)
+        self._lock = threading.RLock()
+        self._records: Dict[str, Dict] = {}  # session_id -> latest journal record
+        self._journal_lines = 0
+        self._compacting = False
+        self._index = SessionIndex()
+        os.makedirs(root, exist_ok=True)
+        
+        if os.path.exists(self.index_path):
+            self._load_index()
+        else:
+            self._migrate_legacy_files()
+    
+    # -- file helpers --------------------------------------------------------
+    def _log_path(self, session_id: str) -> str:
+        return os.path.join(self.root, f"{session_id}.jsonl")
+    
+    @staticmethod
+    def _append(path: str, lines: List[Dict]):
+        """Append JSON lines with a single O_APPEND write followed by fsync"""
+        data = "".join(json.dumps(line, default=_json_default) + "\n" for line in lines).encode()
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    
+    @staticmethod
+    def _write_atomic(path: str, lines: List[Dict]):
+        """Replace a file with the given JSON lines via fsync + rename"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for line in lines:
+                f.write(json.dumps(line, default=_json_default) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    @staticmethod
+    def _read_lines(path: str) -> List[Dict]:
+        """Read JSON lines, skipping a torn trailing line left by a crash"""
+        lines = []
+        if not os.path.exists(path):
+            return lines
+        with open(path, 'r') as f:
+            for raw in f:
+                try:
+                    lines.append(json.loads(raw))
+                except json.JSONDecodeError:
+                    continue
+        return lines
+    
+    # -- index journal -------------------------------------------------------
+    def _load_index(self):
+        for record in self._read_lines(self.index_path):
+            self._journal_lines += 1
+            if record.get("deleted"):
+                self._records.pop(record["id"], None)
+            else:
+                self._records[record["id"]] = record
+        self._index.rebuild((r["id"], r["meta"], r["count"]) for r in self._records.values())
+    
+    def _migrate_legacy_files(self):
+        """One-time import of the old whole-history pickle/JSON files"""
+        sessions = _load_legacy_sessions()
+        
+        # Create the journal even when there is nothing to import so this only runs once
+        self._append(self.index_path, [])
+        for session_id, session_data in sessions.items():
+            self.save_session(session_id, session_data)
+    
+    def _journal(self, record: Dict):
+        self._append(self.index_path, [record])
+        self._journal_lines += 1
+        if (self._journal_lines > max(LOG_COMPACT_MIN_RECORDS, 2 * len(self._records))
+                and not self._compacting):
+            self._compacting = True
+            threading.Thread(target=self._compact_index, daemon=True).start()
+    
+    def _compact_index(self):
+        """Rewrite the journal with one record per live session"""
+        try:
+            with self._lock:
+                snapshot = list(self._records.values())
+                offset = os.path.getsize(self.index_path)
+            
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                for record in snapshot:
+                    f.write(json.dumps(record, default=_json_default) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            
+            with self._lock:
+                # Carry over anything journaled while the snapshot was being written
+                with open(self.index_path, 'rb') as src:
+                    src.seek(offset)
+                    tail = src.read()
+                with open(tmp_path, 'ab') as f:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.index_path)
+                self._journal_lines = len(snapshot) + tail.count(b"\n")
+        except Exception:
+            pass
+        finally:
+            self._compacting = False
+    
+    # -- public API ----------------------------------------------------------
+    def save_session(self, session_id: str, session_data: Dict, rewrite: bool = False):
+        """Persist a session, appending only messages that are not on disk yet.
+
+        Edits to the last stored message are detected automatically; callers
+        that change older messages in place pass ``rewrite=True``.
+        """
+        messages = session_data.get("messages", [])
+        meta = {k: v for k, v in session_data.items() if k != "messages"}
+        
+        with self._lock:
+            previous = self._records.get(session_id)
+            count = previous["count"] if previous else 0
+            log_path = self._log_path(session_id)
+            
+            if (rewrite or count == 0 or len(messages) < count
+                    or _message_fingerprint(messages[count - 1]) != previous["tail"]):
+                # New session or rewritten history: replace just this session's log
+                if messages or os.path.exists(log_path):
+                    self._write_atomic(log_path, messages)
+            elif len(messages) > count:
+                self._append(log_path, messages[count:])
+            
+            record = {
+                "id": session_id,
+                "meta": json.loads(json.dumps(meta, default=_json_default)),
+                "count": len(messages),
+                "tail": _message_fingerprint(messages[-1]) if messages else None
+            }
+            if record != previous:
+                self._records[session_id] = record
+                self._journal(record)
+                self._index.update(session_id, record["meta"], record["count"])
+    
+    def patch_message(self, session_id: str, outbox_id: int, content: str) -> bool:
+        """Replace the placeholder carrying ``outbox_id`` in place; False if it isn't stored.
+
+        Runs under the store lock, so a save of the same session can't slip in
+        between reading the log and writing it back.
+        """
+        with self._lock:
+            session_data = self.get_session(session_id)
+            if session_data is None:
+                return False
+            messages = session_data["messages"]
+            if _patch_outbox_message(messages, outbox_id, content) is None:
+                return False
+            # A newer version makes the delta Drive sync upload the patched session
+            session_data["last_activity"] = datetime.now().isoformat()
+            self.save_session(session_id, session_data, rewrite=True)
+            return True
+    
+    def delete_session(self, session_id: str):
+        """Remove a session and its message log"""
+        with self._lock:
+            if self._records.pop(session_id, None) is None:
+                return
+            self._journal({"id": session_id, "deleted": True})
+            self._index.remove(session_id)
+            try:
+                os.remove(self._log_path(session_id))
+            except FileNotFoundError:
+                pass
+    
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        """Load one session with its messages"""
+        with self._lock:
+            record = self._records.get(session_id)
+            if not record:
+                return None
+            messages = self._read_lines(self._log_path(session_id))
+            if len(messages) != record["count"]:
+                # Log and journal disagree after a crash; force a rewrite on the next save
+                messages = messages[:record["count"]]
+                record["count"] = 0
+            session_data = dict(record["meta"])
+            session_data["messages"] = messages
+            return session_data
+    
+    def iter_sessions(self):
+        """Yield ``(session_id, session_data)`` one session at a time"""
+        with self._lock:
+            session_ids = list(self._records)
+        for session_id in session_ids:
+            session_data = self.get_session(session_id)
+            if session_data is not None:
+                yield session_id, session_data
+    
+    def load_all(self) -> Dict:
+        """Load every session with its messages"""
+        return dict(self.iter_sessions())
+    
+    def session_meta(self, session_id: str) -> Optional[Dict]:
+        """Metadata of one session without loading its messages"""
+        return self._index.get(session_id)
+    
+    def session_ids(self) -> List[str]:
+        return self._index.ids()
+    
+    def oldest_sessions(self, limit: int) -> List[str]:
+        return self._index.oldest(limit)
+    
+    def recent_sessions(self, limit: int = 10) -> List[tuple]:
+        """Return ``(session_id, metadata)`` pairs, most recent activity first"""
+        return self._index.recent(limit)
+    
+    def totals(self) -> tuple:
+        """Return ``(session_count, message_count)`` across all sessions"""
+        return self._index.totals()
+
+class SQLiteSessionStore:
+    """Session storage in SQLite (WAL mode) with one row per message.
+
+    Session metadata lives in its own table indexed on ``last_activity`` and
+    is mirrored in a ``SessionIndex`` for the sidebar list and stats totals.
+    Saves insert only messages that are not stored yet.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            session_name TEXT,
+            created_at TEXT,
+            last_activity TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            tail TEXT,
+            meta TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_last_activity ON sessions (last_activity DESC);
+        CREATE TABLE IF NOT EXISTS messages (
+            session_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT,
+            content TEXT,
+            timestamp TEXT,
+            extra TEXT,
+            PRIMARY KEY (session_id, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS store_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path: str = CHAT_DB_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._index = SessionIndex()
+        self._migrate_legacy_files()
+        with self._lock:
+            rows = self._conn.execute("SELECT session_id, meta, message_count FROM sessions").fetchall()
+        self._index.rebuild((session_id, json.loads(meta), count) for session_id, meta, count in rows)
+    
+    def _migrate_legacy_files(self):
+        """One-shot import of chat_sessions.pkl/json (or an existing session log)"""
+        with self._lock:
+            done = self._conn.execute("SELECT value FROM store_meta WHERE key = 'migrated'").fetchone()
+            if done:
+                return
+            
+            if os.path.exists(os.path.join(CHAT_LOG_DIR, SessionLogStore.INDEX_FILE)):
+                sessions = SessionLogStore(CHAT_LOG_DIR).load_all()
+            else:
+                sessions = _load_legacy_sessions()
+            
+            for session_id, session_data in sessions.items():
+                self.save_session(session_id, session_data)
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO store_meta (key, value) VALUES ('migrated', ?)",
+                    (datetime.now().isoformat(),)
+                )
+    
+    @staticmethod
+    def _message_row(session_id: str, seq: int, message: Dict) -> tuple:
+        extra = {k: v for k, v in message.items() if k not in ("role", "content", "timestamp")}
+        return (
+            session_id, seq, message.get("role"), message.get("content"), message.get("timestamp"),
+            json.dumps(extra, default=_json_default) if extra else None
+        )
+    
+    @staticmethod
+    def _row_message(row: tuple) -> Dict:
+        role, content, timestamp, extra = row
+        message = {"role": role, "content": content}
+        if timestamp is not None:
+            message["timestamp"] = timestamp
+        if extra:
+            message.update(json.loads(extra))
+        return message
+    
+    def save_session(self, session_id: str, session_data: Dict, rewrite: bool = False):
+        """Persist a session, inserting only messages that are not stored yet"""
+        messages = session_data.get("messages", [])
+        meta = {k: v for k, v in session_data.items() if k != "messages"}
+        
+        meta_json = json.dumps(meta, default=_json_default)
+        with self._lock:
+            with self._conn:
+                row = self._conn.execute(
+                    "SELECT message_count, tail FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                count, tail = row if row else (0, None)
+                
+                if (rewrite or len(messages) < count
+                        or (count and _message_fingerprint(messages[count - 1]) != tail)):
+                    self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                    count = 0
+                if len(messages) > count:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO messages (session_id, seq, role, content, timestamp, extra) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [self._message_row(session_id, seq, messages[seq]) for seq in range(count, len(messages))]
+                    )
+                
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sessions "
+                    "(session_id, session_name, created_at, last_activity, message_count, tail, meta) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        session_id, meta.get("session_name"), str(meta.get("created_at", "")),
+                        str(meta.get("last_activity", "")), len(messages),
+                        _message_fingerprint(messages[-1]) if messages else None,
+                        meta_json
+                    )
+                )
+            self._index.update(session_id, json.loads(meta_json), len(messages))
+    
+    def patch_message(self, session_id: str, outbox_id: int, content: str) -> bool:
+        """Replace the placeholder carrying ``outbox_id`` with one UPDATE; False if it isn't stored"""
+        with self._lock:
+            with self._conn:
+                row = self._conn.execute(
+                    "SELECT seq, role, timestamp, extra FROM messages "
+                    "WHERE session_id = ? AND json_extract(extra, '$.outbox_id') = ?",
+                    (session_id, outbox_id)
+                ).fetchone()
+                session = self._conn.execute(
+                    "SELECT message_count, meta FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                if row is None or session is None:
+                    return False
+                seq, role, timestamp, extra = row
+                message = self._row_message((role, content, timestamp, extra))
+                del message["outbox_id"]
+                _, _, _, _, _, extra = self._message_row(session_id, seq, message)
+                self._conn.execute(
+                    "UPDATE messages SET content = ?, extra = ? WHERE session_id = ? AND seq = ?",
+                    (content, extra, session_id, seq)
+                )
+                
+                # A newer version makes the delta Drive sync upload the patched session
+                count, meta_json = session
+                meta = json.loads(meta_json)
+                meta["last_activity"] = datetime.now().isoformat()
+                meta_json = json.dumps(meta, default=_json_default)
+                self._conn.execute(
+                    "UPDATE sessions SET last_activity = ?, meta = ?, "
+                    "tail = CASE WHEN ? THEN ? ELSE tail END WHERE session_id = ?",
+                    (meta["last_activity"], meta_json, seq == count - 1, _message_fingerprint(message), session_id)
+                )
+            self._index.update(session_id, meta, count)
+            return True
+    
+    def delete_session(self, session_id: str):
+        """Remove a session and its messages"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._index.remove(session_id)
+    
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        """Load one session with its messages"""
+        with self._lock:
+            row = self._conn.execute("SELECT meta FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if not row:
+                return None
+            rows = self._conn.execute(
+                "SELECT role, content, timestamp, extra FROM messages WHERE session_id = ? ORDER BY seq",
+                (session_id,)
+            ).fetchall()
+        session_data = json.loads(row[0])
+        session_data["messages"] = [self._row_message(r) for r in rows]
+        return session_data
+    
+    def iter_sessions(self):
+        """Yield ``(session_id, session_data)`` one session at a time"""
+        with self._lock:
+            session_ids = [r[0] for r in self._conn.execute("SELECT session_id FROM sessions")]
+        for session_id in session_ids:
+            session_data = self.get_session(session_id)
+            if session_data is not None:
+                yield session_id, session_data
+    
+    def load_all(self) -> Dict:
+        """Load every session with its messages"""
+        return dict(self.iter_sessions())
+    
+    def session_meta(self, session_id: str) -> Optional[Dict]:
+        """Metadata of one session without loading its messages"""
+        return self._index.get(session_id)
+    
+    def session_ids(self) -> List[str]:
+        return self._index.ids()
+    
+    def oldest_sessions(self, limit: int) -> List[str]:
+        return self._index.oldest(limit)
+    
+    def recent_sessions(self, limit: int = 10) -> List[tuple]:
+        """Return ``(session_id, metadata)`` pairs, most recent activity first"""
+        return self._index.recent(limit)
+    
+    def totals(self) -> tuple:
+        """Return ``(session_count, message_count)`` across all sessions"""
+        return self._index.totals()
+
+class ShardedSessionStore:
+    """Base for stores that keep each session in its own shard.
+
+    The shard key is the session ID itself, so writers to different sessions
+    never contend, even for users who share a name, role and team (every
+    default Guest, for one). Backends provide an atomic read-modify-write of
+    a shard, which keeps concurrent writers to the same session from losing
+    each other's updates. The in-memory ``SessionIndex`` is updated from every
+    shard this process writes and refreshed from shards changed elsewhere at
+    most every ``SHARD_REFRESH_SECONDS``.
+    """
+
+    def __init__(self):
+        self._index = SessionIndex()
+        self._lock = threading.Lock()
+        self._shard_sessions: Dict[str, set] = {}
+        self._shard_versions: Dict[str, object] = {}
+        self._refreshed_at = 0.0
+    
+    @staticmethod
+    def shard_of(session_id: str) -> str:
+        return re.sub(r'[^A-Za-z0-9_-]', '_', session_id) or "_"
+    
+    # -- backend hooks -------------------------------------------------------
+    def _shard_names(self) -> List[str]:
+        raise NotImplementedError
+    
+    def _shard_version(self, shard: str):
+        """Cheap token that changes whenever the shard is rewritten"""
+        raise NotImplementedError
+    
+    def _read_shard(self, shard: str) -> Dict:
+        raise NotImplementedError
+    
+    def _update_shard(self, shard: str, mutate) -> tuple:
+        """Atomically apply ``mutate(sessions)`` to a shard; returns ``(sessions, version)``"""
+        raise NotImplementedError
+    
+    def _claim_migration(self) -> bool:
+        """True for exactly one opener of an empty store"""
+        raise NotImplementedError
+    
+    # -- index ---------------------------------------------------------------
+    def _open(self):
+        if self._claim_migration():
+            for session_id, session_data in _load_legacy_sessions().items():
+                self.save_session(session_id, session_data)
+        self._split_shared_shards()
+        
+        entries = []
+        with self._lock:
+            for shard in self._shard_names():
+                version = self._shard_version(shard)
+                sessions = self._read_shard(shard)
+                self._shard_sessions[shard] = set(sessions)
+                self._shard_versions[shard] = version
+                entries.extend(
+                    (session_id, self._meta(session_data), len(session_data.get("messages", [])))
+                    for session_id, session_data in sessions.items()
+                )
+            self._index.rebuild(entries)
+            self._refreshed_at = time.time()
+    
+    def _split_shared_shards(self):
+        """Move sessions out of the per-user shards earlier versions wrote"""
+        for shard in self._shard_names():
+            for session_id, session_data in self._read_shard(shard).items():
+                if self.shard_of(session_id) == shard:
+                    continue
+                # A newer copy already written to the session's own shard wins
+                self._update_shard(
+                    self.shard_of(session_id),
+                    lambda sessions: sessions.setdefault(session_id, session_data)
+                )
+                self._update_shard(shard, lambda sessions: sessions.pop(session_id, None))
+    
+    @staticmethod
+    def _meta(session_data: Dict) -> Dict:
+        return {k: v for k, v in session_data.items() if k != "messages"}
+    
+    def _index_shard(self, shard: str, sessions: Dict, version):
+        with self._lock:
+            for session_id in self._shard_sessions.get(shard, set()) - sessions.keys():
+                self._index.remove(session_id)
+            for session_id, session_data in sessions.items():
+                self._index.update(session_id, self._meta(session_data), len(session_data.get("messages", [])))
+            self._shard_sessions[shard] = set(sessions)
+            self._shard_versions[shard] = version
+    
+    def _refresh(self):
+        """Re-read shards other processes changed since the last look"""
+        if time.time() - self._refreshed_at < SHARD_REFRESH_SECONDS:
+            return
+        self._refreshed_at = time.time()
+        
+        shards = set(self._shard_names())
+        for shard in shards | set(self._shard_sessions):
+            version = self._shard_version(shard) if shard in shards else None
+            if version != self._shard_versions.get(shard):
+                self._index_shard(shard, self._read_shard(shard) if shard in shards else {}, version)
+    
+    # -- public API ----------------------------------------------------------
+    def save_session(self, session_id: str, session_data: Dict, rewrite: bool = False):
+        """Write a session into its shard (always a full rewrite of the session)"""
+        session_data = json.loads(json.dumps(session_data, default=_json_default))
+        
+        def mutate(sessions):
+            sessions[session_id] = session_data
+        
+        shard = self.shard_of(session_id)
+        self._index_shard(shard, *self._update_shard(shard, mutate))
+    
+    def patch_message(self, session_id: str, outbox_id: int, content: str) -> bool:
+        """Replace the placeholder carrying ``outbox_id`` in one atomic shard update"""
+        patched = []
+        
+        def mutate(sessions):
+            patched.clear()
+            session_data = sessions.get(session_id)
+            if session_data and _patch_outbox_message(session_data.get("messages", []), outbox_id, content) is not None:
+                # A newer version makes the delta Drive sync upload the patched session
+                session_data["last_activity"] = datetime.now().isoformat()
+                patched.append(session_id)
+        
+        shard = self.shard_of(session_id)
+        self._index_shard(shard, *self._update_shard(shard, mutate))
+        return bool(patched)
+    
+    def delete_session(self, session_id: str):
+        def mutate(sessions):
+            sessions.pop(session_id, None)
+        
+        shard = self.shard_of(session_id)
+        self._index_shard(shard, *self._update_shard(shard, mutate))
+    
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        """Load one session with its messages"""
+        return self._read_shard(self.shard_of(session_id)).get(session_id)
+    
+    def iter_sessions(self):
+        """Yield ``(session_id, session_data)`` one shard at a time"""
+        for shard in self._shard_names():
+            yield from self._read_shard(shard).items()
+    
+    def load_all(self) -> Dict:
+        """Load every session with its messages"""
+        return dict(self.iter_sessions())
+    
+    def session_meta(self, session_id: str) -> Optional[Dict]:
+        """Metadata of one session without loading its messages"""
+        self._refresh()
+        return self._index.get(session_id)
+    
+    def session_ids(self) -> List[str]:
+        self._refresh()
+        return self._index.ids()
+    
+    def oldest_sessions(self, limit: int) -> List[str]:
+        self._refresh()
+        return self._index.oldest(limit)
+    
+    def recent_sessions(self, limit: int = 10) -> List[tuple]:
+        """Return ``(session_id, metadata)`` pairs, most recent activity first"""
+        self._refresh()
+        return self._index.recent(limit)
+    
+    def totals(self) -> tuple:
+        """Return ``(session_count, message_count)`` across all sessions"""
+        self._refresh()
+        return self._index.totals()
+
+class ShardedFileStore(ShardedSessionStore):
+    """One JSON file per session shard, written under a lock via atomic rename.
+
+    Writers take an exclusive ``flock`` on the shard's ``.lock`` file (plus a
+    process-local lock), read the shard, apply their change and replace the
+    file with ``os.replace``, so readers never see a torn file and concurrent
+    processes sharing the directory never lose updates.
+    """
+
+    def __init__(self, root: str = CHAT_SHARD_DIR):
+        super().__init__()
+        self.root = root
+        self._shard_locks: Dict[str, threading.Lock] = {}
+        self._open()
+    
+    def _shard_path(self, shard: str) -> str:
+        return os.path.join(self.root, shard[:2], f"{shard}.json")
+    
+    def _shard_lock(self, shard: str) -> threading.Lock:
+        with self._lock:
+            return self._shard_locks.setdefault(shard, threading.Lock())
+    
+    def _claim_migration(self) -> bool:
+        os.makedirs(os.path.dirname(os.path.abspath(self.root)), exist_ok=True)
+        try:
+            os.mkdir(self.root)
+        except FileExistsError:
+            return False
+        return True
+    
+    def _shard_names(self) -> List[str]:
+        names = []
+        for bucket in os.listdir(self.root):
+            bucket_path = os.path.join(self.root, bucket)
+            if os.path.isdir(bucket_path):
+                names.extend(name[:-len(".json")] for name in os.listdir(bucket_path) if name.endswith(".json"))
+        return names
+    
+    def _shard_version(self, shard: str):
+        try:
+            stat = os.stat(self._shard_path(shard))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+    
+    def _read_shard(self, shard: str) -> Dict:
+        try:
+            with open(self._shard_path(shard), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+    
+    def _update_shard(self, shard: str, mutate) -> tuple:
+        path = self._shard_path(shard)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        with self._shard_lock(shard), open(f"{path}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            sessions = self._read_shard(shard)
+            mutate(sessions)
+            if sessions:
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(sessions, f, default=_json_default)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            elif os.path.exists(path):
+                os.remove(path)
+            return sessions, self._shard_version(shard)
+
+class InMemoryKVClient:
+    """In-process stand-in for a network key-value store, for tests and benchmarks; nothing is persisted"""
+
+    def __init__(self):
+        self._data: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._data.get(key)
+    
+    def set(self, key: str, value: bytes):
+        with self._lock:
+            self._data[key] = value
+    
+    def compare_and_set(self, key: str, expected: Optional[bytes], value: Optional[bytes]) -> bool:
+        """Write ``value`` (or delete on None) only if the key still holds ``expected``"""
+        with self._lock:
+            if self._data.get(key) != expected:
+                return False
+            if value is None:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = value
+            return True
+    
+    def keys(self, prefix: str) -> List[str]:
+        with self._lock:
+            return [key for key in self._data if key.startswith(prefix)]
+
+class RedisKVClient:
+    """Redis implementation of the key-value client; needs the optional ``redis`` package"""
+
+    def __init__(self, url: str):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+    
+    def get(self, key: str) -> Optional[bytes]:
+        return self._redis.get(key)
+    
+    def set(self, key: str, value: bytes):
+        self._redis.set(key, value)
+    
+    def compare_and_set(self, key: str, expected: Optional[bytes], value: Optional[bytes]) -> bool:
+        with self._redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != expected:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                if value is None:
+                    pipe.delete(key)
+                else:
+                    pipe.set(key, value)
+                pipe.execute()
+                return True
+            except self._watch_error:
+                return False
+    
+    def keys(self, prefix: str) -> List[str]:
+        return [key.decode() for key in self._redis.scan_iter(match=f"{prefix}*")]
+
+class KeyValueSessionStore(ShardedSessionStore):
+    """Session shards stored as values in a network key-value store.
+
+    Each shard is written with an optimistic compare-and-set loop, so
+    concurrent writers on any replica retry instead of overwriting each
+    other. A small revision key per shard lets other replicas notice changes
+    without downloading the shard.
+    """
+
+    def __init__(self, client, prefix: str = "chat:"):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self._open()
+    
+    def _shard_key(self, shard: str) -> str:
+        return f"{self.prefix}shard:{shard}"
+    
+    def _rev_key(self, shard: str) -> str:
+        return f"{self.prefix}rev:{shard}"
+    
+    def _claim_migration(self) -> bool:
+        return self.client.compare_and_set(
+            f"{self.prefix}migrated", None, datetime.now().isoformat().encode()
+        )
+    
+    def _shard_names(self) -> List[str]:
+        offset = len(self._shard_key(""))
+        return [key[offset:] for key in self.client.keys(self._shard_key(""))]
+    
+    def _shard_version(self, shard: str):
+        return self.client.get(self._rev_key(shard))
+    
+    def _read_shard(self, shard: str) -> Dict:
+        raw = self.client.get(self._shard_key(shard))
+        return json.loads(raw) if raw else {}
+    
+    def _update_shard(self, shard: str, mutate) -> tuple:
+        key = self._shard_key(shard)
+        for attempt in range(KV_CAS_MAX_ATTEMPTS):
+            raw = self.client.get(key)
+            sessions = json.loads(raw) if raw else {}
+            mutate(sessions)
+            value = json.dumps(sessions, default=_json_default).encode() if sessions else None
+            if self.client.compare_and_set(key, raw, value):
+                version = os.urandom(8).hex().encode()
+                self.client.set(self._rev_key(shard), version)
+                return sessions, version
+            # Another writer got there first; back off briefly and re-apply on its result
+            time.sleep(random.uniform(0, 0.002 * (attempt + 1)))
+        raise RuntimeError(f"Could not update session shard {shard} after {KV_CAS_MAX_ATTEMPTS} attempts")
+
+@st.cache_resource
+def get_session_store():
+    if STORAGE_BACKEND == "log":
+        return SessionLogStore()
+    if STORAGE_BACKEND == "files":
+        return ShardedFileStore()
+    if STORAGE_BACKEND == "kv":
+        if not CHAT_KV_URL:
+            # An in-memory stand-in would lose every session on restart and re-import legacy files
+            raise RuntimeError("CHAT_STORAGE_BACKEND=kv needs CHAT_KV_URL, e.g. redis://host:6379/0")
+        return KeyValueSessionStore(RedisKVClient(CHAT_KV_URL))
+    return SQLiteSessionStore()
+
+class SessionArchive:
+    """Cold sessions stored as one gzip-compressed JSON file each.
+
+    Sessions beyond ``MAX_CHAT_HISTORY`` are moved here from the live store,
+    oldest activity first, and restored into the store when opened again.
+    """
+
+    def __init__(self, root: str = CHAT_ARCHIVE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._ids = {name[:-len(".json.gz")] for name in os.listdir(root) if name.endswith(".json.gz")}
+    
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.root, f"{session_id}.json.gz")
+    
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._ids
+    
+    def ids(self) -> List[str]:
+        with self._lock:
+            return list(self._ids)
+    
+    def put(self, session_id: str, session_data: Dict):
+        path = self._path(session_id)
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(session_data, f, default=_json_default)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._ids.add(session_id)
+    
+    def get(self, session_id: str) -> Optional[Dict]:
+        if session_id not in self._ids:
+            return None
+        try:
+            with gzip.open(self._path(session_id), 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+    
+    def discard(self, session_id: str):
+        """Drop the archived copy of a session that is live again"""
+        with self._lock:
+            if session_id not in self._ids:
+                return
+            self._ids.discard(session_id)
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+    
+    def restore(self, session_id: str, store) -> Optional[Dict]:
+        """Move an archived session back into the live store"""
+        session_data = self.get(session_id)
+        if session_data is not None:
+            store.save_session(session_id, session_data)
+            self.discard(session_id)
+        return session_data
+    
+    def enforce_retention(self, store, limit: int = MAX_CHAT_HISTORY) -> int:
+        """Archive the least recently active sessions beyond ``limit``; returns how many moved"""
+        excess = store.totals()[0] - limit
+        moved = 0
+        for session_id in store.oldest_sessions(excess):
+            session_data = store.get_session(session_id)
+            if session_data is not None:
+                self.put(session_id, session_data)
+            store.delete_session(session_id)
+            moved += 1
+        return moved
+
+@st.cache_resource
+def get_session_archive() -> SessionArchive:
+    return SessionArchive()
+
+class StoredSessions(Mapping):
+    """Read-only mapping over the session store; messages load on access.
+
+    Iteration and ``len`` come from the store's in-memory metadata index, so
+    walking the keys or checking membership never reads message bodies.
+    """
+
+    def __init__(self, store, archive: Optional[SessionArchive] = None):
+        self.store = store
+        self.archive = archive
+    
+    def _load(self, session_id: str) -> Optional[Dict]:
+        session_data = self.store.get_session(session_id)
+        if session_data is None and self.archive is not None:
+            session_data = self.archive.restore(session_id, self.store)
+        return session_data
+    
+    def __getitem__(self, session_id: str) -> Dict:
+        session_data = self._load(session_id)
+        if session_data is None:
+            raise KeyError(session_id)
+        return session_data
+    
+    def __iter__(self):
+        return iter(self.store.session_ids())
+    
+    def __len__(self) -> int:
+        return self.store.totals()[0]
+    
+    def __contains__(self, session_id) -> bool:
+        return self.store.session_meta(session_id) is not None
+    
+    def meta(self, session_id: str) -> Optional[Dict]:
+        """Session metadata without messages"""
+        return self.store.session_meta(session_id)
+    
+    def is_archived(self, session_id: str) -> bool:
+        return self.archive is not None and session_id in self.archive
+    
+    def snapshot(self) -> Dict:
+        """Live and archived sessions as a plain dict for full backups; archived ones stay archived"""
+        sessions = dict(self)
+        for session_id in (self.archive.ids() if self.archive is not None else []):
+            if session_id not in sessions and (session_data := self.archive.get(session_id)) is not None:
+                sessions[session_id] = session_data
+        return sessions
+
+class SessionCache(StoredSessions, MutableMapping):
+    """Per-user view of the session store keeping only hot sessions in memory.
+
+    Stored in ``st.session_state.chat_sessions``: metadata comes from the
+    shared store index, and at most ``capacity`` sessions keep their messages
+    resident in an LRU, so per-user memory does not grow with history.
+    Writes land in the LRU; callers persist them with ``save_chat_sessions``.
+    """
+
+    def __init__(self, store, archive: Optional[SessionArchive] = None, capacity: int = SESSION_CACHE_SIZE):
+        super().__init__(store, archive)
+        self.capacity = capacity
+        self._hot: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _remember(self, session_id: str, session_data: Dict):
+        with self._lock:
+            self._hot[session_id] = session_data
+            self._hot.move_to_end(session_id)
+            while len(self._hot) > self.capacity:
+                self._hot.popitem(last=False)
+    
+    def __getitem__(self, session_id: str) -> Dict:
+        with self._lock:
+            session_data = self._hot.get(session_id)
+            if session_data is not None:
+                self._hot.move_to_end(session_id)
+                return session_data
+        session_data = compact_session(super().__getitem__(session_id))
+        self._remember(session_id, session_data)
+        return session_data
+    
+    def __setitem__(self, session_id: str, session_data: Dict):
+        self._remember(session_id, session_data)
+    
+    def __delitem__(self, session_id: str):
+        with self._lock:
+            self._hot.pop(session_id, None)
+    
+    def __iter__(self):
+        with self._lock:
+            unsaved = [session_id for session_id in self._hot if self.store.session_meta(session_id) is None]
+        return iter(self.store.session_ids() + unsaved)
+    
+    def __len__(self) -> int:
+        with self._lock:
+            unsaved = sum(1 for session_id in self._hot if self.store.session_meta(session_id) is None)
+        return self.store.totals()[0] + unsaved
+    
+    def __contains__(self, session_id) -> bool:
+        return session_id in self._hot or super().__contains__(session_id)
+
+class SessionSearchIndex:
+    """Full-text index over message content backed by SQLite FTS5.
+
+    Each message is one FTS row; ``search_messages`` maps it back to its
+    session and position and ``search_sessions`` holds the per-session
+    role/team and the fingerprint of the last indexed message, so a save
+    indexes only messages added since the previous one. Results are ranked
+    with bm25 and can be filtered by role, team and date range.
+    """
+
+    SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(content, tokenize='porter unicode61');
+        CREATE TABLE IF NOT EXISTS search_messages (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT,
+            timestamp TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_search_messages_session ON search_messages (session_id);
+        CREATE TABLE IF NOT EXISTS search_sessions (
+            session_id TEXT PRIMARY KEY,
+            session_name TEXT,
+            user_role TEXT,
+            team TEXT,
+            last_activity TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            tail TEXT
+        );
+        CREATE TABLE IF NOT EXISTS search_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path: str = SEARCH_INDEX_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+    
+    def _drop_messages(self, session_id: str):
+        self._conn.execute(
+            "DELETE FROM search_fts WHERE rowid IN (SELECT id FROM search_messages WHERE session_id = ?)",
+            (session_id,)
+        )
+        self._conn.execute("DELETE FROM search_messages WHERE session_id = ?", (session_id,))
+    
+    def index_session(self, session_id: str, session_data: Dict):
+        """Index the messages of a session that are not indexed yet"""
+        messages = session_data.get("messages", [])
+        user_info = session_data.get("user_info") or {}
+        
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT message_count, tail FROM search_sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            count, tail = row if row else (0, None)
+            
+            if len(messages) < count or (count and _message_fingerprint(messages[count - 1]) != tail):
+                self._drop_messages(session_id)
+                count = 0
+            for seq in range(count, len(messages)):
+                message = messages[seq]
+                cursor = self._conn.execute(
+                    "INSERT INTO search_messages (session_id, seq, role, timestamp) VALUES (?, ?, ?, ?)",
+                    (session_id, seq, message.get("role"), message.get("timestamp"))
+                )
+                self._conn.execute(
+                    "INSERT INTO search_fts (rowid, content) VALUES (?, ?)",
+                    (cursor.lastrowid, str(message.get("content", "")))
+                )
+            
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_sessions "
+                "(session_id, session_name, user_role, team, last_activity, message_count, tail) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    session_id, session_data.get("session_name"), user_info.get("role"), user_info.get("team"),
+                    str(session_data.get("last_activity", "")), len(messages),
+                    _message_fingerprint(messages[-1]) if messages else None
+                )
+            )
+    
+    def remove_session(self, session_id: str):
+        with self._lock, self._conn:
+            self._drop_messages(session_id)
+            self._conn.execute("DELETE FROM search_sessions WHERE session_id = ?", (session_id,))
+    
+    def backfill(self, store):
+        """Index every stored session once, for histories saved before the index existed"""
+        with self._lock:
+            if self._conn.execute("SELECT value FROM search_meta WHERE key = 'backfilled'").fetchone():
+                return
+        for session_id, session_data in store.iter_sessions():
+            self.index_session(session_id, session_data)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_meta (key, value) VALUES ('backfilled', ?)",
+                (datetime.now().isoformat(),)
+            )
+    
+    def facets(self) -> tuple:
+        """Return the distinct ``(roles, teams)`` seen in indexed sessions"""
+        with self._lock:
+            roles = [r[0] for r in self._conn.execute(
+                "SELECT DISTINCT user_role FROM search_sessions WHERE user_role IS NOT NULL ORDER BY 1")]
+            teams = [r[0] for r in self._conn.execute(
+                "SELECT DISTINCT team FROM search_sessions WHERE team IS NOT NULL ORDER BY 1")]
+        return roles, teams
+    
+    @staticmethod
+    def _match_query(text: str) -> Optional[str]:
+        """Turn free text into an FTS5 query; the last word matches as a prefix"""
+        tokens = re.findall(r"\w+", text.lower())
+        if not tokens:
+            return None
+        return " ".join(f'"{token}"' for token in tokens[:-1]) + f' "{tokens[-1]}"*'
+    
+    def search(self, text: str, role: Optional[str] = None, team: Optional[str] = None,
+               start: Optional[str] = None, end: Optional[str] = None,
+               limit: int = SEARCH_RESULT_LIMIT) -> List[Dict]:
+        """Return the best-matching sessions, each with its best message snippet.
+
+        ``start``/``end`` are ISO date strings; ``end`` is exclusive.
+        """
+        match = self._match_query(text)
+        if match is None:
+            return []
+        
+        sql = (
+            "SELECT m.session_id, m.seq, m.role, COALESCE(m.timestamp, s.last_activity), s.session_name, "
+            "snippet(search_fts, 0, '**', '**', '…', 12), bm25(search_fts) AS rank "
+            "FROM search_fts "
+            "JOIN search_messages m ON m.id = search_fts.rowid "
+            "JOIN search_sessions s ON s.session_id = m.session_id "
+            "WHERE search_fts MATCH ?"
+        )
+        params = [match]
+        if role:
+            sql += " AND s.user_role = ?"
+            params.append(role)
+        if team:
+            sql += " AND s.team = ?"
+            params.append(team)
+        if start:
+            sql += " AND COALESCE(m.timestamp, s.last_activity) >= ?"
+            params.append(start)
+        if end:
+            sql += " AND COALESCE(m.timestamp, s.last_activity) < ?"
+            params.append(end)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit * 5)
+        
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        
+        # Keep the best-ranked hit per session
+        results = {}
+        for session_id, seq, message_role, timestamp, session_name, snippet, rank in rows:
+            if session_id not in results:
+                results[session_id] = {
+                    "session_id": session_id, "seq": seq, "role": message_role, "timestamp": timestamp,
+                    "session_name": session_name, "snippet": snippet, "rank": rank
+                }
+                if len(results) == limit:
+                    break
+        return list(results.values())
+
+@st.cache_resource
+def get_search_index() -> SessionSearchIndex:
+    index = SessionSearchIndex()
+    threading.Thread(target=index.backfill, args=(get_session_store(),), daemon=True).start()
+    return index
+
+def index_session_quietly(search_index: SessionSearchIndex, store, session_id: str,
+                          session_data: Optional[Dict] = None, reindex: bool = False):
+    """Index a saved session (read from ``store`` unless given), from scratch when ``reindex`` is set.
+
+    Search is best-effort: the session itself is already saved, and a later
+    save or the startup backfill indexes it again, so failures are logged
+    rather than raised.
+    """
+    try:
+        if reindex:
+            search_index.remove_session(session_id)
+        if session_data is None:
+            session_data = store.get_session(session_id)
+        if session_data is not None:
+            search_index.index_session(session_id, session_data)
+    except Exception:
+        logger.warning("Could not index session %s for search", session_id, exc_info=True)
+
+# ----------------------------
+# Session Export
+# ----------------------------
+EXPORT_FORMATS = {"ndjson.gz": "application/gzip", "zip": "application/zip"}
+
+def iter_export_sessions(store, archive: Optional[SessionArchive] = None, start: Optional[str] = None,
+                         end: Optional[str] = None, role: Optional[str] = None, team: Optional[str] = None,
+                         session_ids: Optional[List[str]] = None):
+    """Yield ``(session_id, session_data)`` pairs matching the filters, one session at a time.
+
+    ``start``/``end`` are ISO dates compared with ``last_activity`` (``end`` is
+    exclusive); ``role``/``team`` match the session's ``user_info``. Live
+    sessions are filtered on their metadata before messages are loaded, and
+    archived sessions are included.
+    """
+    def matches(meta: Dict) -> bool:
+        last_activity = str(meta.get("last_activity", ""))
+        user_info = meta.get("user_info") or {}
+        return ((not start or last_activity >= start)
+                and (not end or last_activity < end)
+                and (not role or user_info.get("role") == role)
+                and (not team or user_info.get("team") == team))
+    
+    if session_ids is None:
+        session_ids = store.session_ids()
+        if archive is not None:
+            session_ids += [session_id for session_id in archive.ids() if store.session_meta(session_id) is None]
+    
+    for session_id in session_ids:
+        meta = store.session_meta(session_id)
+        if meta is not None:
+            session_data = store.get_session(session_id) if matches(meta) else None
+        else:
+            session_data = archive.get(session_id) if archive is not None else None
+            if session_data is not None and not matches(session_data):
+                session_data = None
+        if session_data is not None:
+            yield session_id, session_data
+
+def write_export(sessions, fileobj, fmt: str = "ndjson.gz") -> int:
+    """Stream sessions into a binary file object; returns how many were written.
+
+    ``ndjson.gz`` writes one ``{"session_id", "session"}`` line per session (the
+    format ``iter_archive_sessions`` reads back); ``zip`` writes one JSON file
+    per session. Only one session is encoded at a time.
+    """
+    count = 0
+    if fmt == "zip":
+        with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+            for session_id, session_data in sessions:
+                with bundle.open(f"{session_id}.json", 'w') as f:
+                    f.write(json.dumps(session_data, default=_json_default).encode())
+                count += 1
+    else:
+        with gzip.GzipFile(fileobj=fileobj, mode='wb') as archive:
+            for session_id, session_data in sessions:
+                line = json.dumps({"session_id": session_id, "session": session_data}, default=_json_default)
+                archive.write(line.encode() + b"\n")
+                count += 1
+    return count
+
+_EXPORT_NAME_UNSAFE_RE = re.compile(r'[^A-Za-z0-9._-]+')
+
+def export_file_path(file_name: str, fmt: str = "ndjson.gz") -> str:
+    """Map a user-supplied file name to a path inside ``EXPORT_DIR``.
+
+    Directories are dropped and anything outside ``[A-Za-z0-9._-]`` is replaced,
+    so the export can never land (or overwrite anything) outside ``EXPORT_DIR``.
+    """
+    name = os.path.basename(file_name.replace("\\", "/"))
+    name = _EXPORT_NAME_UNSAFE_RE.sub("_", name).lstrip(".")
+    if not name:
+        raise ValueError("Export file name is empty")
+    if not name.endswith(f".{fmt}"):
+        name = f"{name}.{fmt}"
+    return os.path.join(EXPORT_DIR, name)
+
+def export_to_file(sessions, file_name: str, fmt: str = "ndjson.gz") -> int:
+    """Write an export into ``EXPORT_DIR`` via fsync + rename; returns the session count"""
+    path = export_file_path(file_name, fmt)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        count = write_export(sessions, f, fmt)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return count
+
+# ----------------------------
+# Utility Functions
+# ----------------------------
+_HTML_TAG_RE = re.compile('<.*?>')
+_JSON_START_RE = re.compile(r'\s*[\[{]')
+
+def strip_html_tags(text):
+    """Remove HTML tags from text"""
+    if '<' not in text:
+        return text
+    return _HTML_TAG_RE.sub('', text)
+
+def strip_html_tags_stream(pieces):
+    """Remove HTML tags from streamed text, including tags split across pieces.
+
+    A trailing ``<`` with no ``>`` after it is held back and joined to the next
+    piece; it is released as text once a newline, the end of the stream or
+    ``WEBHOOK_STREAM_TAG_HOLD`` characters show it is not a tag.
+    """
+    held = ""
+    for piece in pieces:
+        text = strip_html_tags(held + piece)
+        held = ""
+        start = text.rfind('<')
+        if start != -1 and len(text) - start <= WEBHOOK_STREAM_TAG_HOLD and not any(
+                c in text[start:] for c in '>\n'):
+            text, held = text[:start], text[start:]
+        if text:
+            yield text
+    if held:
+        yield held
+
+def decode_json(text):
+    """Decode JSON with orjson or ujson when installed, falling back to the stdlib"""
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN or huge integers; let the stdlib decide
+    elif ujson is not None:
+        try:
+            return ujson.loads(text)
+        except ValueError:
+            pass
+    return json.loads(text)
+
+MESSAGES_REPLY_KEYS = ("ai", "assistant", "response", "message", "content", "text")
+REPLY_KEYS = ("response", "message", "text", "content", "answer", "reply", "output")
+NESTED_REPLY_KEYS = ("text", "content", "message")
+
+def _extract_messages_list(data):
+    """n8n chat shape: ``[{"messages": {"ai": "..."}}]``"""
+    if isinstance(data, list):
+        for index, entry in enumerate(data):
+            if isinstance(entry, dict) and "messages" in entry:
+                msg_dict = entry["messages"]
+                for rank, key in enumerate(MESSAGES_REPLY_KEYS):
+                    if key in msg_dict:
+                        return (str(msg_dict[key]), (index, "messages", key),
+                                (("messages",), (), MESSAGES_REPLY_KEYS[:rank]))
+    return None
+
+def _extract_reply_keys(data):
+    """Flat or nested reply objects: ``{"output": "..."}``, ``{"response": {"text": "..."}}``"""
+    if isinstance(data, dict):
+        for rank, key in enumerate(REPLY_KEYS):
+            if key in data:
+                content = data[key]
+                if isinstance(content, str):
+                    return content, (key,), (REPLY_KEYS[:rank],)
+                elif isinstance(content, dict):
+                    for nested_rank, nested_key in enumerate(NESTED_REPLY_KEYS):
+                        if nested_key in content:
+                            return (str(content[nested_key]), (key, nested_key),
+                                    (REPLY_KEYS[:rank], NESTED_REPLY_KEYS[:nested_rank]))
+    return None
+
+# Extractors are tried in order; each returns ``(text, key_path, outranking)`` or None, where
+# ``outranking`` lists per path step the keys the extractor would have preferred
+RESPONSE_EXTRACTORS = [
+    ("messages_list", _extract_messages_list),
+    ("reply_keys", _extract_reply_keys),
+]
+
+def _follow_path(data, path: tuple, outranking: tuple):
+    """Value at ``path``, or None if the path is missing or a preferred key is present along it"""
+    for step, preferred in zip(path, outranking):
+        if isinstance(step, int):
+            if not isinstance(data, list) or step >= len(data):
+                return None
+            if preferred and any(isinstance(entry, dict) and any(key in entry for key in preferred)
+                                 for entry in data[:step]):
+                return None
+        elif not isinstance(data, dict) or step not in data or any(key in data for key in preferred):
+            return None
+        data = data[step]
+    return data
+
+class ResponseExtractor:
+    """Finds the reply text in decoded webhook responses.
+
+    The registered extractors are searched in order the first time; the key
+    path of the match is remembered, and later responses with the same shape
+    are answered by following that path directly, as long as no key the
+    extractor prefers has appeared along it. A miss on the learned path falls
+    back to the full search, which re-learns it.
+    """
+
+    def __init__(self, extractors: Optional[List[tuple]] = None):
+        self.extractors = list(extractors if extractors is not None else RESPONSE_EXTRACTORS)
+        self.learned_path: Optional[tuple] = None  # (key_path, outranking)
+        self.fast_hits = 0
+        self.slow_hits = 0
+    
+    def register(self, name: str, extractor, first: bool = True):
+        """Add an extractor returning ``(text, key_path, outranking)`` or None"""
+        self.extractors.insert(0 if first else len(self.extractors), (name, extractor))
+        self.learned_path = None
+    
+    def extract_data(self, data) -> Optional[str]:
+        """Reply text from decoded JSON, or None if it carries none"""
+        learned_path = self.learned_path
+        if learned_path is not None:
+            value = _follow_path(data, *learned_path)
+            if isinstance(value, str):
+                self.fast_hits += 1
+                return strip_html_tags(value)
+        
+        for name, extractor in self.extractors:
+            found = extractor(data)
+            if found is not None:
+                text, key_path, outranking = found
+                self.learned_path = (key_path, outranking)
+                self.slow_hits += 1
+                return strip_html_tags(text)
+        return None
+    
+    def extract(self, response_text: str) -> str:
+        """Reply text from a raw response body; non-JSON bodies are returned without HTML tags"""
+        if isinstance(response_text, str) and _JSON_START_RE.match(response_text):
+            try:
+                text = self.extract_data(decode_json(response_text))
+                if text is not None:
+                    return text
+            except (ValueError, TypeError, KeyError):
+                pass
+        
+        return strip_html_tags(str(response_text))
+
+@st.cache_resource
+def get_response_extractor(kind: str = "response") -> ResponseExtractor:
+    """Shared extractor per response kind ("response" bodies or "stream" chunks)"""
+    return ResponseExtractor()
+
+def extract_plain_text(response_text):
+    """Extract plain text message from AI response"""
+    return get_response_extractor("response").extract(response_text)
+
+def _decoded_chunk_text(data, chunk: str) -> Optional[str]:
+    """Reply text of one decoded streamed chunk; None for objects no extractor recognises"""
+    if isinstance(data, (dict, list)):
+        try:
+            return get_response_extractor("stream").extract_data(data)
+        except (TypeError, KeyError):
+            return None
+    return strip_html_tags(data if isinstance(data, str) else chunk)
+
+def extract_stream_chunk(chunk: str) -> str:
+    """Extract plain text from one SSE data payload, which may be JSON or a raw text token"""
+    try:
+        data = decode_json(chunk)
+    except (ValueError, TypeError):
+        return strip_html_tags(chunk)
+    # Control events such as {"type": "begin"} carry no text
+    return _decoded_chunk_text(data, chunk) or ""
+
+def generate_session_id(user_info: Dict) -> str:
+    """Generate a unique session ID based on user info and timestamp"""
+    base_string = f"{user_info['name']}_{user_info['role']}_{user_info['team']}"
+    return hashlib.md5(base_string.encode()).hexdigest()[:12]
+
+def save_chat_sessions(sessions: Dict, auto_upload: bool = True, session_ids: Optional[List[str]] = None,
+                       rewrite: bool = False) -> bool:
+    """Save chat sessions to the session store and optionally upload to Drive.
+
+    When ``session_ids`` is given only those sessions are written; the store
+    appends their new messages rather than rewriting the whole history, unless
+    ``rewrite`` says messages already stored were changed. Returns False
+    (after showing the error) when the save failed.
+    """
+    try:
+        store = get_session_store()
+        archive = get_session_archive()
+        for session_id in (session_ids if session_ids is not None else list(sessions)):
+            if session_id in sessions:
+                session_data = sessions[session_id]
+                store.save_session(session_id, session_data, rewrite=rewrite)
+                archive.discard(session_id)
+                index_session_quietly(get_search_index(), store, session_id, session_data, reindex=rewrite)
+        
+        # Keep at most MAX_CHAT_HISTORY sessions live; older ones go to the archive
+        archive.enforce_retention(store)
+        
+        # Auto-upload to Drive in the background if enabled and authenticated
+        if auto_upload and st.session_state.get('drive_enabled', False) and st.session_state.get('drive_credentials'):
+            get_drive_sync_worker().submit(
+                st.session_state.drive_credentials,
+                st.session_state.get('drive_folder_id'),
+                StoredSessions(store, archive)
+            )
+        return True
+                
+    except Exception as e:
+        st.error(f"Error saving chat sessions: {e}")
+        return False
+
+def load_chat_sessions() -> Dict:
+    """Open the session store for this user; messages load on demand"""
+    try:
+        return SessionCache(get_session_store(), get_session_archive())
+    except Exception as e:
+        st.error(f"Error loading chat sessions: {e}")
+    return {}
+
+def format_timestamp(timestamp: str) -> str:
+    """Format timestamp for display"""
+    try:
+        if isinstance(timestamp, str):
+            dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        else:
+            dt = timestamp
+        return dt.strftime("%Y-%m-%d %H:%M:%S")
+    except:
+        return str(timestamp)
+
+def truncate_message(message: str, max_length: int = 100) -> str:
+    """Truncate message for preview"""
+    if len(message) <= max_length:
+        return message
+    return message[:max_length] + "..."
+
+# ----------------------------
+# Customer Data
+# ----------------------------
+class CustomerDataset:
+    """The CRM customer export as one DataFrame shared by every session.
+
+    Loaded on first use (pandas is imported then, not at startup) and again
+    only when the file's modification time changes; a rerun costs one
+    ``os.stat``. Aggregates for the webhook payload and the stats panel are
+    computed once per load. A missing file is an empty dataset, and a file
+    that fails to load keeps the previous data and reports ``error``.
+    """
+
+    def __init__(self, path: str = CUSTOMER_DATA_FILE):
+        self.path = path
+        self.error = None
+        self._frame = None
+        self._mtime = None
+        self._aggregates = {"customer_count": 0, "active_customers": 0, "customers_by_segment": {}}
+        self._lock = threading.Lock()
+    
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            try:
+                frame = self._read() if mtime is not None else None
+            except Exception as e:
+                self.error = f"Could not load {self.path}: {e}"
+                self._mtime = mtime  # retried once the file changes again
+                return
+            self._frame = frame
+            self._aggregates = self._aggregate(frame)
+            self._mtime = mtime
+            self.error = None
+    
+    def _read(self):
+        import pandas as pd
+        if self.path.endswith(".parquet"):
+            frame = pd.read_parquet(self.path)
+        else:
+            frame = pd.read_csv(self.path)
+        frame.columns = [str(column).strip().lower() for column in frame.columns]
+        # Repeated labels are stored once per distinct value
+        for column in (CUSTOMER_SEGMENT_COLUMN, CUSTOMER_STATUS_COLUMN):
+            if column in frame:
+                frame[column] = frame[column].astype("category")
+        return frame
+    
+    @staticmethod
+    def _aggregate(frame) -> Dict:
+        if frame is None:
+            return {"customer_count": 0, "active_customers": 0, "customers_by_segment": {}}
+        if CUSTOMER_STATUS_COLUMN in frame:
+            statuses = frame[CUSTOMER_STATUS_COLUMN].astype(str).str.strip().str.lower()
+            active = int(statuses.isin(CUSTOMER_ACTIVE_STATUSES).sum())
+        elif CUSTOMER_LAST_VISIT_COLUMN in frame:
+            import pandas as pd
+            last_visit = pd.to_datetime(frame[CUSTOMER_LAST_VISIT_COLUMN], errors="coerce")
+            cutoff = pd.Timestamp.now() - pd.Timedelta(days=CUSTOMER_ACTIVE_DAYS)
+            active = int((last_visit >= cutoff).sum())
+        else:
+            active = None
+        by_segment = {}
+        if CUSTOMER_SEGMENT_COLUMN in frame:
+            counts = frame[CUSTOMER_SEGMENT_COLUMN].value_counts(sort=True)
+            by_segment = {str(segment): int(count) for segment, count in counts.items() if count}
+        return {"customer_count": len(frame), "active_customers": active, "customers_by_segment": by_segment}
+    
+    def frame(self):
+        """The shared DataFrame, or None without a customer file; treat it as read-only"""
+        self._refresh()
+        return self._frame
+    
+    def aggregates(self) -> Dict:
+        """``customer_count``, ``active_customers`` and ``customers_by_segment`` for the current file"""
+        self._refresh()
+        return self._aggregates
+
+@st.cache_resource
+def get_customer_dataset() -> CustomerDataset:
+    return CustomerDataset()
+
+# ----------------------------
+# Session State Initialization
+# ----------------------------
+def initialize_session_state():
+    """Initialize all session state variables"""
+    
+    # User information
+    if "user_info" not in st.session_state:
+        st.session_state.user_info = {
+            "name": "Guest",
+            "role": "Visitor", 
+            "team": "Unknown"
+        }
+
+    if "username" not in st.session_state:
+        st.session_state.username = "guest_user"
+
+    # Chat-related state
+    if "messages" not in st.session_state:
+        st.session_state.messages = MessageLog()
+    
+    if "current_session_id" not in st.session_state:
+        st.session_state.current_session_id = generate_session_id(st.session_state.user_info)
+    
+    if "chat_sessions" not in st.session_state:
+        st.session_state.chat_sessions = load_chat_sessions()
+    
+    if "selected_session" not in st.session_state:
+        st.session_state.selected_session = None
+    
+    if "auto_save" not in st.session_state:
+        st.session_state.auto_save = True
+    
+    if "message_count" not in st.session_state:
+        st.session_state.message_count = 0
+    
+    if "last_activity" not in st.session_state:
+        st.session_state.last_activity = datetime.now().isoformat()
+    
+    # Google Drive related state
+    if "drive_enabled" not in st.session_state:
+        st.session_state.drive_enabled = False
+    
+    if "drive_auto_sync" not in st.session_state:
+        st.session_state.drive_auto_sync = True
+    
+    if "transcript_window" not in st.session_state:
+        st.session_state.transcript_window = TRANSCRIPT_PAGE_SIZE
+    
+    if "stream_responses" not in st.session_state:
+        st.session_state.stream_responses = True
+    
+    if "response_cache_enabled" not in st.session_state:
+        st.session_state.response_cache_enabled = False
+    
+    if "pending_replies" not in st.session_state:
+        st.session_state.pending_replies = set()
+    
+    if "context_states" not in st.session_state:
+        st.session_state.context_states = OrderedDict()
+
+# ----------------------------
+# Chat Session Management
+# ----------------------------
+def save_current_session():
+    """Save the current chat session"""
+    if not st.session_state.messages:
+        return
+    
+    # Late replies replace their placeholders before the session is written
+    if apply_outbox_replies(st.session_state.messages, st.session_state.pending_replies):
+        try:
+            # Patched messages may not be at the tail, so the session is indexed afresh
+            get_search_index().remove_session(st.session_state.current_session_id)
+        except Exception:
+            pass
+    
+    # Views share the message records and user_info instead of copying them
+    session_data = {
+        "messages": st.session_state.messages.view(),
+        "user_info": share_user_info(st.session_state.user_info),
+        "created_at": st.session_state.get("session_created_at", datetime.now().isoformat()),
+        "last_activity": datetime.now().isoformat(),
+        "message_count": len(st.session_state.messages),
+        "session_name": f"Chat with {st.session_state.user_info['name']} - {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    }
+    if st.session_state.get("context_summary"):
+        session_data["context_summary"] = saved_context_summary(st.session_state.context_summary)
+    
+    st.session_state.chat_sessions[st.session_state.current_session_id] = session_data
+    save_chat_sessions(
+        st.session_state.chat_sessions,
+        st.session_state.get('drive_auto_sync', True),
+        session_ids=[st.session_state.current_session_id]
+    )
+
+def load_session(session_id: str):
+    """Load a specific chat session"""
+    session_data = st.session_state.chat_sessions.get(session_id)
+    if session_data is not None:
+        messages = session_data["messages"]
+        if hasattr(messages, "covers_log") and messages.covers_log():
+            # Nothing was appended since the save, so keep appending to the same log
+            st.session_state.messages = messages.log
+        else:
+            # Start a new log over the shared records; unsaved turns stay out of it
+            st.session_state.messages = MessageLog(messages)
+        # Shared and never mutated in place; "Update User Info" replaces it
+        st.session_state.user_info = session_data["user_info"]
+        _stash_context_summary()
+        # Without state from this browser session, the next prompt continues the saved summary
+        st.session_state.context_summary = (st.session_state.context_states.pop(session_id, None)
+                                            or session_data.get("context_summary"))
+        st.session_state.pending_replies = {
+            message["outbox_id"] for message in st.session_state.messages if "outbox_id" in message
+        }
+        apply_outbox_replies(st.session_state.messages, st.session_state.pending_replies)
+        st.session_state.current_session_id = session_id
+        st.session_state.selected_session = session_id
+        st.session_state.transcript_window = TRANSCRIPT_PAGE_SIZE
+        st.rerun()
+
+def create_new_session():
+    """Create a new chat session"""
+    if st.session_state.auto_save and st.session_state.messages:
+        save_current_session()
+    
+    _reset_current_session()
+    st.rerun()
+
+def apply_outbox_replies(messages: List[Dict], pending: set) -> int:
+    """Put settled outbox replies in place of their placeholders; returns how many were replaced"""
+    if not pending:
+        return 0
+    results = get_webhook_outbox().results(pending)
+    if not results:
+        return 0
+    for message in messages:
+        outbox_id = message.get("outbox_id")
+        if outbox_id in results:
+            message["content"] = results[outbox_id]
+            del message["outbox_id"]
+    pending.difference_update(results)
+    return len(results)
+
+@st.fragment(run_every=OUTBOX_POLL_SECONDS)
+def render_pending_replies():
+    """Show replies the outbox delivered after the UI stopped waiting for them"""
+    pending = st.session_state.pending_replies
+    if not pending:
+        return
+    if apply_outbox_replies(st.session_state.messages, pending):
+        if st.session_state.auto_save:
+            save_current_session()
+        st.rerun()
+    st.caption(f"⏳ Waiting for {len(pending)} delayed {'reply' if len(pending) == 1 else 'replies'}...")
+
+def _stash_context_summary():
+    """Keep the current session's full summary state in case it is loaded again"""
+    summary = st.session_state.get("context_summary")
+    if summary:
+        states = st.session_state.context_states
+        states[st.session_state.current_session_id] = summary
+        states.move_to_end(st.session_state.current_session_id)
+        while len(states) > SESSION_CACHE_SIZE:
+            states.popitem(last=False)
+
+def _reset_current_session():
+    """Start an empty current session without saving or rerunning"""
+    _stash_context_summary()
+    st.session_state.messages = MessageLog()
+    st.session_state.context_summary = None
+    st.session_state.pending_replies = set()
+    st.session_state.current_session_id = generate_session_id(st.session_state.user_info) + f"_{int(time.time())}"
+    st.session_state.session_created_at = datetime.now().isoformat()
+    st.session_state.selected_session = None
+    st.session_state.transcript_window = TRANSCRIPT_PAGE_SIZE
+
+def delete_session(session_id: str):
+    """Delete a chat session; runs as an on_click callback of the session list"""
+    if session_id in st.session_state.chat_sessions:
+        del st.session_state.chat_sessions[session_id]
+        get_session_store().delete_session(session_id)
+        get_search_index().remove_session(session_id)
+        save_chat_sessions(st.session_state.chat_sessions, st.session_state.get('drive_auto_sync', True), session_ids=[])
+        if st.session_state.current_session_id == session_id:
+            _reset_current_session()
+            # Callbacks can't rerun the app; the session list fragment does it
+            st.session_state.rerun_app = True
+        st.session_state.context_states.pop(session_id, None)
+
+# ----------------------------
+# Conversation Context
+# ----------------------------
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+|\n+')
+_TERM_RE = re.compile(r"[a-z0-9][a-z0-9'-]{2,}")
+_STOP_WORDS = frozenset(
+    "the and for are but not you your with this that have from was were what when where which will "
+    "would can could about there their they them then than into our out its all any how who why has "
+    "had did does just also been being some more other only please thanks thank".split()
+)
+
+def _clip_bytes(text: str, max_bytes: int) -> str:
+    """Text cut to at most ``max_bytes`` of UTF-8, on a character boundary"""
+    encoded = text.encode()
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes].decode(errors="ignore")
+
+def context_budget(role: str) -> int:
+    """Context bytes sent with each prompt for a user role"""
+    return CONTEXT_BUDGETS.get(role, CONTEXT_DEFAULT_BUDGET)
+
+def _sentence_score(text: str, terms: Dict) -> float:
+    words = set(_TERM_RE.findall(text.lower())) - _STOP_WORDS
+    if not words:
+        return 0.0
+    return sum(terms.get(word, 0) for word in words) / len(words) ** 0.5
+
+def _summary_matches(summary: Dict, messages: Sequence) -> bool:
+    """Whether the messages a summary folded in are still the start of ``messages``"""
+    covered = summary.get("covered", 0)
+    if covered > len(messages):
+        return False
+    return covered == 0 or summary.get("last") == _message_fingerprint(messages[covered - 1])
+
+def saved_context_summary(summary: Dict) -> Dict:
+    """The part of a summary stored in session metadata.
+
+    The term counts and sentence pool only make the next update cheap, so
+    they stay in ``st.session_state`` (see ``_stash_context_summary``) and
+    the stored session carries just the text, its budget and what it covers;
+    ``update_context_summary`` continues from that when no full state is left.
+    """
+    return {key: summary[key] for key in ("budget", "text", "covered", "last") if key in summary}
+
+def _reseed_context_summary(saved: Dict) -> Dict:
+    """Full summary state from a saved one, with its text's sentences as the pool"""
+    pool, terms = [], {}
+    lines = [line.partition(": ") for line in saved["text"].split("\n") if line]
+    for offset, (role, _, sentence) in enumerate(lines):
+        # Ordered before anything folded in later
+        pool.append([offset - len(lines), role, sentence])
+        for term in _TERM_RE.findall(sentence.lower()):
+            if term not in _STOP_WORDS:
+                terms[term] = terms.get(term, 0) + 1
+    return {**saved, "terms": terms, "pool": pool}
+
+def update_context_summary(summary: Optional[Dict], messages: Sequence, upto: int, budget: int) -> Dict:
+    """Fold ``messages[covered:upto]`` into a rolling extractive summary and return it.
+
+    The summary keeps counts of the terms folded so far and a pool of
+    candidate sentences of at most ``CONTEXT_SUMMARY_POOL`` times the budget;
+    the sentences that best cover the frequent terms, in conversation order,
+    make up its ``text``. A call only reads the newly folded messages and the
+    bounded pool, so its cost does not grow with the session. A saved summary
+    without that state is continued from its text's sentences. A summary that
+    no longer matches the history, or was built for another budget, is rebuilt.
+    """
+    if summary is None or summary.get("budget") != budget or not _summary_matches(summary, messages):
+        summary = {"budget": budget, "covered": 0, "last": None, "terms": {}, "pool": [], "text": ""}
+    elif "pool" not in summary:
+        summary = _reseed_context_summary(summary)
+    if upto <= summary["covered"]:
+        return summary
+    
+    terms = dict(summary["terms"])
+    pool = list(summary["pool"])
+    seen = {entry[2] for entry in pool}
+    for seq in range(summary["covered"], upto):
+        message = messages[seq]
+        content = str(message.get("content", ""))
+        for term in _TERM_RE.findall(content.lower()):
+            if term not in _STOP_WORDS:
+                terms[term] = terms.get(term, 0) + 1
+        for sentence in _SENTENCE_SPLIT_RE.split(content):
+            sentence = _clip_bytes(sentence.strip(), budget // 2)
+            # Skip greetings, fragments and sentences already in the pool
+            if len(sentence) >= 12 and sentence not in seen:
+                seen.add(sentence)
+                pool.append([seq, message.get("role", "user"), sentence])
+    if len(terms) > 2 * CONTEXT_SUMMARY_TERMS:
+        terms = dict(sorted(terms.items(), key=lambda item: item[1], reverse=True)[:CONTEXT_SUMMARY_TERMS])
+    
+    # Best-scoring candidates stay in the pool; the best of those that fit form the text
+    ranked = sorted(pool, key=lambda entry: _sentence_score(entry[2], terms), reverse=True)
+    kept, chosen = [], []
+    kept_bytes = text_bytes = 0
+    for entry in ranked:
+        size = len(entry[2].encode())
+        if kept_bytes + size > budget * CONTEXT_SUMMARY_POOL:
+            continue
+        kept.append(entry)
+        kept_bytes += size
+        line_size = len(entry[1]) + size + 3
+        if text_bytes + line_size <= budget:
+            chosen.append(entry)
+            text_bytes += line_size
+    
+    return {
+        "budget": budget,
+        "covered": upto,
+        "last": _message_fingerprint(messages[upto - 1]),
+        "terms": terms,
+        "pool": sorted(kept),
+        "text": "\n".join(f"{role}: {text}" for _, role, text in sorted(chosen)),
+    }
+
+def build_context(messages: Sequence, role: str, summary: Optional[Dict] = None) -> tuple:
+    """Recent turns plus a rolling summary of older ones, within the role's byte budget.
+
+    Returns ``(recent, summary)``: the newest messages that fit in the budget
+    left after the summary's share, oldest first, and ``summary`` updated to
+    cover every message before them. The newest message is always sent,
+    clipped if it alone exceeds the budget.
+    """
+    budget = context_budget(role)
+    summary_budget = int(budget * CONTEXT_SUMMARY_SHARE)
+    remaining = budget - summary_budget
+    
+    recent = []
+    start = len(messages)
+    while start > 0 and remaining > 0:
+        message = messages[start - 1]
+        content = str(message["content"])
+        size = len(content.encode())
+        if size > remaining:
+            if recent:
+                break  # left to the summary rather than sent half
+            content = _clip_bytes(content, remaining)
+            size = remaining
+        recent.append({"role": message["role"], "content": content})
+        remaining -= size
+        start -= 1
+    recent.reverse()
+    
+    return recent, update_context_summary(summary, messages, start, summary_budget)
+
+# ----------------------------
+# AI Communication
+# ----------------------------
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised without contacting the webhook while its circuit breaker is open"""
+
+class CircuitBreaker:
+    """Fail fast after repeated webhook failures.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    calls fail immediately. Once ``reset_timeout`` seconds have passed a
+    single probe request is let through; its outcome closes or re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int = WEBHOOK_BREAKER_THRESHOLD,
+                 reset_timeout: float = WEBHOOK_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    def retry_after(self) -> float:
+        """Seconds until the next probe is allowed (0 when closed)"""
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+    
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("AI webhook circuit is open")
+            self._probing = True
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+class WebhookClient:
+    """Shared keep-alive HTTP client for the n8n webhook.
+
+    One ``requests.Session`` with a bounded connection pool is reused by
+    every Streamlit session, so turns skip the TCP/TLS handshake. Failures
+    where the webhook cannot have handled the request (a connection that
+    could not be opened, and gateway 502/503 responses) are retried with
+    full-jitter backoff; errors after the request went out are not, since
+    a retry could run the workflow twice. A circuit breaker per URL fails
+    fast while it is down.
+    """
+
+    def __init__(self, pool_size: int = WEBHOOK_POOL_SIZE,
+                 connect_timeout: float = WEBHOOK_CONNECT_TIMEOUT,
+                 read_timeout: float = WEBHOOK_READ_TIMEOUT,
+                 max_retries: int = WEBHOOK_MAX_RETRIES):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+    
+    def breaker(self, url: str) -> CircuitBreaker:
+        with self._lock:
+            if url not in self._breakers:
+                self._breakers[url] = CircuitBreaker()
+            return self._breakers[url]
+    
+    def post(self, url: str, read_timeout: Optional[float] = None, **kwargs) -> requests.Response:
+        """POST through the shared pool with retries and the URL's circuit breaker"""
+        breaker = self.breaker(url)
+        breaker.before_call()
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(url, timeout=timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= self.max_retries or not _failed_before_sending(e):
+                    breaker.record_failure()
+                    raise
+            except requests.exceptions.RequestException:
+                breaker.record_failure()
+                raise
+            else:
+                if response.status_code not in WEBHOOK_RETRY_STATUSES:
+                    if response.status_code >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    return response
+                if attempt >= self.max_retries:
+                    breaker.record_failure()
+                    return response
+                response.close()
+            
+            attempt += 1
+            time.sleep(random.uniform(0, WEBHOOK_RETRY_BACKOFF * 2 ** attempt))
+
+def _failed_before_sending(error: requests.exceptions.ConnectionError) -> bool:
+    """True when the connection could not be opened, so no part of the request was sent"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    from urllib3.exceptions import ConnectTimeoutError  # also covers NewConnectionError
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+@st.cache_resource
+def get_webhook_client() -> WebhookClient:
+    return WebhookClient()
+
+class EndpointStats:
+    """Rolling latency and error record for one webhook endpoint"""
+
+    def __init__(self, window: int = WEBHOOK_LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+    
+    def record(self, latency: float, ok: bool):
+        with self._lock:
+            self.latencies.append(latency)
+            if ok:
+                self.successes += 1
+            else:
+                self.failures += 1
+    
+    def percentile(self, q: float) -> Optional[float]:
+        """Latency percentile in seconds, or None until there are enough samples"""
+        with self._lock:
+            if len(self.latencies) < WEBHOOK_LATENCY_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class HedgedDispatcher:
+    """Send a webhook request to the fastest of several equivalent endpoints.
+
+    Endpoints are ranked by their recent p95 latency. The request goes to
+    the best one first; if it has not answered within that endpoint's p95
+    (clamped to sane bounds) a hedged copy goes to the next endpoint, and
+    errors fail over immediately. The first 200 response wins and the
+    others are closed as soon as they return. Each primary attempt gets its
+    own thread; only hedges and failovers share the bounded executor, so a
+    burst of slow prompts never queues behind one another.
+    """
+
+    def __init__(self, client: WebhookClient, max_workers: int = WEBHOOK_HEDGE_WORKERS):
+        self.client = client
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="webhook-hedge")
+        self._stats: Dict[str, EndpointStats] = {}
+        self._lock = threading.Lock()
+    
+    def stats(self, url: str) -> EndpointStats:
+        with self._lock:
+            if url not in self._stats:
+                self._stats[url] = EndpointStats()
+            return self._stats[url]
+    
+    def hedge_delay(self, url: str) -> float:
+        p95 = self.stats(url).percentile(0.95)
+        if p95 is None:
+            return WEBHOOK_HEDGE_DEFAULT_DELAY
+        return min(WEBHOOK_HEDGE_MAX_DELAY, max(WEBHOOK_HEDGE_MIN_DELAY, p95))
+    
+    def rank(self, urls: List[str]) -> List[str]:
+        """Order endpoints: closed circuits first, then by p95 latency"""
+        def sort_key(url):
+            p95 = self.stats(url).percentile(0.95)
+            return (self.client.breaker(url).retry_after() > 0,
+                    p95 if p95 is not None else WEBHOOK_HEDGE_DEFAULT_DELAY)
+        return sorted(dict.fromkeys(urls), key=sort_key)
+    
+    def _timed_post(self, url: str, kwargs: Dict, started_at: Dict[str, float]) -> requests.Response:
+        started = started_at[url] = time.monotonic()
+        try:
+            response = self.client.post(url, **kwargs)
+        except CircuitOpenError:
+            raise
+        except Exception:
+            self.stats(url).record(time.monotonic() - started, ok=False)
+            raise
+        self.stats(url).record(time.monotonic() - started, ok=response.status_code == 200)
+        return response
+    
+    @staticmethod
+    def _spawn(fn, *args) -> Future:
+        """Run ``fn`` on a new daemon thread, returning its future"""
+        future = Future()
+        def run():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+        threading.Thread(target=run, name="webhook-primary", daemon=True).start()
+        return future
+    
+    @staticmethod
+    def _discard(future):
+        """Cancel a losing request, or close its response once it arrives"""
+        if not future.cancel():
+            future.add_done_callback(lambda f: f.exception() is None and f.result().close())
+    
+    def post(self, urls: List[str], **kwargs) -> requests.Response:
+        """POST to the endpoints with hedging; returns the first successful response.
+
+        Responses are always streamed, so a response "arrives" once its
+        headers do. If every endpoint fails, the last non-200 response is
+        returned, or the last error is raised.
+        """
+        kwargs["stream"] = True
+        ranked = self.rank(urls)
+        if not ranked:
+            raise ValueError("No webhook URL configured")
+        
+        futures = {}
+        remaining = list(ranked)
+        fallback_response = None
+        last_error = None
+        started_at: Dict[str, float] = {}  # url -> when its request left the executor queue
+        
+        def launch(primary: bool = False):
+            url = remaining.pop(0)
+            submit = self._spawn if primary else self._executor.submit
+            futures[submit(self._timed_post, url, kwargs, started_at)] = url
+            return url, self.hedge_delay(url)
+        
+        latest, delay = launch(primary=True)
+        while futures:
+            timeout = None
+            if remaining:
+                # The hedge delay runs from when the latest attempt started, not when it was queued
+                started = started_at.get(latest)
+                if started is None:
+                    timeout = WEBHOOK_HEDGE_MIN_DELAY / 5
+                else:
+                    timeout = max(0.0, started + delay - time.monotonic())
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                started = started_at.get(latest)
+                if started is not None and time.monotonic() >= started + delay:
+                    # Slowest-case protection: hedge to the next endpoint
+                    latest, delay = launch()
+                continue
+            
+            for future in done:
+                futures.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                else:
+                    if response.status_code == 200:
+                        for other in futures:
+                            self._discard(other)
+                        if fallback_response is not None:
+                            fallback_response.close()
+                        return response
+                    if fallback_response is not None:
+                        fallback_response.close()
+                    fallback_response = response
+                
+                # Fail over right away instead of waiting for the hedge delay
+                if remaining:
+                    latest, delay = launch()
+        
+        if fallback_response is not None:
+            return fallback_response
+        raise last_error
+
+@st.cache_resource
+def get_webhook_dispatcher() -> HedgedDispatcher:
+    return HedgedDispatcher(get_webhook_client())
+
+class ResponseCache:
+    """Cache of webhook answers for repeated questions.
+
+    Keys combine the normalized prompt with the asker's role and team. The
+    memory tier is an LRU bounded by entry count and total size; the
+    optional SQLite tier survives restarts and refills the memory tier on a
+    hit. Entries expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES, path: Optional[str] = RESPONSE_CACHE_FILE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, response, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+    
+    @staticmethod
+    def make_key(prompt: str, user_info: Dict) -> str:
+        """Cache key for a prompt: case, spacing and trailing punctuation are ignored"""
+        normalized = re.sub(r"\s+", " ", prompt.strip().lower()).rstrip(" ?!.")
+        base_string = f"{normalized}\x1f{user_info.get('role', '')}\x1f{user_info.get('team', '')}"
+        return hashlib.sha256(base_string.encode()).hexdigest()
+    
+    def _forget(self, key: str):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[2]
+    
+    def _remember(self, key: str, expires_at: float, response: str):
+        self._forget(key)
+        size = len(response.encode())
+        self._entries[key] = (expires_at, response, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+    
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                self._forget(key)
+            
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT response, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[1] > now:
+                    with self._conn:
+                        self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                    self._remember(key, row[1], row[0])
+                    self.hits += 1
+                    return row[0]
+            
+            self.misses += 1
+            return None
+    
+    def put(self, key: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now + self.ttl, response)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO responses (key, response, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                        (key, response, now + self.ttl, now)
+                    )
+                    self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                    self._conn.execute(
+                        "DELETE FROM responses WHERE key NOT IN "
+                        "(SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+                        (self.max_entries,)
+                    )
+    
+    def invalidate(self, key: str):
+        with self._lock:
+            self._forget(key)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM responses")
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes}
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    return ResponseCache()
+
+EMPTY_REPLY_TEXT = "🤔 I received your message but couldn't generate a proper response. Could you try rephrasing?"
+
+class WebhookReplyError(Exception):
+    """A webhook answer that is not a reply; ``retry`` tells whether asking again may help"""
+
+    def __init__(self, message: str, retry: bool):
+        super().__init__(message)
+        self.retry = retry
+
+class OutboxDelivery:
+    """Hand-off between the first attempt at a prompt and the UI waiting for it.
+
+    The attempt pushes streamed text and then finishes or fails; the UI
+    waits for that within its budget and then either takes the result or
+    detaches, leaving the reply to be patched into the saved session.
+    """
+
+    def __init__(self, outbox_id: int):
+        self.outbox_id = outbox_id
+        self.reply = None
+        self.ok = False
+        self.error = None
+        self._chunks = queue.Queue()
+        self._done = threading.Event()
+        self._attempted = threading.Event()  # set when the first attempt finished or failed
+        self._detached = False
+        self._lock = threading.Lock()
+    
+    def put(self, text: str):
+        self._chunks.put(text)
+    
+    def finish(self, reply: str, ok: bool) -> bool:
+        """Record the reply; False when the UI already detached and the session needs patching"""
+        with self._lock:
+            if self._detached:
+                return False
+            self.reply, self.ok = reply, ok
+            self._done.set()
+        self._attempted.set()
+        self._chunks.put(None)
+        return True
+    
+    def fail(self, error: str, final: bool) -> bool:
+        """Record a failed attempt; retried ones detach the UI. Returns True if detached"""
+        with self._lock:
+            self.error = error
+            if final and not self._detached:
+                self.reply = error
+                self._done.set()
+            else:
+                self._detached = True
+        self._attempted.set()
+        self._chunks.put(None)
+        return self._detached
+    
+    def detach(self) -> bool:
+        """Stop waiting; True if the reply is now left to the outbox, False if it is already here"""
+        with self._lock:
+            if not self._done.is_set():
+                self._detached = True
+            return self._detached
+    
+    def wait(self, timeout: float) -> bool:
+        """Wait for the first attempt to end; True if it did within ``timeout``"""
+        return self._attempted.wait(timeout)
+    
+    def stream(self, idle_timeout: float):
+        """Yield streamed text until the attempt ends or no chunk arrives within ``idle_timeout``"""
+        while True:
+            try:
+                text = self._chunks.get(timeout=idle_timeout)
+            except queue.Empty:
+                if self.detach():
+                    return
+                continue  # finished just now; read the rest
+            if text is None:
+                return
+            yield text
+
+class WebhookOutbox:
+    """Durable queue of prompts whose webhook reply is still outstanding.
+
+    Every prompt is recorded in SQLite before it is sent, and the first
+    attempt runs on a worker thread so the UI only waits as long as it
+    chooses to. Slow attempts carry on after the UI has moved on; failed
+    ones are retried with jittered exponential backoff, also after a
+    restart. A reply that arrives after the UI detached is patched into the
+    stored session, replacing the placeholder message carrying its outbox
+    ID, and ``results`` lets open sessions patch their in-memory copies.
+    """
+
+    def __init__(self, dispatcher: "HedgedDispatcher", store, search_index: "SessionSearchIndex",
+                 path: str = WEBHOOK_OUTBOX_FILE, max_workers: int = WEBHOOK_OUTBOX_WORKERS):
+        self.dispatcher = dispatcher
+        self.store = store
+        self.search_index = search_index
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, urls TEXT NOT NULL, "
+                "payload TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt REAL NOT NULL DEFAULT 0, reply TEXT, error TEXT, "
+                "detached INTEGER NOT NULL DEFAULT 0, patched INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_state ON outbox (state, next_attempt)")
+            # Attempts cut short by a restart are retried
+            self._conn.execute("UPDATE outbox SET state = 'pending', detached = 1 WHERE state = 'sending'")
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="webhook-outbox")
+        self._thread = threading.Thread(target=self._run, name="webhook-outbox", daemon=True)
+        self._thread.start()
+    
+    def send(self, urls: List[str], payload: Dict) -> OutboxDelivery:
+        """Record a prompt and start its first attempt without waiting for it"""
+        now = time.time()
+        with self._lock, self._conn:
+            outbox_id = self._conn.execute(
+                "INSERT INTO outbox (session_id, urls, payload, state, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'sending', ?, ?)",
+                (payload["session_id"], json.dumps(urls), json.dumps(payload, default=_json_default), now, now)
+            ).lastrowid
+        delivery = OutboxDelivery(outbox_id)
+        # Never queued behind retries or other users' prompts
+        threading.Thread(
+            target=self._attempt, args=(outbox_id, urls, payload, delivery),
+            name=f"webhook-outbox-{outbox_id}", daemon=True
+        ).start()
+        return delivery
+    
+    def results(self, outbox_ids) -> Dict[int, str]:
+        """Final text of the given entries that are settled: the reply, or the last error"""
+        outbox_ids = list(outbox_ids)
+        if not outbox_ids:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, reply FROM outbox WHERE id IN ({','.join('?' * len(outbox_ids))}) "
+                "AND state IN ('delivered', 'failed')",
+                outbox_ids
+            ).fetchall()
+        return dict(rows)
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall()
+        return dict(rows)
+    
+    def _attempt(self, outbox_id: int, urls: List[str], payload: Dict, delivery: Optional[OutboxDelivery] = None):
+        try:
+            response = self.dispatcher.post(
+                urls,
+                json=payload,
+                headers={
+                    'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream, application/x-ndjson, application/json, text/plain'
+                }
+            )
+            with response:
+                if response.status_code != 200:
+                    raise WebhookReplyError(
+                        f"❌ AI service returned status {response.status_code}. Please try again later.",
+                        retry=response.status_code in OUTBOX_RETRY_STATUSES
+                    )
+                parts = []
+                for text in _iter_reply_text(response):
+                    parts.append(text)
+                    if delivery is not None:
+                        delivery.put(text)
+            reply = "".join(parts)
+            ok = bool(reply.strip())
+            self._settle(outbox_id, "delivered", reply if ok else EMPTY_REPLY_TEXT, None,
+                         delivery is None or not delivery.finish(reply if ok else EMPTY_REPLY_TEXT, ok))
+        except Exception as e:
+            self._failed(outbox_id, urls, e, delivery)
+    
+    def _failed(self, outbox_id: int, urls: List[str], error: Exception, delivery: Optional[OutboxDelivery]):
+        message = _webhook_error_message(error, urls, self.dispatcher.client)
+        # Only failures where the workflow cannot have run are retried; anything
+        # else (read timeouts, resets after sending, 500/504) settles with the error
+        if isinstance(error, WebhookReplyError):
+            retry = error.retry
+        elif isinstance(error, CircuitOpenError):
+            retry = True
+        else:
+            retry = isinstance(error, requests.exceptions.ConnectionError) and _failed_before_sending(error)
+        with self._lock:
+            attempts = self._conn.execute("SELECT attempts FROM outbox WHERE id = ?", (outbox_id,)).fetchone()[0] + 1
+        final = not retry or attempts >= OUTBOX_MAX_ATTEMPTS
+        detached = delivery is None or delivery.fail(message, final)
+        if final:
+            self._settle(outbox_id, "failed", message, message, detached, attempts)
+            return
+        delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE ** attempts) * random.uniform(0.5, 1.0)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET state = 'pending', attempts = ?, next_attempt = ?, error = ?, detached = 1, "
+                "updated_at = ? WHERE id = ?",
+                (attempts, time.time() + delay, message, time.time(), outbox_id)
+            )
+    
+    def _settle(self, outbox_id: int, state: str, reply: str, error: Optional[str], detached: bool,
+                attempts: Optional[int] = None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE outbox SET state = ?, reply = ?, error = ?, detached = ?, patched = ?, "
+                "attempts = COALESCE(?, attempts + 1), updated_at = ? WHERE id = ?",
+                (state, reply, error, int(detached), int(not detached), attempts, time.time(), outbox_id)
+            )
+            row = self._conn.execute("SELECT session_id FROM outbox WHERE id = ?", (outbox_id,)).fetchone()
+        if detached and self._patch_session(row[0], outbox_id, reply):
+            self._mark_patched(outbox_id)
+    
+    def _mark_patched(self, outbox_id: int):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE outbox SET patched = 1 WHERE id = ?", (outbox_id,))
+    
+    def _patch_session(self, session_id: str, outbox_id: int, text: str) -> bool:
+        """Replace the stored placeholder for an entry with its final text; False if it isn't saved yet"""
+        try:
+            # Patched in place by the store, never rewritten from an older snapshot
+            if not self.store.patch_message(session_id, outbox_id, text):
+                return False
+        except Exception:
+            return False
+        # The tail may be unchanged, so the patched message is only found after a full reindex
+        index_session_quietly(self.search_index, self.store, session_id, reindex=True)
+        return True
+    
+    def _run(self):
+        while True:
+            time.sleep(OUTBOX_POLL_SECONDS)
+            now = time.time()
+            try:
+                with self._lock, self._conn:
+                    due = self._conn.execute(
+                        "SELECT id, urls, payload FROM outbox WHERE state = 'pending' AND next_attempt <= ?", (now,)
+                    ).fetchall()
+                    self._conn.executemany(
+                        "UPDATE outbox SET state = 'sending', updated_at = ? WHERE id = ?",
+                        [(now, outbox_id) for outbox_id, _, _ in due]
+                    )
+                    unpatched = self._conn.execute(
+                        "SELECT id, session_id, reply, created_at FROM outbox "
+                        "WHERE state IN ('delivered', 'failed') AND detached = 1 AND patched = 0"
+                    ).fetchall()
+                    self._conn.execute(
+                        "DELETE FROM outbox WHERE state IN ('delivered', 'failed') AND updated_at < ?",
+                        (now - OUTBOX_RETENTION,)
+                    )
+            except sqlite3.Error:
+                continue
+            
+            for outbox_id, urls, payload in due:
+                self._executor.submit(self._attempt, outbox_id, json.loads(urls), json.loads(payload))
+            # Placeholders saved after their reply arrived; give up on ones that never were
+            for outbox_id, session_id, reply, created_at in unpatched:
+                if self._patch_session(session_id, outbox_id, reply) or now - created_at > OUTBOX_PATCH_WINDOW:
+                    self._mark_patched(outbox_id)
+
+@st.cache_resource
+def get_webhook_outbox() -> WebhookOutbox:
+    return WebhookOutbox(get_webhook_dispatcher(), get_session_store(), get_search_index())
+
+def build_ai_payload(prompt: str) -> Dict:
+    """Build the webhook payload for a prompt with budgeted conversation context"""
+    recent_context, summary = build_context(
+        st.session_state.messages,
+        st.session_state.user_info['role'],
+        st.session_state.get("context_summary")
+    )
+    # Saved with the session, so the next prompt only folds in what is new
+    st.session_state.context_summary = summary
+    customers = get_customer_dataset().aggregates()
+    
+    return {
+        "message": prompt,
+        "user_id": st.session_state.username,
+        "user_name": st.session_state.user_info['name'],
+        "user_role": st.session_state.user_info['role'],
+        "user_team": st.session_state.user_info['team'],
+        "timestamp": datetime.now().isoformat(),
+        "customer_count": customers["customer_count"],
+        "active_customers": customers["active_customers"],
+        "customers_by_segment": customers["customers_by_segment"],
+        "system": "laundry_crm",
+        "session_id": st.session_state.current_session_id,
+        "message_count": len(st.session_state.messages),
+        "context": recent_context,
+        "context_summary": summary["text"]
+    }
+
+def _circuit_open_message(webhook_urls: List[str], client: Optional[WebhookClient] = None) -> str:
+    client = client or get_webhook_client()
+    retry_after = min(client.breaker(url).retry_after() for url in webhook_urls)
+    return f"🚧 The AI service is currently unavailable. Please try again in {int(retry_after) + 1} seconds."
+
+def _webhook_error_message(error: Exception, webhook_urls: List[str], client: Optional[WebhookClient] = None) -> str:
+    """User-facing text for a failed webhook call"""
+    if isinstance(error, WebhookReplyError):
+        return str(error)
+    if isinstance(error, CircuitOpenError):
+        return _circuit_open_message(webhook_urls, client)
+    if isinstance(error, requests.exceptions.Timeout):
+        return "⏱️ Request timed out. The AI might be processing a complex query. Please try again."
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return "🔌 Connection error. Please check your internet connection and try again."
+    return f"⚠️ Unexpected error: {str(error)}"
+
+def _pending_reply_text(error: Optional[str] = None) -> str:
+    text = "⏳ Lil J is still working on this. The reply will appear here when it arrives."
+    if error:
+        text += f"\n\n_Last attempt: {error}_"
+    return text
+
+def _delivery_reply(delivery: OutboxDelivery, outcome: Optional[Dict]) -> Optional[str]:
+    """The reply the UI waited for, or None once it is left to the outbox (``outcome["outbox_id"]``)"""
+    if delivery.detach():
+        if outcome is not None:
+            outcome["outbox_id"] = delivery.outbox_id
+        return None
+    if delivery.ok and outcome is not None:
+        outcome["ok"] = True
+    return delivery.reply
+
+def send_message_to_ai(prompt: str, webhook_urls: List[str], outcome: Optional[Dict] = None) -> str:
+    """Send message to AI and return response, waiting at most ``WEBHOOK_UI_WAIT_SECONDS``.
+
+    ``outcome["ok"]`` is set when the webhook produced a real answer. If
+    the reply is slow or the call failed and will be retried, a placeholder
+    is returned and ``outcome["outbox_id"]`` identifies the pending reply.
+    """
     try:
-        if isinstance(timestamp, str):
-            dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-        else:
-            dt = timestamp
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
-    except:
-        return str(timestamp)
+        with st.spinner("🤖 Lil J is thinking..."):
+            delivery = get_webhook_outbox().send(webhook_urls, build_ai_payload(prompt))
+            delivery.wait(WEBHOOK_UI_WAIT_SECONDS)
+        bot_response = _delivery_reply(delivery, outcome)
+        return bot_response if bot_response is not None else _pending_reply_text(delivery.error)
+    except Exception as e:
+        return f"⚠️ Unexpected error: {str(e)}"
 
-def truncate_message(message: str, max_length: int = 100) -> str:
-    """Truncate message for preview"""
-    if len(message) <= max_length:
-        return message
-    return message[:max_length] + "..."
+def _iter_sse_data(response):
+    """Yield the data payload of each Server-Sent Event in a streamed response"""
+    data_lines = []
+    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+        if line == "":
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+        elif line.startswith("data:"):
+            data = line[5:]
+            data_lines.append(data[1:] if data.startswith(" ") else data)
+    if data_lines:
+        yield "\n".join(data_lines)
 
-# ----------------------------
-# Session State Initialization
-# ----------------------------
-def initialize_session_state():
-    """Initialize all session state variables"""
-    
-    # User information
-    if "user_info" not in st.session_state:
-        st.session_state.user_info = {
-            "name": "Guest",
-            "role": "Visitor", 
-            "team": "Unknown"
-        }
+def _iter_json_lines(response):
+    """Yield the reply text of NDJSON lines as they arrive.
 
-    if "username" not in st.session_state:
-        st.session_state.username = "guest_user"
+    A body that is not NDJSON (pretty-printed JSON), or whose lines carry no
+    reply text an extractor recognises, goes whole through
+    ``extract_plain_text`` at the end, so unknown shapes come back as the raw
+    body just as they do for a non-streamed reply.
+    """
+    lines = response.iter_lines(chunk_size=None, decode_unicode=True)
+    held = []  # raw lines, until one of them carries reply text
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            data = decode_json(line)
+        except (ValueError, TypeError):
+            # Pretty-printed JSON spread over several lines: wait for the full body
+            yield extract_plain_text("\n".join([*(held or []), line, *lines]))
+            return
+        text = _decoded_chunk_text(data, line)
+        if text is None:
+            if held is not None:
+                held.append(line)
+            continue
+        held = None
+        yield text
+    if held:
+        yield extract_plain_text("\n".join(held))
 
-    if "customers_df" not in st.session_state:
-        st.session_state.customers_df = []
+def _iter_reply_text(response):
+    """Yield the text of a 200 webhook response piece by piece.
 
-    # Chat-related state
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-    
-    if "current_session_id" not in st.session_state:
-        st.session_state.current_session_id = generate_session_id(st.session_state.user_info)
-    
-    if "chat_sessions" not in st.session_state:
-        st.session_state.chat_sessions = load_chat_sessions()
-    
-    if "selected_session" not in st.session_state:
-        st.session_state.selected_session = None
+    Server-Sent Events and chunked NDJSON replies are yielded chunk by chunk,
+    other chunked bodies as raw text pieces; tags split across chunks are
+    stripped by ``strip_html_tags_stream``. A regular single JSON body is
+    yielded once.
+    """
+    content_type = response.headers.get('Content-Type', '').lower()
+    if 'charset' not in content_type:
+        response.encoding = 'utf-8'
     
-    if "auto_save" not in st.session_state:
-        st.session_state.auto_save = True
+    if 'text/event-stream' in content_type:
+        texts = (extract_stream_chunk(data) for data in _iter_sse_data(response) if data != "[DONE]")
+    elif 'json' in content_type:
+        texts = _iter_json_lines(response)
+    else:
+        # Chunk boundaries of other bodies are arbitrary, so pieces are text, never JSON
+        texts = response.iter_content(chunk_size=None, decode_unicode=True)
     
-    if "message_count" not in st.session_state:
-        st.session_state.message_count = 0
+    yield from strip_html_tags_stream(texts)
+
+def stream_message_to_ai(prompt: str, webhook_urls: List[str], outcome: Optional[Dict] = None):
+    """Send message to AI and yield the reply text as it arrives.
+
+    Waits at most ``WEBHOOK_UI_WAIT_SECONDS`` for each next chunk. After
+    that, or when the call failed and will be retried, a placeholder is
+    yielded and ``outcome["outbox_id"]`` identifies the pending reply.
+    ``outcome["ok"]`` is set once the full answer has been received.
+    """
+    try:
+        delivery = get_webhook_outbox().send(webhook_urls, build_ai_payload(prompt))
+        produced = False
+        for text in delivery.stream(WEBHOOK_UI_WAIT_SECONDS):
+            produced = True
+            yield text
+        
+        bot_response = _delivery_reply(delivery, outcome)
+        if bot_response is None:
+            yield ("\n\n" if produced else "") + _pending_reply_text(delivery.error)
+        elif not produced or not delivery.ok:
+            # Errors and empty replies are not streamed
+            yield bot_response
+    except Exception as e:
+        yield f"⚠️ Unexpected error: {str(e)}"
+
+def respond_to_prompt(prompt: str, webhook_urls: List[str]) -> Dict:
+    """Get, display and return the assistant message for a prompt"""
+    cache = get_response_cache() if st.session_state.response_cache_enabled else None
+    cache_key = cache.make_key(prompt, st.session_state.user_info) if cache else None
+    cached_response = cache.get(cache_key) if cache else None
+    outcome = {}
     
-    if "last_activity" not in st.session_state:
-        st.session_state.last_activity = datetime.now().isoformat()
+    if cached_response is not None:
+        bot_response = cached_response
+        with st.chat_message("assistant"):
+            st.markdown(f'<div class="assistant-message">{bot_response}</div>', 
+                      unsafe_allow_html=True)
+            timestamp = datetime.now().isoformat()
+            st.caption(f"⏰ {format_timestamp(timestamp)} · ⚡ cached")
+    elif st.session_state.stream_responses:
+        # Render the reply token by token as the webhook streams it
+        with st.chat_message("assistant"):
+            bot_response = st.write_stream(stream_message_to_ai(prompt, webhook_urls, outcome))
+            timestamp = datetime.now().isoformat()
+            st.caption(f"⏰ {format_timestamp(timestamp)}")
+    else:
+        bot_response = send_message_to_ai(prompt, webhook_urls, outcome)
+        
+        # Display assistant response
+        with st.chat_message("assistant"):
+            st.markdown(f'<div class="assistant-message">{bot_response}</div>', 
+                      unsafe_allow_html=True)
+            timestamp = datetime.now().isoformat()
+            st.caption(f"⏰ {format_timestamp(timestamp)}")
     
-    # Google Drive related state
-    if "drive_enabled" not in st.session_state:
-        st.session_state.drive_enabled = False
+    if cache_key:
+        st.session_state.last_cache_key = cache_key
+        if outcome.get("ok"):
+            cache.put(cache_key, bot_response)
     
-    if "drive_auto_sync" not in st.session_state:
-        st.session_state.drive_auto_sync = True
+    assistant_message = {
+        "role": "assistant", 
+        "content": bot_response,
+        "timestamp": timestamp
+    }
+    if cached_response is not None:
+        assistant_message["cached"] = True
+    if outcome.get("outbox_id"):
+        # Replaced by the real reply once the outbox delivers it
+        assistant_message["outbox_id"] = outcome["outbox_id"]
+        st.session_state.pending_replies.add(outcome["outbox_id"])
+    return assistant_message
 
 # ----------------------------
-# Chat Session Management
+# Google Drive UI Components
 # ----------------------------
-def save_current_session():
-    """Save the current chat session"""
-    if not st.session_state.messages:
-        return
+def _session_digest(session_data: Dict) -> str:
+    return hashlib.sha256(json.dumps(session_data, sort_keys=True, default=_json_default).encode()).hexdigest()[:16]
+
+def _message_key(message: Dict) -> tuple:
+    """Identity of a message across copies of a session: who said it and when"""
+    if message.get("timestamp"):
+        return (message.get("role"), str(message["timestamp"]))
+    return (None, _message_fingerprint(message))
+
+def merge_sessions(local: Optional[Dict], remote: Dict) -> Optional[Dict]:
+    """Merge a remote copy of a session into the local one; None when local already has it all.
+
+    Messages are matched by role and timestamp, so a copy edited in place
+    (a placeholder patched with its delivered reply) is one message, not
+    two; where only one side still has the placeholder the delivered text
+    wins. The union is kept in timestamp order; metadata comes from
+    whichever copy was active more recently.
+    """
+    if not local:
+        return remote
     
-    session_data = {
-        "messages": st.session_state.messages.copy(),
-        "user_info": st.session_state.user_info.copy(),
-        "created_at": st.session_state.get("session_created_at", datetime.now().isoformat()),
-        "last_activity": datetime.now().isoformat(),
-        "message_count": len(st.session_state.messages),
-        "session_name": f"Chat with {st.session_state.user_info['name']} - {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-    }
+    local_messages = list(local.get("messages", []))
+    position = {_message_key(message): index for index, message in enumerate(local_messages)}
+    missing = []
+    replaced = False
+    for message in remote.get("messages", []):
+        index = position.get(_message_key(message))
+        if index is None:
+            missing.append(message)
+        elif "outbox_id" in local_messages[index] and "outbox_id" not in message:
+            local_messages[index] = message
+            replaced = True
+    remote_newer = str(remote.get("last_activity", "")) > str(local.get("last_activity", ""))
+    if not missing and not replaced and not remote_newer:
+        return None
     
-    st.session_state.chat_sessions[st.session_state.current_session_id] = session_data
-    save_chat_sessions(st.session_state.chat_sessions, st.session_state.get('drive_auto_sync', True))
+    messages = local_messages + missing
+    if missing and all("timestamp" in message for message in messages):
+        messages.sort(key=lambda message: message["timestamp"])
+    
+    merged = {k: v for k, v in (remote if remote_newer else local).items() if k != "messages"}
+    merged["messages"] = messages
+    merged["message_count"] = len(messages)
+    created = [str(c) for c in (local.get("created_at"), remote.get("created_at")) if c]
+    if created:
+        merged["created_at"] = min(created)
+    return merged
 
-def load_session(session_id: str):
-    """Load a specific chat session"""
-    if session_id in st.session_state.chat_sessions:
-        session_data = st.session_state.chat_sessions[session_id]
-        st.session_state.messages = session_data["messages"].copy()
-        st.session_state.user_info = session_data["user_info"].copy()
-        st.session_state.current_session_id = session_id
-        st.session_state.selected_session = session_id
-        st.rerun()
+def _merge_remote_sessions(sessions, previous_digests: Dict) -> tuple:
+    """Merge ``(session_id, session_data)`` pairs into the store, skipping ones seen before.
 
-def create_new_session():
-    """Create a new chat session"""
-    if st.session_state.auto_save and st.session_state.messages:
-        save_current_session()
-    
-    st.session_state.messages = []
-    st.session_state.current_session_id = generate_session_id(st.session_state.user_info) + f"_{int(time.time())}"
-    st.session_state.session_created_at = datetime.now().isoformat()
-    st.session_state.selected_session = None
-    st.rerun()
+    Returns ``(changed_ids, digests, failed_ids)``; only sessions whose merge
+    changed something are written, and ``digests`` leaves out those whose
+    write failed so the next pull merges them again.
+    """
+    store, archive = get_session_store(), get_session_archive()
+    changed, digests, failed = [], {}, set()
+    for session_id, remote in sessions:
+        digest = _session_digest(remote)
+        if previous_digests.get(session_id) != digest:
+            local = store.get_session(session_id) or archive.get(session_id)
+            merged = merge_sessions(local, remote)
+            if merged is not None:
+                # A placeholder replaced or a message merged in before the tail changes stored history
+                local_messages = list(local.get("messages", [])) if local else []
+                rewrite = merged["messages"][:len(local_messages)] != local_messages
+                if not save_chat_sessions({session_id: merged}, False, rewrite=rewrite):  # Don't auto-upload
+                    failed.add(session_id)
+                    continue
+                changed.append(session_id)
+        digests[session_id] = digest
+    return changed, digests, failed
 
-def delete_session(session_id: str):
-    """Delete a chat session"""
-    if session_id in st.session_state.chat_sessions:
-        del st.session_state.chat_sessions[session_id]
-        save_chat_sessions(st.session_state.chat_sessions, st.session_state.get('drive_auto_sync', True))
-        if st.session_state.current_session_id == session_id:
-            create_new_session()
-        st.rerun()
+def pull_drive_file(drive_manager: GoogleDriveManager, file_id: str) -> Optional[List[str]]:
+    """Merge a Drive session file (JSON snapshot or .ndjson.gz archive) into local sessions.
 
-# ----------------------------
-# AI Communication
-# ----------------------------
-def send_message_to_ai(prompt: str, webhook_url: str) -> str:
-    """Send message to AI and return response"""
+    Skips the download entirely when the file's checksum and modification
+    time match the last pull. Returns the IDs of sessions that changed, or
+    None on error.
+    """
     try:
-        with st.spinner("🤖 Lil J is thinking..."):
-            recent_context = []
-            if len(st.session_state.messages) > 0:
-                recent_messages = st.session_state.messages[-5:]
-                for msg in recent_messages:
-                    recent_context.append({
-                        "role": msg["role"],
-                        "content": msg["content"][:200]
-                    })
-            
-            payload = {
-                "message": prompt,
-                "user_id": st.session_state.username,
-                "user_name": st.session_state.user_info['name'],
-                "user_role": st.session_state.user_info['role'],
-                "user_team": st.session_state.user_info['team'],
-                "timestamp": datetime.now().isoformat(),
-                "customer_count": len(st.session_state.customers_df),
-                "system": "laundry_crm",
-                "session_id": st.session_state.current_session_id,
-                "message_count": len(st.session_state.messages),
-                "context": recent_context
-            }
-            
-            response = requests.post(
-                webhook_url,
-                json=payload,
-                timeout=45,
-                headers={'Content-Type': 'application/json'}
-            )
+        cache = get_drive_download_cache()
+        file_meta = drive_manager.file_metadata(file_id)
+        if cache.unchanged(file_meta):
+            return []
+        
+        if file_meta["name"].endswith(".ndjson.gz"):
+            sessions = drive_manager.iter_archive_sessions(file_id)
+        else:
+            sessions = drive_manager._download_json(file_id).items()
+        changed, digests, failed = _merge_remote_sessions(sessions, cache.session_digests(file_id))
+        cache.record(file_meta, digests, complete=not failed)
+        cache.save()
+        return changed
+    except Exception as e:
+        st.error(f"Download error: {str(e)}")
+        return None
 
-            if response.status_code == 200:
-                bot_response = extract_plain_text(response.text)
-                if not bot_response or bot_response.strip() == "":
-                    bot_response = "🤔 I received your message but couldn't generate a proper response. Could you try rephrasing?"
-                return bot_response
-            else:
-                return f"❌ AI service returned status {response.status_code}. Please try again later."
+def pull_delta_sessions(drive_manager: GoogleDriveManager) -> Optional[List[str]]:
+    """Merge the per-session auto-sync files into local sessions.
 
-    except requests.exceptions.Timeout:
-        return "⏱️ Request timed out. The AI might be processing a complex query. Please try again."
-    except requests.exceptions.ConnectionError:
-        return "🔌 Connection error. Please check your internet connection and try again."
+    The manifest is skipped when unchanged, and only session files whose
+    content hash differs from the last pull are downloaded.
+    """
+    try:
+        cache = get_drive_download_cache()
+        manifest_meta = drive_manager.find_delta_manifest()
+        if manifest_meta is None or cache.unchanged(manifest_meta):
+            return []
+        
+        manifest = drive_manager._download_json(manifest_meta["id"])
+        pulled = cache.session_digests(manifest_meta["id"])
+        entries = manifest.get("sessions", {})
+        
+        def changed_sessions():
+            for session_id, entry in entries.items():
+                if pulled.get(session_id) != entry["hash"]:
+                    yield from drive_manager._download_json(entry["file_id"]).items()
+        
+        changed, _, failed = _merge_remote_sessions(changed_sessions(), {})
+        cache.record(
+            manifest_meta,
+            {session_id: entry["hash"] for session_id, entry in entries.items() if session_id not in failed},
+            complete=not failed
+        )
+        cache.save()
+        return changed
     except Exception as e:
-        return f"⚠️ Unexpected error: {str(e)}"
+        st.error(f"Download error: {str(e)}")
+        return None
 
-# ----------------------------
-# Google Drive UI Components
-# ----------------------------
+def _show_pull_result(changed: Optional[List[str]]):
+    if changed is None:
+        return
+    if not changed:
+        st.info("Already up to date.")
+        return
+    # Drop stale copies of the merged sessions from this user's cache
+    for session_id in changed:
+        if session_id in st.session_state.chat_sessions:
+            del st.session_state.chat_sessions[session_id]
+    st.success(f"Merged {len(changed)} changed sessions!")
+    st.rerun()
+
+@st.fragment(run_every=DRIVE_LISTING_POLL_SECONDS)
+def render_drive_file_list(drive_manager: GoogleDriveManager):
+    """Render the Drive folder's session files from the shared listing cache.
+
+    Never waits on Drive: a stale listing is refreshed in the background and
+    this fragment re-reads the cache every few seconds to show the result.
+    """
+    listing = get_drive_file_listing()
+    folder_id = drive_manager.folder_id
+    if st.button("🔄 Refresh list", key="refresh_drive_files"):
+        listing.invalidate(folder_id)
+    if listing.is_stale(folder_id):
+        listing.refresh_async(st.session_state.drive_credentials, folder_id)
+    
+    files = listing.files(folder_id)
+    status = listing.status(folder_id)
+    if status["error"]:
+        st.caption(f"⚠️ Couldn't refresh Drive files: {status['error']}")
+    
+    if files is None:
+        st.caption("Loading Drive files...")
+    elif files:
+        st.write("**Available session files:**")
+        for file_info in files[:10]:  # Show last 10 files
+            col1, col2 = st.columns([3, 1])
+            with col1:
+                file_name = truncate_message(file_info['name'], 25)
+                if st.button(f"📥 {file_name}", 
+                           key=f"download_{file_info['id']}",
+                           help=f"Modified: {format_timestamp(file_info['modifiedTime'])}"):
+                    if file_info['name'].endswith(".zip"):
+                        st.info("ZIP exports can't be restored here; use an .ndjson.gz archive.")
+                    else:
+                        _show_pull_result(pull_drive_file(drive_manager, file_info['id']))
+            with col2:
+                size_kb = round(int(file_info.get('size', 0)) / 1024, 1)
+                st.caption(f"{size_kb}KB")
+    else:
+        st.info("No session files found in Drive")
+
+@st.fragment
 def render_google_drive_section():
-    """Render Google Drive integration section in sidebar"""
-    st.sidebar.subheader("🔐 Authentication")
+    """Render Google Drive integration section; call inside ``with st.sidebar``.
+
+    Runs as a fragment so its buttons rerun only this panel; the Drive file
+    listing comes from the shared cache in ``render_drive_file_list``.
+    """
+    st.subheader("🔐 Authentication")
     
     drive_manager = get_drive_manager()
     
     # Check if already authenticated
     if st.session_state.get('drive_enabled', False):
-        st.sidebar.success("✅ Connected to Google Drive")
+        st.success("✅ Connected to Google Drive")
         
         # Auto-sync toggle
-        st.session_state.drive_auto_sync = st.sidebar.checkbox(
+        st.session_state.drive_auto_sync = st.checkbox(
             "Auto-sync to Drive", 
             value=st.session_state.get('drive_auto_sync', True)
         )
         
         # Manual sync button
-        if st.sidebar.button("🔄 Sync Now"):
+        if st.button("🔄 Sync Now"):
+            if drive_manager.initialize_from_session():
+                if drive_manager.upload_sessions(st.session_state.chat_sessions.snapshot()):
+                    invalidate_drive_listing()
+                    st.success("Synced to Drive!")
+                else:
+                    st.error("Sync failed")
+        
+        # Compressed archive of the whole store, streamed session by session
+        pending_upload = drive_manager.pending_archive_upload()
+        if pending_upload:
+            if st.button(f"▶️ Resume archive upload ({pending_upload.progress:.0%})"):
+                if drive_manager.initialize_from_session() and drive_manager.resume_archive_upload():
+                    invalidate_drive_listing()
+                    st.success("Archive uploaded to Drive!")
+            if st.button("🗑️ Discard archive upload"):
+                drive_manager.discard_archive_upload()
+                st.rerun()
+        elif st.button("🗜️ Archive to Drive"):
             if drive_manager.initialize_from_session():
-                if drive_manager.upload_sessions(st.session_state.chat_sessions):
-                    st.sidebar.success("Synced to Drive!")
+                if drive_manager.upload_sessions_archive(
+                    iter_export_sessions(get_session_store(), get_session_archive())
+                ):
+                    invalidate_drive_listing()
+                    st.success("Archive uploaded to Drive!")
                 else:
-                    st.sidebar.error("Sync failed")
+                    st.error("Archive upload failed")
         
         # View Drive files
-        with st.sidebar.expander("📁 Drive Files", expanded=False):
+        with st.expander("📁 Drive Files", expanded=False):
             if drive_manager.initialize_from_session():
-                files = drive_manager.list_session_files()
+                render_drive_file_list(drive_manager)
                 
-                if files:
-                    st.write("**Available session files:**")
-                    for file_info in files[:10]:  # Show last 10 files
-                        col1, col2 = st.columns([3, 1])
-                        with col1:
-                            file_name = truncate_message(file_info['name'], 25)
-                            if st.button(f"📥 {file_name}", 
-                                       key=f"download_{file_info['id']}",
-                                       help=f"Modified: {format_timestamp(file_info['modifiedTime'])}"):
-                                downloaded_sessions = drive_manager.download_sessions(file_info['id'])
-                                if downloaded_sessions:
-                                    st.session_state.chat_sessions.update(downloaded_sessions)
-                                    save_chat_sessions(st.session_state.chat_sessions, False)  # Don't auto-upload
-                                    st.success(f"Loaded {len(downloaded_sessions)} sessions!")
-                                    st.rerun()
-                        with col2:
-                            size_kb = round(int(file_info.get('size', 0)) / 1024, 1)
-                            st.caption(f"{size_kb}KB")
-                else:
-                    st.info("No session files found in Drive")
+                if DRIVE_SYNC_MODE == "delta" and st.button("📥 Restore from auto-sync", key="download_delta"):
+                    _show_pull_result(pull_delta_sessions(drive_manager))
         
         # Disconnect option
-        if st.sidebar.button("🔌 Disconnect Drive"):
+        if st.button("🔌 Disconnect Drive"):
+            drive_manager.discard_archive_upload()
+            if st.session_state.get('drive_credentials'):
+                get_drive_client_pool().invalidate(st.session_state.drive_credentials)
             st.session_state.drive_enabled = False
             st.session_state.drive_credentials = None
             st.session_state.drive_folder_id = None
@@ -540,9 +4454,9 @@ def render_google_drive_section():
     
     else:
         # Simple service account upload
-        st.sidebar.info("Upload service_account.json")
+        st.info("Upload service_account.json")
         
-        uploaded_file = st.sidebar.file_uploader(
+        uploaded_file = st.file_uploader(
             "Drag and drop file here",
             type=['json'],
             help="Limit 200MB per file • JSON For google drive"
@@ -556,50 +4470,91 @@ def render_google_drive_section():
                 with st.spinner("🔄 Authenticating with Google Drive..."):
                     if drive_manager.authenticate_service_account(service_account_content):
                         st.session_state.drive_enabled = True
-                        st.sidebar.success("✅ Google Drive connected successfully!")
+                        st.success("✅ Google Drive connected successfully!")
                         time.sleep(1)
                         st.rerun()
                     else:
-                        st.sidebar.error("❌ Authentication failed")
+                        st.error("❌ Authentication failed")
                         
             except Exception as e:
-                st.sidebar.error(f"❌ Error reading file: {str(e)}")
+                st.error(f"❌ Error reading file: {str(e)}")
 
 # ----------------------------
 # Enhanced UI Components
 # ----------------------------
-def render_sidebar():
-    """Render the enhanced sidebar with Google Drive integration"""
-    st.sidebar.subheader("🔗 AI Webhook Settings")
-    webhook_url = st.sidebar.text_input("Enter N8N Webhook URL:", value=DEFAULT_N8N_WEBHOOK)
-    
-    # Google Drive Integration
-    render_google_drive_section()
+class RenderedMessageCache:
+    """LRU of rendered message HTML and timestamp captions shared by all reruns.
+
+    Entries are keyed by session, position, role, timestamp and a hash of the
+    content, so a message is formatted once and reused until it changes, and
+    browser sessions sharing a session id (e.g. Guest users) never see each
+    other's messages. ``str`` caches its hash, so repeat lookups stay cheap.
+    """
+
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
     
-    st.sidebar.subheader("👤 User Settings")
-    with st.sidebar.expander("Edit User Info", expanded=False):
-        new_name = st.text_input("Name:", value=st.session_state.user_info['name'])
-        new_role = st.selectbox("Role:", 
-                               ["Visitor", "Customer", "Manager", "Technician", "Admin"],
-                               index=["Visitor", "Customer", "Manager", "Technician", "Admin"].index(st.session_state.user_info['role']) if st.session_state.user_info['role'] in ["Visitor", "Customer", "Manager", "Technician", "Admin"] else 0)
-        new_team = st.text_input("Team:", value=st.session_state.user_info['team'])
+    def get(self, session_id: str, index: int, message: Dict) -> tuple:
+        """Return ``(html, caption)`` for a message; caption is None without a timestamp"""
+        key = (session_id, index, message["role"], message.get("timestamp"), hash(message["content"]))
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+                return rendered
         
-        if st.button("Update User Info"):
-            st.session_state.user_info.update({
-                "name": new_name,
-                "role": new_role,
-                "team": new_team
-            })
-            st.success("User info updated!")
-            st.rerun()
+        css_class = "assistant-message" if message["role"] == "assistant" else "user-message"
+        html = f'<div class="{css_class}">{message["content"]}</div>'
+        caption = f"⏰ {format_timestamp(message['timestamp'])}" if "timestamp" in message else None
+        with self._lock:
+            self._entries[key] = (html, caption)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return html, caption
+
+@st.cache_resource
+def get_rendered_message_cache() -> RenderedMessageCache:
+    return RenderedMessageCache()
+
+def _load_earlier_messages():
+    st.session_state.transcript_window += TRANSCRIPT_PAGE_SIZE
+
+def render_transcript():
+    """Render the last ``transcript_window`` messages of the current session"""
+    messages = st.session_state.messages
+    start = max(0, len(messages) - st.session_state.transcript_window)
+    
+    if start > 0:
+        st.button(
+            f"⬆️ Load earlier messages ({start} more)",
+            key="load_earlier_messages",
+            on_click=_load_earlier_messages
+        )
     
-    st.sidebar.subheader("💬 Chat Sessions")
+    render_cache = get_rendered_message_cache()
+    for index in range(start, len(messages)):
+        message = messages[index]
+        html, caption = render_cache.get(st.session_state.current_session_id, index, message)
+        with st.chat_message(message["role"]):
+            st.markdown(html, unsafe_allow_html=True)
+            if caption:
+                st.caption(caption)
+
+@st.fragment
+def render_session_list():
+    """Render chat session controls and recent sessions; call inside ``with st.sidebar``"""
+    if st.session_state.pop("rerun_app", False):
+        st.rerun()
+    
+    st.subheader("💬 Chat Sessions")
     
     # Auto-save toggle
-    st.session_state.auto_save = st.sidebar.checkbox("Auto-save sessions", value=st.session_state.auto_save)
+    st.session_state.auto_save = st.checkbox("Auto-save sessions", value=st.session_state.auto_save)
     
     # Session management buttons
-    col1, col2 = st.sidebar.columns(2)
+    col1, col2 = st.columns(2)
     with col1:
         if st.button("🆕 New Chat", use_container_width=True):
             create_new_session()
@@ -608,22 +4563,51 @@ def render_sidebar():
             save_current_session()
             st.success("Session saved!")
     
-    # Display chat sessions
-    if st.session_state.chat_sessions:
-        st.sidebar.write("**Previous Sessions:**")
+    # Search past conversations
+    query = st.text_input("🔎 Search chats", key="session_search", placeholder="Words from any message...")
+    if query:
+        search_index = get_search_index()
+        with st.expander("Search filters", expanded=False):
+            roles, teams = search_index.facets()
+            role = st.selectbox("Role:", ["Any"] + roles, key="search_role")
+            team = st.selectbox("Team:", ["Any"] + teams, key="search_team")
+            date_range = st.date_input("Date range:", value=(), key="search_dates")
         
-        sorted_sessions = sorted(
-            st.session_state.chat_sessions.items(),
-            key=lambda x: x[1].get("last_activity", ""),
-            reverse=True
+        start = end = None
+        if len(date_range) >= 1:
+            start = date_range[0].isoformat()
+            end = (date_range[-1] + timedelta(days=1)).isoformat()
+        results = search_index.search(
+            query,
+            role=None if role == "Any" else role,
+            team=None if team == "Any" else team,
+            start=start,
+            end=end
         )
         
-        for session_id, session_data in sorted_sessions[:10]:
+        if results:
+            for result in results:
+                session_id = result["session_id"]
+                session_name = result["session_name"] or f"Session {session_id[:8]}"
+                if st.button(f"🔎 {truncate_message(session_name, 24)}", key=f"search_{session_id}",
+                             help=f"Last activity: {format_timestamp(result['timestamp'])}",
+                             use_container_width=True):
+                    load_session(session_id)
+                st.caption(result["snippet"])
+        else:
+            st.caption("No matching messages.")
+    
+    # Display chat sessions
+    recent_sessions = get_session_store().recent_sessions(10)
+    if recent_sessions:
+        st.write("**Previous Sessions:**")
+        
+        for session_id, session_data in recent_sessions:
             session_name = session_data.get("session_name", f"Session {session_id[:8]}")
             message_count = session_data.get("message_count", 0)
             last_activity = session_data.get("last_activity", "")
             
-            with st.sidebar.container():
+            with st.container():
                 col1, col2, col3 = st.columns([3, 1, 1])
                 
                 with col1:
@@ -637,32 +4621,233 @@ def render_sidebar():
                     st.write(f"{message_count}")
                 
                 with col3:
-                    if st.button("🗑️", key=f"delete_{session_id}", help="Delete session"):
-                        delete_session(session_id)
+                    st.button("🗑️", key=f"delete_{session_id}", help="Delete session",
+                              on_click=delete_session, args=(session_id,))
+
+def render_sidebar():
+    """Render the enhanced sidebar with Google Drive integration"""
+    st.sidebar.subheader("🔗 AI Webhook Settings")
+    webhook_url = st.sidebar.text_input("Enter N8N Webhook URL:", value=DEFAULT_N8N_WEBHOOK)
+    fallback_urls = st.sidebar.text_area(
+        "Fallback webhook URLs (one per line):",
+        value="",
+        help="Equivalent n8n endpoints; a slow primary is hedged to the fastest of these"
+    )
+    webhook_urls = [url.strip() for url in [webhook_url, *fallback_urls.splitlines()] if url.strip()]
+    
+    if len(webhook_urls) > 1:
+        with st.sidebar.expander("📈 Endpoint Latency", expanded=False):
+            dispatcher = get_webhook_dispatcher()
+            for url in dispatcher.rank(webhook_urls):
+                endpoint = dispatcher.stats(url)
+                p95 = endpoint.percentile(0.95)
+                st.caption(
+                    f"{truncate_message(url, 40)} · p95 {f'{p95:.2f}s' if p95 is not None else 'n/a'} · "
+                    f"{endpoint.successes} ok / {endpoint.failures} failed"
+                )
+    st.session_state.stream_responses = st.sidebar.checkbox(
+        "Stream responses",
+        value=st.session_state.stream_responses,
+        help="Show the reply as it arrives when the webhook streams (SSE or chunked NDJSON)"
+    )
+    st.session_state.response_cache_enabled = st.sidebar.checkbox(
+        "⚡ Cache repeated questions",
+        value=st.session_state.response_cache_enabled,
+        help="Answer repeated questions from the same role and team from cache"
+    )
+    if st.session_state.response_cache_enabled:
+        with st.sidebar.expander("⚡ Response Cache", expanded=False):
+            cache = get_response_cache()
+            cache_stats = cache.stats()
+            col1, col2 = st.columns(2)
+            col1.metric("Hits", cache_stats["hits"])
+            col2.metric("Misses", cache_stats["misses"])
+            st.caption(f"{cache_stats['entries']} answers in memory ({round(cache_stats['bytes'] / 1024, 1)}KB)")
+            if st.session_state.get("last_cache_key") and st.button("🚫 Forget last answer"):
+                cache.invalidate(st.session_state.last_cache_key)
+                st.session_state.last_cache_key = None
+                st.success("Last answer removed from cache")
+            if st.button("🧹 Clear cache"):
+                cache.clear()
+                st.success("Response cache cleared")
+    
+    # Google Drive Integration
+    with st.sidebar:
+        render_google_drive_section()
+    
+    st.sidebar.subheader("👤 User Settings")
+    with st.sidebar.expander("Edit User Info", expanded=False):
+        new_name = st.text_input("Name:", value=st.session_state.user_info['name'])
+        new_role = st.selectbox("Role:", 
+                               ["Visitor", "Customer", "Manager", "Technician", "Admin"],
+                               index=["Visitor", "Customer", "Manager", "Technician", "Admin"].index(st.session_state.user_info['role']) if st.session_state.user_info['role'] in ["Visitor", "Customer", "Manager", "Technician", "Admin"] else 0)
+        new_team = st.text_input("Team:", value=st.session_state.user_info['team'])
+        
+        if st.button("Update User Info"):
+            st.session_state.user_info = {
+                **st.session_state.user_info,
+                "name": new_name,
+                "role": new_role,
+                "team": new_team
+            }
+            st.success("User info updated!")
+            st.rerun()
     
-    return webhook_url
+    with st.sidebar:
+        render_session_list()
+    
+    return webhook_urls
 
+@st.fragment(run_every=STATS_REFRESH_SECONDS)
 def render_chat_stats():
-    """Render enhanced chat statistics with Drive status"""
+    """Render enhanced chat statistics with Drive status; refreshes on its own timer"""
     col1, col2, col3, col4, col5 = st.columns(5)
+    total_sessions, total_messages = get_session_store().totals()
     
     with col1:
         st.metric("Current Messages", len(st.session_state.messages))
     
     with col2:
-        st.metric("Total Sessions", len(st.session_state.chat_sessions))
+        st.metric("Total Sessions", total_sessions)
     
     with col3:
-        total_messages = sum(session.get("message_count", 0) for session in st.session_state.chat_sessions.values())
         st.metric("Total Messages", total_messages)
     
     with col4:
-        st.metric("Customers", len(st.session_state.customers_df))
+        customers = get_customer_dataset()
+        st.metric("Customers", customers.aggregates()["customer_count"])
+        if customers.error:
+            st.caption(f"⚠️ {customers.error}")
     
     with col5:
         drive_status = "✅ Connected" if st.session_state.get('drive_enabled', False) else "❌ Offline"
         st.metric("Drive Status", drive_status)
 
+@st.fragment(run_every=DRIVE_SYNC_STATUS_POLL_SECONDS)
+def render_sync_status():
+    """Render the background Drive sync state; refreshes on its own timer"""
+    if st.session_state.get('drive_enabled', False) and st.session_state.get('drive_credentials'):
+        sync_status = get_drive_sync_worker().status(
+            st.session_state.drive_credentials,
+            st.session_state.get('drive_folder_id')
+        )
+        last_sync = sync_status.get('last_sync') or st.session_state.get('last_drive_sync', 'Never')
+        state = sync_status.get('state')
+        if state in ("pending", "syncing"):
+            st.caption(f"🔄 Syncing... (last sync: {last_sync})")
+        elif state == "retrying":
+            st.caption(f"⚠️ Sync retrying (attempt {sync_status['attempts']}) - last sync: {last_sync}")
+        elif state == "failed":
+            st.caption(f"❌ Sync failed: {sync_status['error']} - last sync: {last_sync}")
+        else:
+            st.caption(f"☁️ Last sync: {last_sync}")
+    else:
+        st.caption("💻 Local storage only")
+
+@st.fragment
+def render_chat_area(webhook_urls: List[str]):
+    """Render the transcript and handle new prompts without rerunning the rest of the page"""
+    # Display the most recent messages; earlier ones load on demand
+    render_transcript()
+    
+    # New messages go above the inline chat input
+    new_messages = st.container()
+    
+    # Chat input
+    if prompt := st.chat_input("Type your message here... 💬"):
+        with new_messages:
+            # Add user message with timestamp
+            user_message = {
+                "role": "user", 
+                "content": prompt,
+                "timestamp": datetime.now().isoformat()
+            }
+            st.session_state.messages.append(user_message)
+            
+            # Display user message immediately
+            with st.chat_message("user"):
+                st.markdown(f'<div class="user-message">{prompt}</div>', unsafe_allow_html=True)
+                st.caption(f"⏰ {format_timestamp(user_message['timestamp'])}")
+            
+            # Get AI response
+            if webhook_urls:
+                assistant_message = respond_to_prompt(prompt, webhook_urls)
+                st.session_state.messages.append(assistant_message)
+                
+                # Auto-save if enabled
+                new_session = st.session_state.current_session_id not in st.session_state.chat_sessions
+                if st.session_state.auto_save:
+                    save_current_session()
+                
+                # Update last activity
+                st.session_state.last_activity = datetime.now().isoformat()
+                
+                # The session list is outside this fragment; rerun the app so it shows a newly saved session
+                if new_session and st.session_state.current_session_id in st.session_state.chat_sessions:
+                    st.rerun()
+                
+            else:
+                st.error("⚙️ Webhook URL not set. Please enter it in the sidebar.")
+
+@st.fragment
+def render_export_panel():
+    """Export filtered sessions as a download, a local file or a Drive archive"""
+    fmt = st.radio("Format:", list(EXPORT_FORMATS), horizontal=True, key="export_format")
+    date_range = st.date_input("Last activity between:", value=(), key="export_dates")
+    roles, teams = get_search_index().facets()
+    role = st.selectbox("Role:", ["Any"] + roles, key="export_role")
+    team = st.selectbox("Team:", ["Any"] + teams, key="export_team")
+    ids_text = st.text_input("Session IDs (comma-separated, optional):", key="export_ids")
+    
+    destinations = ["Download", "Local file"]
+    if st.session_state.get('drive_enabled', False):
+        destinations.append("Google Drive")
+    destination = st.radio("Destination:", destinations, horizontal=True, key="export_destination")
+    
+    session_ids = [session_id.strip() for session_id in ids_text.split(",") if session_id.strip()]
+    filters = {
+        "start": date_range[0].isoformat() if len(date_range) >= 1 else None,
+        "end": (date_range[-1] + timedelta(days=1)).isoformat() if len(date_range) >= 1 else None,
+        "role": None if role == "Any" else role,
+        "team": None if team == "Any" else team,
+        "session_ids": session_ids or None
+    }
+    store, archive = get_session_store(), get_session_archive()
+    file_name = f"chat_sessions_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    
+    try:
+        if destination == "Download":
+            def build_export() -> bytes:
+                # Runs on click, off the script thread; only the compressed archive is held
+                with tempfile.TemporaryFile() as tmp:
+                    write_export(iter_export_sessions(store, archive, **filters), tmp, fmt)
+                    tmp.seek(0)
+                    return tmp.read()
+            
+            st.download_button(
+                label="💾 Download export",
+                data=build_export,
+                file_name=file_name,
+                mime=EXPORT_FORMATS[fmt]
+            )
+        elif destination == "Local file":
+            local_name = st.text_input(f"File name (saved in {EXPORT_DIR}/):",
+                                       value=f"chat_sessions_export.{fmt}", key=f"export_name_{fmt}")
+            if st.button("📤 Export to file", key="export_local"):
+                count = export_to_file(iter_export_sessions(store, archive, **filters), local_name, fmt)
+                st.success(f"Exported {count} sessions to {export_file_path(local_name, fmt)}")
+        else:
+            if st.button("☁️ Export to Drive", key="export_drive"):
+                drive_manager = get_drive_manager()
+                with st.spinner("Uploading export..."):
+                    if (drive_manager.initialize_from_session()
+                            and drive_manager.upload_sessions_archive(
+                                iter_export_sessions(store, archive, **filters), file_name, fmt)):
+                        invalidate_drive_listing()
+                        st.success(f"Uploaded {file_name} to Drive!")
+    except Exception as e:
+        st.error(f"Export error: {str(e)}")
+
 # ----------------------------
 # Main Application
 # ----------------------------
@@ -711,8 +4896,8 @@ def main():
     </style>
     """, unsafe_allow_html=True)
     
-    # Render sidebar and get webhook URL
-    webhook_url = render_sidebar()
+    # Render sidebar and get webhook URLs
+    webhook_urls = render_sidebar()
     
     # Main content area
     st.title("💬 Lil J's AI Auto Laundry Super Chat")
@@ -733,68 +4918,9 @@ def main():
     # Enhanced chat statistics
     render_chat_stats()
     
-    # Chat messages container
-    chat_container = st.container()
-    
-    with chat_container:
-        # Display chat messages
-        for i, message in enumerate(st.session_state.messages):
-            with st.chat_message(message["role"]):
-                if message["role"] == "assistant":
-                    # Display assistant message with better formatting
-                    st.markdown(f'<div class="assistant-message">{message["content"]}</div>', 
-                              unsafe_allow_html=True)
-                else:
-                    # Display user message
-                    st.markdown(f'<div class="user-message">{message["content"]}</div>', 
-                              unsafe_allow_html=True)
-                
-                # Add timestamp if available
-                if "timestamp" in message:
-                    st.caption(f"⏰ {format_timestamp(message['timestamp'])}")
-    
-    # Chat input
-    if prompt := st.chat_input("Type your message here... 💬"):
-        # Add user message with timestamp
-        user_message = {
-            "role": "user", 
-            "content": prompt,
-            "timestamp": datetime.now().isoformat()
-        }
-        st.session_state.messages.append(user_message)
-        
-        # Display user message immediately
-        with st.chat_message("user"):
-            st.markdown(f'<div class="user-message">{prompt}</div>', unsafe_allow_html=True)
-            st.caption(f"⏰ {format_timestamp(user_message['timestamp'])}")
-        
-        # Get AI response
-        if webhook_url:
-            bot_response = send_message_to_ai(prompt, webhook_url)
-            
-            # Add assistant message with timestamp
-            assistant_message = {
-                "role": "assistant", 
-                "content": bot_response,
-                "timestamp": datetime.now().isoformat()
-            }
-            st.session_state.messages.append(assistant_message)
-            
-            # Display assistant response
-            with st.chat_message("assistant"):
-                st.markdown(f'<div class="assistant-message">{bot_response}</div>', 
-                          unsafe_allow_html=True)
-                st.caption(f"⏰ {format_timestamp(assistant_message['timestamp'])}")
-            
-            # Auto-save if enabled
-            if st.session_state.auto_save:
-                save_current_session()
-            
-            # Update last activity
-            st.session_state.last_activity = datetime.now().isoformat()
-            
-        else:
-            st.error("⚙️ Webhook URL not set. Please enter it in the sidebar.")
+    # Chat transcript and input
+    render_pending_replies()
+    render_chat_area(webhook_urls)
     
     # Footer with Drive sync status
     st.markdown("---")
@@ -806,31 +4932,13 @@ def main():
         st.markdown("🧺 **Lil J's AI Auto Laundry** - Making laundry management smarter, one conversation at a time!")
     
     with footer_col2:
-        if st.session_state.get('drive_enabled', False):
-            last_sync = st.session_state.get('last_drive_sync', 'Never')
-            st.caption(f"☁️ Last sync: {last_sync}")
-        else:
-            st.caption("💻 Local storage only")
+        render_sync_status()
     
     with footer_col3:
-        # Quick export option
+        # Streaming export of selected sessions
         if st.session_state.chat_sessions:
-            if st.button("📤 Export All Sessions"):
-                # Create downloadable JSON
-                export_data = {
-                    "export_timestamp": datetime.now().isoformat(),
-                    "total_sessions": len(st.session_state.chat_sessions),
-                    "user_info": st.session_state.user_info,
-                    "sessions": st.session_state.chat_sessions
-                }
-                
-                json_str = json.dumps(export_data, indent=2, default=str)
-                st.download_button(
-                    label="💾 Download JSON",
-                    data=json_str,
-                    file_name=f"lil_j_chat_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                    mime="application/json"
-                )
+            with st.popover("📤 Export Sessions"):
+                render_export_panel()
 
 if __name__ == "__main__":
     main()
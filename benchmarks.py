@@ -0,0 +1,807 @@
+"""Micro-benchmarks for the hot paths in app.py.
+
+Run ``python benchmarks.py`` for every benchmark, or name the ones to run,
+e.g. ``python benchmarks.py extract session_index``.
+"""
+import importlib.util
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app
+
+# ----------------------------
+# Helpers
+# ----------------------------
+def report(label: str, seconds: float, number: int):
+    print(f"  {label:<42} {seconds / number * 1e6:>10.2f} µs/op")
+
+def run(label: str, func, number: int = 20000):
+    report(label, timeit.timeit(func, number=number), number)
+
+# ----------------------------
+# Response extraction
+# ----------------------------
+def _legacy_strip_html_tags(text):
+    clean = re.compile('<.*?>')
+    return re.sub(clean, '', text)
+
+def _legacy_extract_plain_text(response_text):
+    """extract_plain_text as it was before the extractor registry"""
+    try:
+        data = json.loads(response_text)
+        if isinstance(data, list):
+            for entry in data:
+                if isinstance(entry, dict) and "messages" in entry:
+                    msg_dict = entry["messages"]
+                    for key in ("ai", "assistant", "response", "message", "content", "text"):
+                        if key in msg_dict:
+                            return _legacy_strip_html_tags(str(msg_dict[key]))
+        elif isinstance(data, dict):
+            for key in ("response", "message", "text", "content", "answer", "reply", "output"):
+                if key in data:
+                    content = data[key]
+                    if isinstance(content, str):
+                        return _legacy_strip_html_tags(content)
+                    elif isinstance(content, dict):
+                        for nested_key in ("text", "content", "message"):
+                            if nested_key in content:
+                                return _legacy_strip_html_tags(str(content[nested_key]))
+    except (json.JSONDecodeError, TypeError, KeyError):
+        pass
+    return _legacy_strip_html_tags(str(response_text))
+
+REPLY = ("Our Main Street location is open 6am-11pm today. Machine 4 can be reset by holding "
+         "START for five seconds, then selecting the cycle again. ") * 4
+
+EXTRACT_PAYLOADS = {
+    "messages list": json.dumps([{"messages": {"human": "what are today's hours?", "ai": REPLY},
+                                  "sessionId": "abc123", "metadata": {"tokens": 812}}]),
+    "nested content dict": json.dumps({"response": {"content": REPLY, "model": "gpt-4o", "usage": {"total": 812}},
+                                       "status": "ok"}),
+    "flat output key": json.dumps({"output": REPLY}),
+    "plain text": REPLY,
+    "html-heavy reply": "".join(f"<p><strong>Step {i}:</strong> <a href='#s{i}'>{REPLY[:80]}</a></p>"
+                                for i in range(20)),
+}
+
+# Responses sent in order through one extractor: the first ones teach it a key path,
+# the last carries a key the full search prefers over that path
+EXTRACT_SEQUENCES = {
+    "flat key outranked": [{"output": "hello"}, {"output": "debug", "response": "real answer"}],
+    "nested key outranked": [{"response": {"content": "hello"}},
+                             {"response": {"content": "debug", "text": "real answer"}}],
+    "message entry outranked": [[{"sessionId": "abc"}, {"messages": {"ai": "hello"}}],
+                                [{"messages": {"ai": "real answer"}}, {"messages": {"ai": "debug"}}]],
+    "message key outranked": [[{"messages": {"text": "hello"}}], [{"messages": {"text": "debug", "ai": "real answer"}}]],
+}
+
+def bench_extract():
+    """Legacy extract_plain_text vs. the learned-path ResponseExtractor"""
+    decoder = "orjson" if app.orjson else "ujson" if app.ujson else "json"
+    print(f"extract_plain_text (JSON decoder: {decoder})")
+    for name, payloads in EXTRACT_SEQUENCES.items():
+        extractor = app.ResponseExtractor()
+        for payload in map(json.dumps, payloads):
+            assert extractor.extract(payload) == _legacy_extract_plain_text(payload), name
+    for name, payload in EXTRACT_PAYLOADS.items():
+        extractor = app.ResponseExtractor()
+        assert extractor.extract(payload) == _legacy_extract_plain_text(payload), name
+        run(f"{name} / legacy", lambda: _legacy_extract_plain_text(payload))
+        run(f"{name} / registry", lambda: extractor.extract(payload))
+        assert extractor.extract(payload) == _legacy_extract_plain_text(payload), name  # on the learned path
+
+# ----------------------------
+# Streamed replies
+# ----------------------------
+STREAM_PIECES = ["Our hours ", "are <str", "ong>8am</strong> to ", "10pm."]
+STREAM_TEXT = "Our hours are 8am to 10pm."
+STREAM_PIECE_DELAY = 0.05
+
+def _stream_bodies() -> dict:
+    """Content type, body pieces and expected reply per ``/<format>`` the streaming stub serves"""
+    return {
+        "sse": ("text/event-stream",
+                [f"data: {json.dumps({'output': piece})}\n\n" for piece in STREAM_PIECES] + ["data: [DONE]\n\n"],
+                STREAM_TEXT),
+        "ndjson": ("application/x-ndjson", [json.dumps({"output": piece}) + "\n" for piece in STREAM_PIECES],
+                   STREAM_TEXT),
+        "pretty": ("application/json", json.dumps({"output": STREAM_TEXT}, indent=2).partition("\n")[::2],
+                   STREAM_TEXT),
+        "text": ("text/plain", STREAM_PIECES, STREAM_TEXT),
+        # Plain-text pieces that happen to be valid JSON stay as they are
+        "text-json-like": ("text/plain", ["See the manual ", "[1]", " and ", '"reset"', " the washer."],
+                           'See the manual [1] and "reset" the washer.'),
+        # JSON no extractor recognises comes back as the raw body, as from extract_plain_text
+        "unknown-json": ("application/json", ['{"foo": "bar"}'], '{"foo": "bar"}'),
+        "json-list": ("application/json", ['[{"output": "Hi there"}]'], '[{"output": "Hi there"}]'),
+    }
+
+class _StreamStub(BaseHTTPRequestHandler):
+    """Sends each body piece as its own HTTP chunk, ``STREAM_PIECE_DELAY`` apart"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        content_type, pieces, _ = _stream_bodies()[self.path.strip("/")]
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for piece in pieces:
+            data = piece.encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+            time.sleep(STREAM_PIECE_DELAY)
+        self.wfile.write(b"0\r\n\r\n")
+
+def bench_streaming():
+    """Time to first and last piece of a streamed reply per format, against a local chunked stub"""
+    import requests
+    print(f"streamed replies ({len(STREAM_PIECES)} chunks, {STREAM_PIECE_DELAY * 1000:.0f} ms apart)")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StreamStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for name, (_, _, expected) in _stream_bodies().items():
+            start = time.perf_counter()
+            first = None
+            pieces = []
+            with requests.post(f"http://127.0.0.1:{server.server_port}/{name}", json={}, stream=True) as response:
+                for text in app._iter_reply_text(response):
+                    first = first or time.perf_counter() - start
+                    pieces.append(text)
+            total = time.perf_counter() - start
+            # Tags split across chunks ("<str" + "ong>") must not leak into the reply
+            assert "".join(pieces) == expected, (name, pieces, expected)
+            print(f"  {name:<14} first {first * 1000:>6.0f} ms   last {total * 1000:>6.0f} ms   {len(pieces)} pieces")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# ----------------------------
+# Session index
+# ----------------------------
+def _session_metas(count: int) -> dict:
+    start = datetime(2024, 1, 1)
+    return {
+        f"{i:012x}_{i}": {
+            "session_name": f"Chat {i}",
+            "last_activity": (start + timedelta(seconds=(i * 7919) % (count * 60))).isoformat(),
+            "message_count": i % 40,
+        }
+        for i in range(count)
+    }
+
+def bench_session_index():
+    """Sort-and-sum over every session vs. the incremental SessionIndex"""
+    for count in (10_000, 100_000):
+        print(f"session index ({count:,} sessions)")
+        metas = _session_metas(count)
+        index = app.SessionIndex()
+        index.rebuild((session_id, meta, meta["message_count"]) for session_id, meta in metas.items())
+        
+        def legacy_recent():
+            ranked = sorted(metas.items(), key=lambda item: item[1].get("last_activity", ""), reverse=True)
+            return [session_id for session_id, _ in ranked[:10]]
+        
+        def legacy_totals():
+            return len(metas), sum(meta.get("message_count", 0) for meta in metas.values())
+        
+        assert [session_id for session_id, _ in index.recent(10)] == legacy_recent()
+        assert index.totals() == legacy_totals()
+        
+        session_id, meta = next(iter(metas.items()))
+        touched = dict(meta)
+        
+        def save():
+            touched["last_activity"] = datetime.now().isoformat()
+            index.update(session_id, touched, touched["message_count"])
+        
+        run("recent 10 / sort all", legacy_recent, number=20)
+        run("recent 10 / index", lambda: index.recent(10))
+        run("totals / sum all", legacy_totals, number=20)
+        run("totals / index", index.totals)
+        run("update on save / index", save)
+
+# ----------------------------
+# Sharded storage backends
+# ----------------------------
+def _save_sessions(store, user: str, worker: int, saves: int):
+    for i in range(saves):
+        store.save_session(f"{user}_{worker}_{i}", {
+            "last_activity": datetime.now().isoformat(),
+            "message_count": 2,
+            "messages": [{"role": "user", "content": f"question {i}"},
+                         {"role": "assistant", "content": REPLY}],
+        })
+
+def _file_store_worker(root: str, user: str, worker: int, saves: int):
+    _save_sessions(app.ShardedFileStore(root), user, worker, saves)
+
+def _concurrent_saves(make_store, workers: int, saves: int, shared_shard: bool, processes: bool) -> float:
+    """Run ``workers`` writers saving ``saves`` sessions each; returns saves/second.
+
+    File-store writers are separate processes (like app replicas sharing a
+    volume); key-value writers are threads sharing the in-process stand-in.
+    """
+    store = make_store()
+    users = ["shared000000" if shared_shard else f"user{n:08d}" for n in range(workers)]
+    if processes:
+        context = multiprocessing.get_context("fork")
+        runners = [context.Process(target=_file_store_worker, args=(store.root, users[n], n, saves))
+                   for n in range(workers)]
+    else:
+        runners = [threading.Thread(target=_save_sessions, args=(store, users[n], n, saves))
+                   for n in range(workers)]
+    
+    start = time.perf_counter()
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join()
+    elapsed = time.perf_counter() - start
+    
+    # Every save must survive, including those racing on one user's shard
+    saved = sum(1 for _ in store.iter_sessions())
+    assert saved == workers * saves, (saved, workers * saves)
+    return workers * saves / elapsed
+
+def _check_shared_shard_split():
+    """Sessions from the older one-shard-per-user layout move to their own shards"""
+    with tempfile.TemporaryDirectory() as root:
+        shards = os.path.join(root, "shards")
+        os.makedirs(os.path.join(shards, "sh"))
+        older = {session_id: {"last_activity": "2024-01-01T00:00:00", "messages": []}
+                 for session_id in ("shared000000", "shared000000_1700000000")}
+        with open(os.path.join(shards, "sh", "shared000000.json"), "w") as f:
+            json.dump(older, f)
+        store = app.ShardedFileStore(shards)
+        assert sorted(store._shard_names()) == sorted(older), store._shard_names()
+        assert store.totals() == (2, 0), store.totals()
+
+def bench_store_concurrency(saves: int = 100):
+    """Save throughput by worker count for the sharded file and key-value stores"""
+    _check_shared_shard_split()
+    for name, processes in (("files", True), ("kv (in-process stand-in)", False)):
+        print(f"{name} store ({saves} saves per worker)")
+        for shared_shard in (False, True):
+            for workers in (1, 2, 4, 8):
+                with tempfile.TemporaryDirectory() as root:
+                    if processes:
+                        make_store = lambda: app.ShardedFileStore(os.path.join(root, "shards"))
+                    else:
+                        make_store = lambda: app.KeyValueSessionStore(app.InMemoryKVClient())
+                    rate = _concurrent_saves(make_store, workers, saves, shared_shard, processes)
+                label = f"{workers} writer{'s' if workers > 1 else ''} / {'one shared user' if shared_shard else 'one user each'}"
+                print(f"  {label:<42} {rate:>10.0f} saves/s")
+
+# ----------------------------
+# Message memory
+# ----------------------------
+def _rerun_app():
+    """A second copy of app.py's module, as Streamlit makes on every rerun"""
+    spec = importlib.util.spec_from_file_location("app_rerun", app.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _traced_bytes(build):
+    """Bytes still allocated by ``build()`` while its result is alive"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return used
+
+def bench_message_memory(sessions: int = 2000, messages: int = 50):
+    """Resident size of a synthetic history as plain dicts vs. compact Message records"""
+    print(f"message memory ({sessions:,} sessions x {messages} messages)")
+    start = datetime(2024, 1, 1)
+    roles = ["Visitor", "Customer", "Manager", "Technician", "Admin"]
+    
+    def session(n):
+        # Decoded from JSON, as sessions are when read back from any store
+        return json.loads(json.dumps({
+            "messages": [
+                {
+                    "role": "user" if i % 2 == 0 else "assistant",
+                    "content": f"Message {i}: " + REPLY[:(n * messages + i) * 37 % len(REPLY)],
+                    "timestamp": (start + timedelta(seconds=(n * messages + i) * 61)).isoformat(),
+                }
+                for i in range(messages)
+            ],
+            "user_info": {"name": f"User {n % 50}", "role": roles[n % 5], "team": f"Team {n % 7}"},
+        }))
+    
+    legacy = _traced_bytes(lambda: [session(n) for n in range(sessions)])
+    compact = _traced_bytes(lambda: [app.compact_session(session(n)) for n in range(sessions)])
+    
+    print(f"  {'dict messages':<42} {legacy / 2**20:>10.1f} MiB")
+    print(f"  {'compact messages':<42} {compact / 2**20:>10.1f} MiB")
+    print(f"  {'reduction':<42} {(1 - compact / legacy) * 100:>10.0f} %")
+    
+    sample = session(0)["messages"][0]
+    assert app.Message.from_dict(sample).to_dict() == sample
+    assert app._message_fingerprint(app.Message.from_dict(sample)) == app._message_fingerprint(sample)
+    
+    # A rerun redefines the classes; records from the previous run must still serialize as dicts
+    rerun = _rerun_app()
+    view = rerun.MessageLog([sample]).view()
+    assert json.loads(json.dumps({"messages": view}, default=app._json_default)) == {"messages": [sample]}
+    assert app.Message.from_dict(view[0]) is view[0]
+
+# ----------------------------
+# Webhook outbox
+# ----------------------------
+class _WebhookStub(BaseHTTPRequestHandler):
+    """``/slow<seconds>`` answers late, ``/flaky<n>`` fails twice with 503 before answering,
+    ``/status<code>`` always answers with that status"""
+    protocol_version = "HTTP/1.1"
+    failures = {}
+    hits = {}
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.strip("/")
+        self.hits[path] = self.hits.get(path, 0) + 1
+        if path.startswith("status"):
+            self.send_response(int(path[6:]))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if path.startswith("slow"):
+            time.sleep(float(path[4:]))
+        elif path.startswith("flaky"):
+            self.failures[path] = self.failures.get(path, 0) + 1
+            if self.failures[path] <= 2:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        body = json.dumps({"output": f"reply from {path}"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def _check_patch_message():
+    """Every store patches a placeholder in place, keeping messages saved after it"""
+    with tempfile.TemporaryDirectory() as root:
+        stores = {
+            "sqlite": app.SQLiteSessionStore(os.path.join(root, "sessions.db")),
+            "log": app.SessionLogStore(os.path.join(root, "logs")),
+            "files": app.ShardedFileStore(os.path.join(root, "shards")),
+            "kv": app.KeyValueSessionStore(app.InMemoryKVClient()),
+        }
+        for name, store in stores.items():
+            messages = [{"role": "user", "content": "hours?", "timestamp": "2024-01-01T09:00:00"},
+                        {"role": "assistant", "content": "working", "timestamp": "2024-01-01T09:00:01", "outbox_id": 7}]
+            saved = {"last_activity": "2024-01-01T09:00:00", "messages": messages}
+            store.save_session("s", saved)
+            # The UI appends a turn after the outbox last looked at the session
+            saved["messages"] = messages + [{"role": "user", "content": "thanks", "timestamp": "2024-01-01T09:05:00"}]
+            store.save_session("s", saved)
+            assert store.patch_message("s", 7, "6am-11pm") and not store.patch_message("s", 7, "again"), name
+            patched = store.get_session("s")
+            assert [m["content"] for m in patched["messages"]] == ["hours?", "6am-11pm", "thanks"], (name, patched)
+            assert "outbox_id" not in patched["messages"][1] and patched["last_activity"] > "2024-01-01T09:00:00"
+            # Later saves keep appending on top of the patched history
+            store.save_session("s", {**patched, "messages": patched["messages"] + [{"role": "assistant", "content": "bye"}]})
+            assert [m["content"] for m in store.get_session("s")["messages"]][-2:] == ["thanks", "bye"], name
+
+def bench_outbox(ui_wait: float = 0.5):
+    """Time the UI spends per prompt when the webhook is slow or failing, and late-reply patching"""
+    _check_patch_message()
+    print(f"webhook outbox (UI budget {ui_wait:.1f} s)")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _WebhookStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    app.OUTBOX_POLL_SECONDS, app.OUTBOX_BACKOFF_BASE, app.OUTBOX_BACKOFF_MAX = 0.1, 1.5, 0.2
+    
+    with tempfile.TemporaryDirectory() as root:
+        store = app.SQLiteSessionStore(os.path.join(root, "sessions.db"))
+        search_index = app.SessionSearchIndex(os.path.join(root, "search.db"))
+        outbox = app.WebhookOutbox(
+            app.HedgedDispatcher(app.WebhookClient(max_retries=0)), store,
+            search_index, path=os.path.join(root, "outbox.db")
+        )
+        
+        for n, path in enumerate(("slow0", "slow2", "flaky1")):
+            session_id = f"session{n}"
+            start = time.perf_counter()
+            delivery = outbox.send([f"{base}/{path}"], {"session_id": session_id, "message": "hours?"})
+            delivery.wait(ui_wait)
+            outcome = {}
+            reply = app._delivery_reply(delivery, outcome)
+            waited = time.perf_counter() - start
+            assert waited < ui_wait + 0.25, waited
+            
+            # The placeholder is saved as the UI would, with a later turn after it,
+            # then the late reply replaces it
+            placeholder = {"role": "assistant", "content": app._pending_reply_text(delivery.error),
+                           "timestamp": datetime(2024, 1, 1, 9, 0, 1).isoformat()}
+            if reply is None:
+                placeholder["outbox_id"] = outcome["outbox_id"]
+            saved = {"last_activity": datetime(2024, 1, 1, 9).isoformat(), "messages": [
+                {"role": "user", "content": "hours?", "timestamp": datetime(2024, 1, 1, 9).isoformat()},
+                placeholder,
+                {"role": "user", "content": "thanks", "timestamp": datetime(2024, 1, 1, 9, 5).isoformat()}]}
+            store.save_session(session_id, saved)
+            search_index.index_session(session_id, saved)
+            deadline = time.monotonic() + 5
+            while reply is None and time.monotonic() < deadline:
+                stored = store.get_session(session_id)["messages"][1]
+                if "outbox_id" not in stored:
+                    reply = stored["content"]
+                time.sleep(0.05)
+            assert reply == f"reply from {path}", reply
+            if placeholder.get("outbox_id"):
+                patched = store.get_session(session_id)
+                assert patched["last_activity"] > saved["last_activity"]
+                assert any(hit["session_id"] == session_id for hit in search_index.search(path))
+                assert not any(hit["session_id"] == session_id for hit in search_index.search("working"))
+                # A Drive copy that still has the placeholder merges into the patched one
+                merged = app.merge_sessions(patched, saved)
+                assert merged is None or [m["content"] for m in merged["messages"]] == ["hours?", reply, "thanks"]
+            print(f"  {f'/{path} / UI wait':<42} {waited * 1e3:>10.1f} ms")
+        
+        # A 504 may mean the workflow is still running, so it is not sent again
+        delivery = outbox.send([f"{base}/status504"], {"session_id": "gateway", "message": "hours?"})
+        outcome = {}
+        assert delivery.wait(5) and "504" in app._delivery_reply(delivery, outcome)
+        assert "outbox_id" not in outcome
+        time.sleep(0.5)  # a few retry polls
+        assert _WebhookStub.hits["status504"] == 1, _WebhookStub.hits
+        
+        # Concurrent slow prompts from many users are not queued behind each other,
+        # even beyond the hedge executor's size
+        users = app.WEBHOOK_HEDGE_WORKERS * 2 + 5
+        start = time.perf_counter()
+        deliveries = [outbox.send([f"{base}/slow1"], {"session_id": f"user{n}", "message": "hours?"})
+                      for n in range(users)]
+        for delivery in deliveries:
+            assert delivery.wait(5) and delivery.reply == "reply from slow1"
+        elapsed = time.perf_counter() - start
+        assert elapsed < 1.8, elapsed
+        while len(outbox.results(d.outbox_id for d in deliveries)) < users:
+            time.sleep(0.01)  # recorded before the database goes away
+        print(f"  {f'{users} concurrent /slow1 / all replied':<42} {elapsed * 1e3:>10.1f} ms")
+        server.shutdown()
+
+# ----------------------------
+# Conversation context
+# ----------------------------
+def _legacy_context(messages):
+    """build_ai_payload's context as it was before the context builder"""
+    return [{"role": msg["role"], "content": msg["content"][:200]} for msg in messages[-5:]]
+
+def bench_context(turns: int = 2000, role: str = "Manager"):
+    """Payload context per prompt as a session grows: last 5 clipped vs. budget with rolling summary"""
+    budget = app.context_budget(role)
+    print(f"conversation context ({role}, {budget:,} byte budget)")
+    machines = ["washer 4", "dryer 2", "the coin changer", "washer 11", "the card reader"]
+    log = app.MessageLog()
+    summary = None
+    timings = {}
+    for n in range(turns):
+        topic = machines[n % len(machines)]
+        log.append({"role": "user", "content": f"Turn {n}: {topic} at Main Street shows error E{n % 9}. What should I do?",
+                    "timestamp": datetime(2024, 1, 1, 9).isoformat()})
+        start = time.perf_counter()
+        recent, summary = app.build_context(log, role, summary)
+        payload = json.dumps({"context": recent, "context_summary": summary["text"]})
+        elapsed = time.perf_counter() - start
+        
+        recent_bytes = sum(len(m["content"].encode()) for m in recent)
+        assert recent_bytes + len(summary["text"].encode()) <= budget
+        assert summary["covered"] == len(log) - len(recent)
+        assert recent[-1]["content"] == log[-1]["content"]
+        if n + 1 in (10, 100, 1000, turns):
+            timings[n + 1] = (elapsed, len(payload.encode()))
+        log.append({"role": "assistant", "content": REPLY, "timestamp": datetime(2024, 1, 1, 9).isoformat()})
+    
+    # A changed history is noticed and the summary rebuilt rather than extended
+    edited = app.MessageLog(log[:100])
+    edited[50] = {"role": "user", "content": "Edited question about the soap dispenser."}
+    assert app.build_context(edited, role, summary)[1]["covered"] <= 100
+    
+    # Session metadata carries only the text; the incremental state stays out of it
+    saved = app.saved_context_summary(summary)
+    assert app.update_context_summary(saved, log, saved["covered"], saved["budget"])["text"] == summary["text"]
+    
+    # A session loaded without that state continues its saved summary instead of rebuilding it
+    class _ReadLog(list):
+        first_read = len(log)
+        def __getitem__(self, index):
+            if isinstance(index, int):
+                self.first_read = min(self.first_read, index % len(self))
+            return super().__getitem__(index)
+    continued = _ReadLog(log)
+    continued.append({"role": "user", "content": "One more question about washer 4 and its error code.",
+                      "timestamp": datetime(2024, 1, 1, 9).isoformat()})
+    recent, resumed = app.build_context(continued, role, saved)
+    assert resumed["covered"] == len(continued) - len(recent) > saved["covered"]
+    assert continued.first_read >= saved["covered"] - 1, continued.first_read
+    
+    for count, (elapsed, size) in timings.items():
+        print(f"  {f'{count:,} prompts / payload bytes':<42} {size:>10,}")
+        print(f"  {f'{count:,} prompts / build + serialize':<42} {elapsed * 1e6:>10.2f} µs/op")
+    legacy = json.dumps({"context": _legacy_context(log)})
+    print(f"  {'legacy last 5 x 200 chars / payload bytes':<42} {len(legacy.encode()):>10,}")
+    print(f"  {'saved summary / metadata bytes':<42} {len(json.dumps(saved).encode()):>10,}")
+    print(f"  {'full summary state / bytes':<42} {len(json.dumps(summary).encode()):>10,}")
+    print(f"  {'summary':<42} {summary['text'][:60]!r}")
+
+# ----------------------------
+# Drive file listing
+# ----------------------------
+class _FakeRequest:
+    def __init__(self, result):
+        self._result = result
+    
+    def execute(self):
+        return self._result()
+
+class FakeDriveService:
+    """In-memory stand-in for the Drive v3 ``files`` and ``changes`` endpoints used by the listing.
+
+    Only the folder and name filters of the session-file query are honoured;
+    a page token older than ``oldest_token`` is rejected with a 410 like an
+    expired one. ``calls`` counts requests per endpoint.
+    """
+
+    def __init__(self, folder_id: str):
+        self.folder_id = folder_id
+        self.store = {}
+        self.log = []  # change feed: one file ID per change
+        self.oldest_token = 0
+        self.calls = {"files.list": 0, "changes.list": 0, "changes.getStartPageToken": 0}
+    
+    def put(self, file_id: str, name: str, parents=None, trashed=False):
+        self.store[file_id] = {
+            "id": file_id, "name": name, "size": str(len(name) * 100),
+            "modifiedTime": f"2024-01-01T00:00:{len(self.log) % 60:02d}.{len(self.log):06d}Z",
+            "parents": parents or [self.folder_id], "trashed": trashed,
+        }
+        self.log.append(file_id)
+    
+    def delete(self, file_id: str):
+        del self.store[file_id]
+        self.log.append(file_id)
+    
+    def files(self):
+        return self
+    
+    def changes(self):
+        return _FakeChanges(self)
+    
+    def list(self, q, pageSize=100, pageToken=None, **kwargs):
+        def result():
+            self.calls["files.list"] += 1
+            matches = sorted(
+                (f for f in self.store.values()
+                 if self.folder_id in f["parents"] and "chat_sessions" in f["name"] and not f["trashed"]),
+                key=lambda f: f["modifiedTime"], reverse=True
+            )
+            start = int(pageToken or 0)
+            page = {"files": [{k: f[k] for k in ("id", "name", "modifiedTime", "size")}
+                              for f in matches[start:start + pageSize]]}
+            if start + pageSize < len(matches):
+                page["nextPageToken"] = str(start + pageSize)
+            return page
+        return _FakeRequest(result)
+
+class _FakeChanges:
+    def __init__(self, drive: FakeDriveService):
+        self.drive = drive
+    
+    def getStartPageToken(self):
+        def result():
+            self.drive.calls["changes.getStartPageToken"] += 1
+            return {"startPageToken": str(len(self.drive.log))}
+        return _FakeRequest(result)
+    
+    def list(self, pageToken, pageSize=100, **kwargs):
+        def result():
+            self.drive.calls["changes.list"] += 1
+            start = int(pageToken)
+            if start < self.drive.oldest_token:
+                error = Exception("410 page token expired")
+                error.resp = type("Response", (), {"status": 410})()
+                raise error
+            changes = []
+            for file_id in self.drive.log[start:start + pageSize]:
+                if file_id in self.drive.store:
+                    changes.append({"fileId": file_id, "removed": False, "file": dict(self.drive.store[file_id])})
+                else:
+                    changes.append({"fileId": file_id, "removed": True})
+            end = start + len(changes)
+            if end < len(self.drive.log):
+                return {"changes": changes, "nextPageToken": str(end)}
+            return {"changes": changes, "newStartPageToken": str(end)}
+        return _FakeRequest(result)
+
+def _legacy_list_session_files(service, folder_id):
+    """list_session_files as it was before the cached listing: one request, first page only"""
+    query = f"parents in \"{folder_id}\" and name contains \"chat_sessions\""
+    return service.files().list(q=query, orderBy='modifiedTime desc', spaces='drive',
+                                fields="files(id, name, modifiedTime, size)").execute().get('files', [])
+
+def bench_drive_listing(files: int = 2500):
+    """Per-render Drive listing vs. the cached, paginated and incremental DriveFileListing"""
+    print(f"drive listing ({files:,} session files, {app.DRIVE_LIST_PAGE_SIZE} per page)")
+    drive = FakeDriveService("folder")
+    for n in range(files):
+        drive.put(f"f{n}", f"chat_sessions_{n:05d}.json")
+    drive.put("other", "notes.txt")
+    drive.put("elsewhere", "chat_sessions_other.json", parents=["another-folder"])
+    
+    manager = app.GoogleDriveManager(client_pool=object())
+    manager.service, manager.folder_id = drive, "folder"
+    
+    def expected():
+        return sorted((f for f in drive.store.values()
+                       if "folder" in f["parents"] and "chat_sessions" in f["name"] and not f["trashed"]),
+                      key=lambda f: f["modifiedTime"], reverse=True)
+    
+    def check(listing):
+        assert [f["id"] for f in listing.files("folder")] == [f["id"] for f in expected()]
+    
+    with tempfile.TemporaryDirectory() as root:
+        listing = app.DriveFileListing(client_pool=None, path=os.path.join(root, "listing.json"))
+        assert listing.files("folder") is None and listing.is_stale("folder")
+        
+        legacy = _legacy_list_session_files(drive, "folder")
+        print(f"  {'files seen / single request':<42} {len(legacy):>10,}")
+        listing.refresh(manager)
+        check(listing)
+        print(f"  {'files seen / paginated listing':<42} {len(listing.files('folder')):>10,}")
+        assert not listing.is_stale("folder")
+        
+        # New, renamed, moved, trashed and deleted files arrive through the Changes API only
+        drive.calls = dict.fromkeys(drive.calls, 0)
+        drive.put("new", "chat_sessions_new.json")
+        drive.put("f1", "chat_sessions_renamed.json")
+        drive.put("f2", "notes_from_f2.txt")
+        drive.put("f3", "chat_sessions_00003.json", parents=["another-folder"])
+        drive.put("f4", "chat_sessions_00004.json", trashed=True)
+        drive.delete("f5")
+        listing.refresh(manager)
+        check(listing)
+        assert drive.calls == {"files.list": 0, "changes.list": 1, "changes.getStartPageToken": 0}, drive.calls
+        
+        # The token and files survive a restart
+        restarted = app.DriveFileListing(client_pool=None, path=listing.path)
+        check(restarted)
+        
+        # An expired token falls back to a full listing
+        drive.oldest_token = len(drive.log) + 1
+        drive.put("after-expiry", "chat_sessions_after_expiry.json")
+        drive.oldest_token = len(drive.log)
+        restarted.refresh(manager)
+        check(restarted)
+        
+        run("per render / files.list every page", app.GoogleDriveManager.list_session_files.__get__(manager), number=20)
+        run("per render / changes.list (no changes)", lambda: listing.refresh(manager), number=200)
+        run("per render / cached listing", lambda: listing.files("folder"), number=200)
+
+# ----------------------------
+# Startup imports
+# ----------------------------
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", 800))
+DRIVE_MODULES = ("googleapiclient", "google_auth_oauthlib", "google.oauth2", "google_auth_httplib2")
+
+def _import_times(statement: str) -> dict:
+    """Cumulative import time in µs per module, from ``python -X importtime``"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=here, capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|(\s+)(\S+)", line)
+        if match:
+            times[match.group(3)] = (int(match.group(1)), len(match.group(2)) - 1)
+    return times
+
+def bench_startup(rounds: int = 5):
+    """Time to import app.py (the work before first render) against STARTUP_BUDGET_MS"""
+    print(f"startup imports (best of {rounds}, budget {STARTUP_BUDGET_MS:.0f} ms)")
+    runs = [_import_times("import app") for _ in range(rounds)]
+    best = min(runs, key=lambda times: times["app"][0])
+    total_ms = best["app"][0] / 1000
+    
+    top_level = sorted(
+        ((name, us) for name, (us, depth) in best.items() if depth == 2),
+        key=lambda item: item[1], reverse=True
+    )
+    for name, us in top_level[:6]:
+        print(f"  {name:<42} {us / 1000:>10.1f} ms")
+    print(f"  {'import app (total)':<42} {total_ms:>10.1f} ms")
+    
+    deferred = _import_times("import googleapiclient.discovery, googleapiclient.http, google.oauth2.service_account")
+    deferred_ms = sum(us for name, (us, depth) in deferred.items() if depth == 0) / 1000
+    print(f"  {'Drive stack alone (now deferred)':<42} {deferred_ms:>10.1f} ms")
+    
+    eager = [name for name in best if name.startswith(DRIVE_MODULES)]
+    assert not eager, f"Drive modules imported at startup: {eager[:5]}"
+    assert total_ms <= STARTUP_BUDGET_MS, f"import app took {total_ms:.0f} ms (budget {STARTUP_BUDGET_MS:.0f} ms)"
+
+# ----------------------------
+# Customer dataset
+# ----------------------------
+def _write_customers(path: str, rows: int, churned_every: int = 4):
+    segments = ["Wash & Fold", "Self Service", "Commercial", "Dry Cleaning"]
+    with open(path, "w") as f:
+        f.write("customer_id,name,Segment,Status,last_visit\n")
+        for n in range(rows):
+            status = "churned" if n % churned_every == 0 else "Active"
+            f.write(f"{n},Customer {n},{segments[n % len(segments)]},{status},2024-01-{n % 28 + 1:02d}\n")
+
+def bench_customers(rows: int = 200_000):
+    """Customer aggregates per rerun: reading the CRM export each time vs. the shared CustomerDataset"""
+    import pandas as pd
+    print(f"customer dataset ({rows:,} rows)")
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "customers.csv")
+        _write_customers(path, rows)
+        dataset = app.CustomerDataset(path)
+        
+        start = time.perf_counter()
+        aggregates = dataset.aggregates()
+        report("first use / load + aggregate", time.perf_counter() - start, 1)
+        assert aggregates["customer_count"] == rows
+        assert aggregates["active_customers"] == rows - len(range(0, rows, 4))
+        assert sum(aggregates["customers_by_segment"].values()) == rows
+        
+        run("per rerun / read_csv + aggregate", lambda: app.CustomerDataset._aggregate(pd.read_csv(path)), number=3)
+        run("per rerun / cached (mtime check)", dataset.aggregates)
+        assert dataset.frame() is dataset.frame()
+        
+        # A new export is picked up once its mtime changes; Parquet loads the same way
+        _write_customers(path, rows // 2, churned_every=2)
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000))
+        assert dataset.aggregates()["active_customers"] == rows // 4
+        parquet_path = os.path.join(root, "customers.parquet")
+        dataset.frame().to_parquet(parquet_path)
+        assert app.CustomerDataset(parquet_path).aggregates() == dataset.aggregates()
+        assert app.CustomerDataset(os.path.join(root, "missing.csv")).aggregates()["customer_count"] == 0
+    
+    assert "pandas" not in _import_times("import app"), "pandas imported at startup"
+
+BENCHMARKS = {
+    "extract": bench_extract,
+    "streaming": bench_streaming,
+    "session_index": bench_session_index,
+    "startup": bench_startup,
+    "store_concurrency": bench_store_concurrency,
+    "message_memory": bench_message_memory,
+    "drive_listing": bench_drive_listing,
+    "context": bench_context,
+    "outbox": bench_outbox,
+    "customers": bench_customers,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()